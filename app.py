@@ -1,10 +1,17 @@
-from flask import Flask
+from flask import Flask, Response, abort, jsonify, request, send_file
+import hmac
 import os
 import threading
 import traceback
 
 app = Flask(__name__)
 
+# STARTUP_MODE=eager: main importato e scheduler avviato durante l'import dell'app.
+# background (default): lo fa un thread, così il worker risponde subito a /health;
+# con STARTUP_WARMUP=1 lo stesso thread precarica poi stato, template card e Bot.
+STARTUP_MODE = os.environ.get("STARTUP_MODE", "background").strip().lower()
+STARTUP_WARMUP = os.environ.get("STARTUP_WARMUP", "1") == "1"
+
 _main = None
 _import_trace = None
 _scheduler_started = False
@@ -46,8 +53,17 @@ def _start_scheduler_once():
     _scheduler_started = True
 
 
+def _startup():
+    _start_scheduler_once()
+    if STARTUP_WARMUP and _main is not None:
+        _main.warm_up()
+
+
 # Avvio scheduler in background (una sola volta)
-_start_scheduler_once()
+if STARTUP_MODE == "eager":
+    _start_scheduler_once()
+else:
+    threading.Thread(target=_startup, name="startup", daemon=True).start()
 
 
 @app.get("/health")
@@ -60,20 +76,110 @@ def health():
     return "OK" + forwarding_info, 200
 
 
-@app.get("/run")
+@app.route("/run", methods=["GET", "POST"])
 def run_now():
+    """Avvia un ciclo in background (o si aggancia a quello in corso) e ritorna subito l'id del job."""
     _load_main()
     if _main is None:
         tail = (_import_trace or "Errore sconosciuto")[-2000:]
         return f"❌ main.py non importabile.\n\n{tail}", 500
 
+    # breaker aperto e niente in coda: inutile avviare un ciclo
+    api_ok, retry_in = _main.creators_available()
+    if not api_ok and _main.prefetch_size() == 0 and _main.cycle_in_flight() is None:
+        return Response(
+            f"⛔ Creators API sospesa (circuit breaker aperto), riprova tra {retry_in:.0f}s",
+            status=503,
+            headers={"Retry-After": str(int(retry_in) + 1)},
+            mimetype="text/plain",
+        )
+
     try:
-        ok = _main.invia_offerta()
-        if ok:
-            return "✅ Offerta pubblicata davvero", 200
-        return "⚠️ Nessuna offerta valida trovata (filtri/duplicati o prezzi non disponibili). Riprova tra poco.", 200
+        job = _main.submit_run_job("http")
     except Exception:
         return f"❌ Errore runtime:\n\n{traceback.format_exc()[-2000:]}", 500
+    job["status_url"] = f"/run/{job['id']}"
+    return jsonify(job), 202, {"Location": job["status_url"]}
+
+
+@app.get("/run/<job_id>")
+def run_status(job_id):
+    """Stato di un job di /run: running, done (posted true/false) o error."""
+    _load_main()
+    if _main is None:
+        return jsonify({"error": "main.py non importabile"}), 503
+    job = _main.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "job sconosciuto o scaduto"}), 404
+    return jsonify(job)
+
+
+@app.get("/metrics")
+def metrics():
+    _load_main()
+    if _main is None:
+        return "# main.py non importabile\n", 503
+    return Response(_main.render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+@app.get("/status/creators")
+def creators_status():
+    _load_main()
+    if _main is None:
+        return jsonify({"error": "main.py non importabile"}), 503
+    return jsonify(_main.creators_status())
+
+
+@app.get("/status/keywords")
+def keywords_status():
+    _load_main()
+    if _main is None:
+        return jsonify({"error": "main.py non importabile"}), 503
+    return jsonify({"selector": _main.KEYWORD_SELECTOR, "keywords": _main.keyword_stats()})
+
+
+@app.get("/status/caches")
+def caches_status():
+    _load_main()
+    if _main is None:
+        return jsonify({"error": "main.py non importabile"}), 503
+    return jsonify({"search": _main.search_cache_stats(), "negative": _main.negative_cache_stats()})
+
+
+def _check_debug_token():
+    """
+    Le route /debug richiedono DEBUG_ROUTES_TOKEN nell'header X-Debug-Token (non in query
+    string, che finisce nei log di accesso); confronto a tempo costante.
+    """
+    expected = os.environ.get("DEBUG_ROUTES_TOKEN", "").strip()
+    given = request.headers.get("X-Debug-Token", "")
+    if not expected or not hmac.compare_digest(given.encode(), expected.encode()):
+        abort(403)
+    _load_main()
+    if _main is None:
+        abort(503)
+
+
+@app.get("/debug/profiles")
+def debug_profiles():
+    _check_debug_token()
+    return jsonify([{"name": n, "bytes": b} for n, b in _main.list_profiles()])
+
+
+@app.get("/debug/profiles/<name>")
+def debug_profile_file(name):
+    _check_debug_token()
+    path = _main.profile_path(name)
+    if path is None:
+        abort(404)
+    return send_file(path, as_attachment=name.endswith(".prof"))
+
+
+@app.get("/debug/traces")
+def debug_traces():
+    _check_debug_token()
+    n = max(1, min(request.args.get("n", 20, type=int), 500))
+    return jsonify(_main.tail_traces(n))
 
 
 if __name__ == "__main__":
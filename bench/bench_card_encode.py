@@ -0,0 +1,100 @@
+"""
+Benchmark formati della card: renderizza card di esempio e misura per ogni
+formato tempo di encode, dimensione e tempo di upload stimato verso Telegram.
+
+Uso:
+    python bench/bench_card_encode.py
+    python bench/bench_card_encode.py --image foto1.jpg --image foto2.jpg --uplink-mbps 20
+    CARD_JPEG_QUALITY=80 python bench/bench_card_encode.py
+
+Senza --image i tile prodotto sono sintetici (gradiente + rumore, simile a una foto).
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+from bench_common import ROOT, prepare_main_env
+
+os.chdir(ROOT)  # FONT_PATH/LOGO_PATH/BADGE_PATH sono relativi alla root
+prepare_main_env()
+
+from PIL import Image, ImageDraw, ImageFilter  # noqa: E402
+
+import main  # noqa: E402
+
+FORMATS = ["png", "jpeg", "webp"]
+
+
+def synthetic_tile(rng, size=(600, 600)):
+    w, h = size
+    c1 = [rng.randint(0, 255) for _ in range(3)]
+    c2 = [rng.randint(0, 255) for _ in range(3)]
+    tile = Image.linear_gradient("L").resize(size).convert("RGB")
+    tile = Image.composite(Image.new("RGB", size, tuple(c1)), Image.new("RGB", size, tuple(c2)), tile.convert("L"))
+    draw = ImageDraw.Draw(tile)
+    for _ in range(40):
+        x, y = rng.randint(0, w), rng.randint(0, h)
+        r = rng.randint(10, 120)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(rng.randint(0, 255) for _ in range(3)))
+    noise = Image.effect_noise(size, 24).convert("RGB")
+    return Image.blend(tile.filter(ImageFilter.GaussianBlur(2)), noise, 0.12)
+
+
+def sample_cards(args):
+    rng = random.Random(args.seed)
+    tiles = []
+    for path in args.image:
+        with Image.open(path) as im:
+            tiles.append(im.convert("RGB").resize((600, 600)))
+    while len(tiles) < args.cards:
+        tiles.append(synthetic_tile(rng))
+
+    cards = []
+    for i, tile in enumerate(tiles[: args.cards]):
+        price = round(rng.uniform(20, 900), 2)
+        cards.append(main.render_card(f"Prodotto {i}", price, price * 1.4, 29, tile, i % 2 == 0))
+    return cards
+
+
+def main_cli():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--cards", type=int, default=8)
+    ap.add_argument("--image", action="append", default=[], help="foto prodotto locale (ripetibile)")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--uplink-mbps", type=float, default=10.0, help="banda in upload verso api.telegram.org")
+    ap.add_argument("--rtt-ms", type=float, default=60.0)
+    ap.add_argument("--seed", type=int, default=7)
+    args = ap.parse_args()
+
+    cards = sample_cards(args)
+    print(
+        f"cards={len(cards)} uplink={args.uplink_mbps} Mbit/s rtt={args.rtt_ms:.0f} ms | "
+        f"png compress={main.CARD_PNG_COMPRESS} jpeg q={main.CARD_JPEG_QUALITY} "
+        f"optimize={main.CARD_JPEG_OPTIMIZE} webp q={main.CARD_WEBP_QUALITY} method={main.CARD_WEBP_METHOD}"
+    )
+    print(f"{'formato':<8}{'encode p50 ms':>15}{'encode max ms':>15}{'KB medi':>10}{'upload ms':>11}{'totale ms':>11}")
+
+    for fmt in FORMATS:
+        times, sizes = [], []
+        for card in cards:
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                out = main.encode_card(card, fmt)
+                times.append((time.perf_counter() - t0) * 1000)
+            sizes.append(len(out.getvalue()))
+
+        avg_bytes = statistics.mean(sizes)
+        # stima: handshake già fatto (keep-alive), un RTT per la risposta + byte / banda
+        upload_ms = args.rtt_ms + avg_bytes * 8 / (args.uplink_mbps * 1e6) * 1000
+        p50 = statistics.median(times)
+        print(
+            f"{fmt:<8}{p50:>15.1f}{max(times):>15.1f}{avg_bytes / 1024:>10.0f}"
+            f"{upload_ms:>11.0f}{p50 + upload_ms:>11.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,22 @@
+"""Funzioni condivise dagli script di bench/."""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def prepare_main_env():
+    """Da chiamare prima di "import main": root nel path e DATA_DIR temporanea se non impostata."""
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    if not os.environ.get("DATA_DIR"):
+        os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="bench_")
+
+
+def percentile(sorted_samples, q):
+    """Percentile q (0-100) con il metodo nearest-rank su campioni già ordinati."""
+    if not sorted_samples:
+        return 0.0
+    idx = min(len(sorted_samples) - 1, max(0, int(round(q / 100 * len(sorted_samples) + 0.5)) - 1))
+    return sorted_samples[idx]
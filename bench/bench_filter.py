@@ -0,0 +1,124 @@
+"""
+Benchmark filtro offerte: percorso per-item (_reject_reason, un item alla volta)
+contro filter_deals (maschere numpy su tutto il lotto).
+
+Uso:
+    python bench/bench_filter.py                      # 50k item sintetici
+    python bench/bench_filter.py --items 200000
+    python bench/bench_filter.py --fixture risposte.json [--fixture altra.json]
+
+Le fixture sono risposte searchItems/getItems registrate ({"searchResult": {"items": [...]}}
+oppure {"items": [...]}); vengono replicate fino a --items elementi.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+from bench_common import prepare_main_env
+
+prepare_main_env()
+
+import main  # noqa: E402
+
+
+def synthetic_item(rng, i):
+    """Item nelle forme gestite da extract_from_item (savings, savingBasis, dealDetails, summaries)."""
+    price = round(rng.uniform(5, 1500), 2)
+    saving = round(price * rng.uniform(0, 0.6), 2)
+    shape = i % 5
+    listing = {"price": {"money": {"amount": price}}}
+    item = {"asin": f"B{i:09d}", "itemInfo": {"title": {"displayValue": f"Prodotto {i}"}}}
+    if shape == 0:
+        listing["savings"] = {"money": {"amount": saving}, "percentage": int(saving / (price + saving) * 100)}
+    elif shape == 1:
+        listing["savingBasis"] = {"money": {"amount": price + saving}}
+    elif shape == 2:
+        listing["dealDetails"] = [{"listPrice": {"displayAmount": f"{price + saving:.2f}".replace(".", ",") + " €"}}]
+    elif shape == 3:
+        item["offersV2"] = {
+            "listings": [listing],
+            "summaries": [{"savings": {"percentage": 20, "money": {"amount": saving}}}],
+        }
+        return item
+    else:
+        listing = {}
+    item["offersV2"] = {"listings": [listing] if listing else []}
+    return item
+
+
+def load_fixture_items(paths):
+    items = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            j = json.load(f)
+        items.extend(main.safe_get(j, "searchResult", "items", default=None) or j.get("items", []) or [])
+    return items
+
+
+def per_item_path(parsed_list, ranked):
+    ok = []
+    for parsed in parsed_list:
+        if main._reject_reason(parsed) is None:
+            if not ranked:
+                return [parsed]
+            ok.append(parsed)
+    ok.sort(key=lambda p: -main.deal_score(p))
+    return ok
+
+
+def timed(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main_cli():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--items", type=int, default=50000)
+    ap.add_argument("--fixture", action="append", default=[])
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--seed", type=int, default=42)
+    args = ap.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.fixture:
+        base = load_fixture_items(args.fixture)
+        if not base:
+            sys.exit("Nessun item nelle fixture")
+        raw = [base[i % len(base)] for i in range(args.items)]
+    else:
+        raw = [synthetic_item(rng, i) for i in range(args.items)]
+
+    t0 = time.perf_counter()
+    parsed_list = [main.extract_from_item(item) for item in raw]
+    t_parse = time.perf_counter() - t0
+
+    # verifica che i due percorsi accettino gli stessi item
+    ok_batch, _ = main.filter_deals(parsed_list)
+    ok_item = [i for i, p in enumerate(parsed_list) if main._reject_reason(p) is None]
+    assert ok_batch == ok_item, "filter_deals e _reject_reason divergono"
+
+    n = len(parsed_list)
+    print(f"items={n} validi={len(ok_batch)} numpy={'si' if main.get_numpy() is not None else 'no'}")
+    print(f"{'stage':<28}{'tempo (ms)':>12}{'item/s':>14}")
+    print(f"{'extract_from_item':<28}{t_parse * 1000:>12.1f}{n / t_parse:>14,.0f}")
+
+    rows = [
+        ("per-item, tutti i validi", lambda: [p for p in parsed_list if main._reject_reason(p) is None]),
+        ("per-item, ranked", lambda: per_item_path(parsed_list, ranked=True)),
+        ("filter_deals", lambda: main.filter_deals(parsed_list)),
+        ("filter_deals ranked", lambda: main.filter_deals(parsed_list, ranked=True)),
+    ]
+    for label, fn in rows:
+        t = timed(fn, args.repeat)
+        print(f"{label:<28}{t * 1000:>12.1f}{n / t:>14,.0f}")
+
+
+if __name__ == "__main__":
+    main_cli()
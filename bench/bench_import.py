@@ -0,0 +1,179 @@
+"""
+Tempo di import di main (cold start del worker): ogni giro è un processo nuovo con
+-X importtime, da cui si ricava il dettaglio per modulo importato direttamente da main.
+Misura anche warm_up() (stato, numpy, template card, PIL, Bot) che app.py esegue in background.
+
+Controlli rispetto a bench/import_budget.json:
+    - mediana di "import main" (cumulativo) entro budget_ms
+    - nessuno dei moduli in lazy_modules (PIL, telegram, numpy, ...) caricato dall'import
+    - DATA_DIR non creata dall'import
+
+Uso:
+    python bench/bench_import.py                      # confronta con il budget
+    python bench/bench_import.py --runs 10 --top 20
+    python bench/bench_import.py --update-budget      # budget = mediana attuale + headroom
+    python bench/bench_import.py --cold               # senza .pyc (primo avvio dopo il deploy)
+
+Esce con codice 1 se un controllo fallisce.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+BUDGET_FILE = os.path.join(BENCH_DIR, "import_budget.json")
+DEFAULT_LAZY = ["PIL", "telegram", "numpy", "pstats"]
+
+PROBE = """
+import json, os, sys, time
+t0 = time.perf_counter()
+import main
+t1 = time.perf_counter()
+lazy = sorted({m.split(".")[0] for m in sys.modules} & set(LAZY))
+data_dir = os.path.isdir(main.DATA_DIR)
+t2 = time.perf_counter()
+if WARMUP:
+    main.warm_up()
+t3 = time.perf_counter()
+print("@@" + json.dumps({"import_ms": (t1 - t0) * 1000, "warmup_ms": (t3 - t2) * 1000,
+                         "lazy_loaded": lazy, "data_dir_created": data_dir}))
+"""
+
+
+def parse_importtime(stderr):
+    """[(livello, self_us, cumulativo_us, modulo)] dalle righe di -X importtime."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        head, cum_us, name = line.split("|", 2)
+        self_us = head.split(":", 1)[1]
+        name = name.rstrip()
+        # il nome è rientrato di 2 spazi per livello di annidamento (dopo uno spazio fisso)
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((level, int(self_us), int(cum_us), name.strip()))
+    return rows
+
+
+def main_breakdown(rows):
+    """(self_us, cumulativo_us, figli diretti) della riga di main."""
+    children = []
+    for level, self_us, cum_us, name in rows:
+        if level == 0 and name == "main":
+            return self_us, cum_us, children
+        if level == 0:
+            children = []
+        elif level == 1:
+            children.append((name, self_us, cum_us))
+    return 0, 0, []
+
+
+def run_once(args, lazy):
+    env = {k: v for k, v in os.environ.items() if k != "PYTHONDONTWRITEBYTECODE"}
+    if args.cold:
+        env["PYTHONDONTWRITEBYTECODE"] = "1"
+    # main non deve trovare la cartella dati: si verifica che l'import non la crei
+    env["DATA_DIR"] = os.path.join(tempfile.mkdtemp(prefix="bench_import_"), "data")
+    # warm_up() costruisce il Bot: basta un token con formato valido, la rete non si usa
+    env.setdefault("TELEGRAM_BOT_TOKEN", "123456:BENCH")
+    code = f"LAZY = {lazy!r}\nWARMUP = {not args.no_warmup!r}\n" + PROBE
+    cmd = [sys.executable, "-X", "importtime"]
+    if args.cold:
+        cmd.append("-B")
+    proc = subprocess.run(cmd + ["-c", code], cwd=ROOT, env=env, capture_output=True, text=True)
+    result = next((json.loads(l[2:]) for l in proc.stdout.splitlines() if l.startswith("@@")), None)
+    if proc.returncode != 0 or result is None:
+        sys.exit(f"Import di main fallito:\n{proc.stderr[-3000:]}")
+    self_us, cum_us, children = main_breakdown(parse_importtime(proc.stderr))
+    result.update(main_self_ms=self_us / 1000, main_cum_ms=cum_us / 1000, children=children)
+    return result
+
+
+def main_cli():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--top", type=int, default=15, help="moduli figli di main da mostrare")
+    ap.add_argument("--cold", action="store_true", help="niente .pyc (compila main a ogni giro)")
+    ap.add_argument("--no-warmup", action="store_true", help="non misurare warm_up()")
+    ap.add_argument("--budget", default=BUDGET_FILE)
+    ap.add_argument("--update-budget", action="store_true")
+    ap.add_argument("--headroom", type=float, default=0.3, help="margine sulla mediana con --update-budget")
+    ap.add_argument("--json", action="store_true", help="stampa i risultati in JSON")
+    args = ap.parse_args()
+
+    budget = {}
+    if os.path.exists(args.budget):
+        with open(args.budget, "r", encoding="utf-8") as f:
+            budget = json.load(f)
+    lazy = budget.get("lazy_modules", DEFAULT_LAZY)
+
+    if not args.cold:
+        run_once(args, lazy)  # scrive i .pyc, come dopo il primo avvio in produzione
+    runs = [run_once(args, lazy) for _ in range(args.runs)]
+
+    cum = statistics.median(r["main_cum_ms"] for r in runs)
+    summary = {
+        "runs": args.runs,
+        "cold": args.cold,
+        "main_cum_ms": round(cum, 1),
+        "main_self_ms": round(statistics.median(r["main_self_ms"] for r in runs), 1),
+        "import_wall_ms": round(statistics.median(r["import_ms"] for r in runs), 1),
+        "warmup_ms": None if args.no_warmup else round(statistics.median(r["warmup_ms"] for r in runs), 1),
+        "lazy_loaded": sorted({m for r in runs for m in r["lazy_loaded"]}),
+        "data_dir_created": any(r["data_dir_created"] for r in runs),
+    }
+    # dettaglio per modulo: mediana del cumulativo di ogni figlio diretto di main
+    per_child = {}
+    for r in runs:
+        for name, self_us, cum_us in r["children"]:
+            per_child.setdefault(name, []).append(cum_us / 1000)
+    children = sorted(((n, statistics.median(v)) for n, v in per_child.items()), key=lambda kv: -kv[1])
+
+    if args.json:
+        print(json.dumps({**summary, "children_ms": dict(children)}, indent=2))
+    else:
+        print(f"python={sys.version.split()[0]} giri={args.runs} {'senza .pyc' if args.cold else 'con .pyc'}")
+        print(f"import main: {summary['main_cum_ms']:.1f} ms cumulativo (self {summary['main_self_ms']:.1f} ms, "
+              f"wall {summary['import_wall_ms']:.1f} ms)")
+        if summary["warmup_ms"] is not None:
+            print(f"warm_up():   {summary['warmup_ms']:.1f} ms")
+        print(f"\n{'modulo importato da main':<36}{'ms':>9}{'quota':>8}")
+        for name, ms in children[:args.top]:
+            print(f"{name:<36}{ms:>9.1f}{ms / cum:>8.0%}" if cum else f"{name:<36}{ms:>9.1f}")
+
+    if args.update_budget:
+        out = {
+            "python": sys.version.split()[0],
+            "budget_ms": round(cum * (1 + args.headroom), 1),
+            "measured_ms": round(cum, 1),
+            "lazy_modules": lazy,
+        }
+        with open(args.budget, "w", encoding="utf-8") as f:
+            json.dump(out, f, indent=2)
+            f.write("\n")
+        print(f"✅ Budget aggiornato: {args.budget} ({out['budget_ms']} ms)")
+        return
+
+    problems = []
+    if summary["lazy_loaded"]:
+        problems.append(f"moduli da caricare al primo uso importati da main: {', '.join(summary['lazy_loaded'])}")
+    if summary["data_dir_created"]:
+        problems.append("DATA_DIR creata durante l'import")
+    if budget.get("budget_ms") and not args.cold and cum > budget["budget_ms"]:
+        problems.append(f"import main {cum:.1f} ms oltre il budget di {budget['budget_ms']} ms")
+    if not budget:
+        print("ℹ️ Nessun budget: eseguire con --update-budget per crearlo")
+    if problems:
+        for p in problems:
+            print(f"❌ {p}")
+        sys.exit(1)
+    print(f"\n✅ Import entro il budget ({budget.get('budget_ms', '-')} ms), {', '.join(lazy)} caricati al primo uso")
+
+
+if __name__ == "__main__":
+    main_cli()
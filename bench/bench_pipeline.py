@@ -0,0 +1,242 @@
+"""
+Benchmark offline della pipeline search → parse → filter → render, in replay
+delle risposte searchItems/getItems registrate in bench/fixtures (nessuna rete).
+
+Stage misurati (latenza per operazione, p50/p95/p99, e throughput):
+    parse          extract_from_item su una pagina di item
+    filter         filter_deals(ranked=True) su una pagina già parsata
+    scan_first     _first_valid_item_for_keyword con le pagine in replay
+    scan_fallback  come sopra, ma con i validi della ricerca già pubblicati (→ fallback GetItems)
+    render         render_card di una card
+    encode         encode_card nel formato CARD_FORMAT
+
+Uso:
+    python bench/bench_pipeline.py                       # confronta con bench/baseline.json
+    python bench/bench_pipeline.py --update-baseline     # riscrive la baseline
+    python bench/bench_pipeline.py --fixture altra.json --iterations 500
+    python bench/bench_pipeline.py --threshold p95=0.5
+
+Le fixture search_*.json sono le pagine della ricerca in ordine di nome,
+getitems_*.json le risposte GetItems. Esce con codice 1 se uno stage peggiora
+oltre le soglie rispetto alla baseline (p50/p95 più alti, throughput più basso).
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+from bench_common import ROOT, percentile, prepare_main_env
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+os.chdir(ROOT)  # FONT_PATH/LOGO_PATH/BADGE_PATH sono relativi alla root
+prepare_main_env()
+# replay puro: niente cache searchItems né cache negativa, pagine in sequenza, niente coda di arricchimento
+os.environ["SEARCH_CACHE_TTL"] = "0"
+os.environ["PAGES_CONCURRENCY"] = "1"
+os.environ["ENRICH_ENABLED"] = "0"
+os.environ["NEG_CACHE_TTL_PRICE"] = "0"
+os.environ["NEG_CACHE_TTL_STRUCTURAL"] = "0"
+
+import main  # noqa: E402
+from bench_card_encode import synthetic_tile  # noqa: E402
+
+FIXTURES_DIR = os.path.join(BENCH_DIR, "fixtures")
+BASELINE_FILE = os.path.join(BENCH_DIR, "baseline.json")
+DEFAULT_THRESHOLDS = {"p50": 0.25, "p95": 0.40, "throughput": 0.25}
+STAGES = ["parse", "filter", "scan_first", "scan_fallback", "render", "encode"]
+
+
+def load_items(path):
+    with open(path, "r", encoding="utf-8") as f:
+        j = json.load(f)
+    return main.safe_get(j, "searchResult", "items", default=None) or j.get("items", []) or []
+
+
+def load_fixtures(extra):
+    search = sorted(glob.glob(os.path.join(FIXTURES_DIR, "search_*.json")))
+    getitems = sorted(glob.glob(os.path.join(FIXTURES_DIR, "getitems_*.json")))
+    for path in extra:
+        (getitems if os.path.basename(path).startswith("getitems") else search).append(path)
+    pages = [load_items(p) for p in search]
+    pages = [p for p in pages if p]
+    by_asin = {}
+    for path in getitems:
+        for item in load_items(path):
+            if item.get("asin"):
+                by_asin[item["asin"]] = item
+    return pages, by_asin
+
+
+def install_replay(pages, getitems_by_asin):
+    """Sostituisce le chiamate Creators con il replay delle fixture."""
+    main.PAGES = len(pages)
+
+    def search_items(kw, page):
+        return {"searchResult": {"items": pages[page - 1]}}, list(main.SEARCH_RES_LEVELS[0])
+
+    def get_items(asins):
+        return {"items": [getitems_by_asin[a] for a in asins if a in getitems_by_asin]}, list(main.GET_RES_LEVELS[0])
+
+    main.creators_search_items = search_items
+    main.creators_get_items = get_items
+
+
+def measure(fn, args_list, iterations, warmup=3):
+    for a in args_list[:warmup]:
+        fn(a)
+    samples = []
+    total = 0.0
+    for i in range(iterations):
+        a = args_list[i % len(args_list)]
+        t0 = time.perf_counter()
+        fn(a)
+        dt = time.perf_counter() - t0
+        samples.append(dt)
+        total += dt
+    samples.sort()
+    return {
+        "ops": iterations,
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p95_ms": percentile(samples, 95) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+        "throughput": iterations / total if total else 0.0,
+    }
+
+
+def card_inputs(parsed_pages, n, seed):
+    rng = random.Random(seed)
+    payloads = [main._deal_payload(p) for page in parsed_pages for p in page if main._reject_reason(p) is None]
+    if not payloads:
+        sys.exit("Nessuna offerta valida nelle fixture: impossibile misurare il render")
+    return [(payloads[i % len(payloads)], synthetic_tile(rng)) for i in range(n)]
+
+
+def run(args):
+    pages, getitems_by_asin = load_fixtures(args.fixture)
+    if not pages:
+        sys.exit(f"Nessuna pagina search_*.json in {FIXTURES_DIR}")
+    install_replay(pages, getitems_by_asin)
+
+    parsed_pages = [[main.extract_from_item(item) for item in page] for page in pages]
+    accepted = {p["asin"] for page in parsed_pages for p in page if main._reject_reason(p) is None}
+    # il replay deve percorrere davvero entrambi i rami, altrimenti i tempi non dicono nulla
+    if not main._first_valid_item_for_keyword("replay", set()):
+        sys.exit("Il replay delle pagine non trova offerte: fixture da rivedere")
+    if getitems_by_asin and not main._first_valid_item_for_keyword("replay", accepted):
+        sys.exit("Il replay del fallback GetItems non trova offerte: fixture da rivedere")
+    cards = card_inputs(parsed_pages, min(args.iterations, 16), args.seed)
+    rendered = [
+        main.render_card(p["title"], p["price_new"], p["price_old"], p["discount"], tile, p["minimo"])
+        for p, tile in cards
+    ]
+
+    it = args.iterations
+    render_it = max(1, it // args.render_divisor)
+    results = {
+        "parse": measure(lambda page: [main.extract_from_item(item) for item in page], pages, it),
+        "filter": measure(lambda parsed: main.filter_deals(parsed, ranked=True), parsed_pages, it),
+        "scan_first": measure(lambda kw: main._first_valid_item_for_keyword(kw, set()), ["replay"], it),
+        "scan_fallback": measure(lambda kw: main._first_valid_item_for_keyword(kw, accepted), ["replay"], it),
+        "render": measure(
+            lambda c: main.render_card(c[0]["title"], c[0]["price_new"], c[0]["price_old"], c[0]["discount"], c[1], c[0]["minimo"]),
+            cards, render_it, warmup=1,
+        ),
+        "encode": measure(lambda img: main.encode_card(img), rendered, render_it, warmup=1),
+    }
+    items_per_page = sum(len(p) for p in pages) / len(pages)
+    results["parse"]["items_per_s"] = results["parse"]["throughput"] * items_per_page
+    results["filter"]["items_per_s"] = results["filter"]["throughput"] * items_per_page
+    return results, len(pages), len(getitems_by_asin)
+
+
+def compare(results, baseline, thresholds):
+    """Righe (stage, metrica, baseline, attuale, variazione) oltre soglia."""
+    regressions = []
+    for stage, cur in results.items():
+        base = baseline.get("stages", {}).get(stage)
+        if not base:
+            continue
+        for metric in ("p50", "p95"):
+            b, c = base[f"{metric}_ms"], cur[f"{metric}_ms"]
+            if b > 0 and (c - b) / b > thresholds[metric]:
+                regressions.append((stage, f"{metric}_ms", b, c, (c - b) / b))
+        b, c = base["throughput"], cur["throughput"]
+        if b > 0 and (b - c) / b > thresholds["throughput"]:
+            regressions.append((stage, "throughput", b, c, (c - b) / b))
+    return regressions
+
+
+def main_cli():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--fixture", action="append", default=[], help="fixture aggiuntiva (search_* o getitems_*)")
+    ap.add_argument("--iterations", type=int, default=300)
+    ap.add_argument("--render-divisor", type=int, default=10, help="render/encode fanno iterations/N giri")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--baseline", default=BASELINE_FILE)
+    ap.add_argument("--update-baseline", action="store_true")
+    ap.add_argument("--threshold", action="append", default=[], metavar="METRICA=FRAZIONE",
+                    help="es. p95=0.5 (default da baseline.json, poi %s)" % DEFAULT_THRESHOLDS)
+    ap.add_argument("--json", action="store_true", help="stampa i risultati in JSON")
+    args = ap.parse_args()
+
+    results, n_pages, n_getitems = run(args)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"pagine={n_pages} getitems={n_getitems} numpy={'si' if main.get_numpy() is not None else 'no'} "
+              f"formato={main.CARD_FORMAT} python={platform.python_version()}")
+        print(f"{'stage':<16}{'ops':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'op/s':>12}{'item/s':>12}")
+        for stage in STAGES:
+            r = results[stage]
+            item_s = f"{r['items_per_s']:,.0f}" if "items_per_s" in r else "-"
+            print(f"{stage:<16}{r['ops']:>6}{r['p50_ms']:>10.3f}{r['p95_ms']:>10.3f}{r['p99_ms']:>10.3f}"
+                  f"{r['throughput']:>12,.0f}{item_s:>12}")
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    thresholds.update(baseline.get("thresholds", {}))
+    for spec in args.threshold:
+        metric, _, value = spec.partition("=")
+        if metric not in DEFAULT_THRESHOLDS:
+            sys.exit(f"Soglia sconosciuta: {metric}")
+        thresholds[metric] = float(value)
+
+    if args.update_baseline:
+        out = {
+            "machine": {"python": platform.python_version(), "platform": platform.platform(), "numpy": main.get_numpy() is not None},
+            "card_format": main.CARD_FORMAT,
+            "iterations": args.iterations,
+            "thresholds": thresholds,
+            "stages": {s: {k: round(v, 4) for k, v in results[s].items()} for s in STAGES},
+        }
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(out, f, indent=2)
+            f.write("\n")
+        print(f"✅ Baseline aggiornata: {args.baseline}")
+        return
+
+    if not baseline:
+        print("ℹ️ Nessuna baseline: eseguire con --update-baseline per crearla")
+        return
+
+    regressions = compare(results, baseline, thresholds)
+    if not regressions:
+        print(f"✅ Nessuna regressione rispetto alla baseline (soglie {thresholds})")
+        return
+    print("❌ Regressioni rispetto alla baseline:")
+    for stage, metric, b, c, delta in regressions:
+        print(f"   {stage:<16}{metric:<12}{b:>12.3f} → {c:<12.3f}({delta:+.0%})")
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
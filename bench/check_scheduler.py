@@ -0,0 +1,77 @@
+"""
+Controlli con assert dello scheduler su orologio finto (stesso FakeClock di
+sim_scheduler.py): slot in ora locale nelle settimane del cambio d'ora e
+politiche di recupero skip/once dopo una sospensione. Esce con errore al primo
+controllo fallito.
+
+Uso:
+    python bench/check_scheduler.py
+"""
+import os
+import sys
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# sim_scheduler prepara l'ambiente (DATA_DIR temporanea) e importa main
+from sim_scheduler import local, main, parse_local, simulate  # noqa: E402
+
+# configurazione di riferimento, indipendente dall'ambiente
+main.SCHEDULE_TZ = main.ZoneInfo("Europe/Rome")
+main.POST_WINDOW_START, main.POST_WINDOW_END = 9, 21
+main.POST_INTERVAL_MINUTES = 14
+main.POST_JITTER_SECONDS = 0
+main.RESET_WEEKDAY, main.RESET_TIME = 0, "06:59"
+main.SCHEDULE_GRACE_SECONDS = 120
+
+SLOTS_PER_DAY = 52  # 09:00, 09:14, ..., 20:54
+
+
+def runs_on(runs, day):
+    return [t for t in runs if local(t).strftime("%Y-%m-%d") == day]
+
+
+def check_dst_week(start, before, after, utc_hours):
+    """Stessa griglia locale prima e dopo il cambio d'ora; cambia solo l'ora UTC del primo invio."""
+    runs, _ = simulate(parse_local(start), 3, 0, [], "skip", seed=1)
+    for day, utc_hour in zip((before, after), utc_hours):
+        posts = runs_on(runs["invia_offerta"], day)
+        assert len(posts) == SLOTS_PER_DAY, f"{day}: {len(posts)} invii, attesi {SLOTS_PER_DAY}"
+        assert local(posts[0]).strftime("%H:%M:%S") == "09:00:00", f"{day}: primo invio {local(posts[0])}"
+        assert local(posts[-1]).strftime("%H:%M:%S") == "20:54:00", f"{day}: ultimo invio {local(posts[-1])}"
+        assert all(b - a == 14 * 60 for a, b in zip(posts, posts[1:])), f"{day}: passo diverso da 14 minuti"
+        first_utc = datetime.fromtimestamp(posts[0], timezone.utc).hour
+        assert first_utc == utc_hour, f"{day}: primo invio alle {first_utc} UTC, atteso {utc_hour}"
+    print(f"✅ {before} → {after}: griglia locale invariata, primo invio {utc_hours[0]}→{utc_hours[1]} UTC")
+
+
+def check_reset():
+    runs, _ = simulate(parse_local("2026-03-26"), 7, 0, [], "skip", seed=1)
+    resets = [local(t).strftime("%a %Y-%m-%d %H:%M:%S") for t in runs["resetta_pubblicati"]]
+    assert resets == ["Mon 2026-03-30 06:59:00"], resets
+    print("✅ reset settimanale: lunedì 06:59 locale, una volta")
+
+
+def check_catchup(policy, expected_recoveries):
+    """Sospensione 10:05-11:35: i 7 slot 10:10..11:34 sono persi; skip non recupera, once uno solo al risveglio."""
+    day = "2026-03-30"
+    suspend = (parse_local(f"{day}T10:05"), 5400)
+    runs, _ = simulate(parse_local(day), 1, 0, [suspend], policy, seed=1)
+    posts = runs_on(runs["invia_offerta"], day)
+    gap = [local(t).strftime("%H:%M:%S") for t in posts
+           if parse_local(f"{day}T10:05") < t < parse_local(f"{day}T11:48")]
+    assert gap == expected_recoveries, f"{policy}: invii nella sospensione {gap}, attesi {expected_recoveries}"
+    assert len(posts) == SLOTS_PER_DAY - 7 + len(expected_recoveries), f"{policy}: {len(posts)} invii"
+    assert parse_local(f"{day}T11:48") in posts, f"{policy}: la griglia non riprende alle 11:48"
+    print(f"✅ catchup={policy}: recuperi {expected_recoveries or 'nessuno'}, poi griglia dalle 11:48")
+
+
+def main_cli():
+    check_dst_week("2026-03-28", "2026-03-28", "2026-03-29", (8, 7))
+    check_dst_week("2026-10-24", "2026-10-24", "2026-10-25", (7, 8))
+    check_reset()
+    check_catchup("skip", [])
+    check_catchup("once", ["11:35:00"])
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,270 @@
+"""
+Load driver end-to-end: martella /run dell'app e il percorso dello scheduler
+(run_cycle in-process) contro gli stub locali, poi riporta throughput,
+latenze di coda e post duplicati (stessa coppia chat/ASIN inviata più volte).
+
+/run ritorna subito un job: "http /run" misura l'accodamento (esiti queued o
+coalesced, cioè agganciato a un ciclo già in corso), "http job" il tempo fino
+all'esito letto da /run/<id>.
+
+Tutto in locale, stub e app avviati dal driver:
+    python bench/load_driver.py --start-stubs --start-app 5055 \\
+        --http-workers 8 --requests 200 --scheduler-workers 2 --scheduler-ticks 20
+
+Contro un'app e degli stub già avviati (stesso DATA_DIR per app e driver se si
+usa anche --scheduler-workers):
+    python bench/stub_servers.py --port 8765 --rate-429 0.05 &
+    python bench/load_driver.py --stubs http://127.0.0.1:8765 --target http://127.0.0.1:10000 --duration 60
+
+Le opzioni degli stub (--latency-ms, --rate-429, --reject-resource, ...) valgono
+anche qui con --start-stubs. Esce con codice 1 se ci sono post duplicati.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # FONT_PATH/LOGO_PATH/BADGE_PATH sono relativi alla root
+
+from bench_common import percentile  # noqa: E402
+import stub_servers  # noqa: E402
+
+
+class Recorder:
+    """Latenze ed esiti per sorgente di carico."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.outcomes = {}
+        self.first_error = {}  # esito -> primo messaggio, per capire cosa è andato storto
+
+    def add(self, source, seconds, outcome, error=None):
+        with self.lock:
+            self.samples.setdefault(source, []).append(seconds)
+            self.outcomes.setdefault(source, Counter())[outcome] += 1
+            if error and outcome not in self.first_error:
+                self.first_error[outcome] = str(error)[:300]
+
+
+def stub_env(base):
+    """Variabili d'ambiente che puntano il bot sugli stub (credenziali finte)."""
+    env = {
+        "CREATORS_TOKEN_URL": f"{base}/oauth2/token",
+        "CREATORS_API_BASE": f"{base}/catalog/v1",
+        "TELEGRAM_API_BASE": f"{base}/bot",
+    }
+    defaults = {
+        "AMAZON_ASSOCIATE_TAG": "stub-21",
+        "CREATORS_MARKETPLACE": "www.amazon.it",
+        "CREATORS_CREDENTIAL_ID": "stub-id",
+        "CREATORS_CREDENTIAL_SECRET": "stub-secret",
+        "CREATORS_CREDENTIAL_VERSION": "2.2",
+        "TELEGRAM_BOT_TOKEN": "123456:LOADTEST",
+        "TELEGRAM_CHAT_ID": "-1001000000001",
+    }
+    for k, v in defaults.items():
+        if not os.environ.get(k):
+            env[k] = v
+    return env
+
+
+def http_json(url, method="GET", timeout=10):
+    req = urllib.request.Request(url, method=method, data=b"" if method == "POST" else None)
+    with urllib.request.urlopen(req, timeout=timeout) as r:
+        return json.loads(r.read() or b"{}")
+
+
+def wait_for(url, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=2):
+                return True
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.3)
+    return False
+
+
+def start_app(port, env):
+    """App Flask in un processo figlio (server werkzeug multi-thread)."""
+    code = (
+        "import app; from werkzeug.serving import run_simple; "
+        f"run_simple('127.0.0.1', {port}, app.app, threaded=True)"
+    )
+    proc = subprocess.Popen([sys.executable, "-c", code], cwd=ROOT, env={**os.environ, **env})
+    if not wait_for(f"http://127.0.0.1:{port}/health", 60):
+        proc.terminate()
+        sys.exit("L'app non risponde su /health")
+    return proc
+
+
+def wait_job(target, job, timeout, poll=0.2):
+    """Esito finale del job (posted, miss, error) interrogando /run/<id>."""
+    deadline = time.time() + timeout
+    while job["status"] == "running":
+        if time.time() >= deadline:
+            return "job_timeout", None
+        time.sleep(poll)
+        job = http_json(f"{target}/run/{job['id']}")
+    if job["status"] == "error":
+        return "error", job.get("error")
+    return ("posted" if job["posted"] else "miss"), None
+
+
+def http_worker(target, rec, stop_at, budget, timeout):
+    while time.time() < stop_at and budget():
+        t0 = time.perf_counter()
+        error = None
+        job = None
+        try:
+            job = http_json(f"{target}/run", method="POST", timeout=timeout)
+            outcome = "coalesced" if job["coalesced"] else "queued"
+        except urllib.error.HTTPError as e:
+            outcome = f"http_{e.code}"
+            error = e.read().decode("utf-8", "replace")[-300:]
+        except (urllib.error.URLError, OSError) as e:
+            outcome = "conn_error"
+            error = e
+        rec.add("http /run", time.perf_counter() - t0, outcome, error)
+        if job is None:
+            continue
+        try:
+            outcome, error = wait_job(target, job, timeout)
+        except (urllib.error.URLError, OSError) as e:
+            outcome, error = "conn_error", e
+        rec.add("http job", time.perf_counter() - t0, outcome, error)
+
+
+def scheduler_worker(main, rec, ticks, stop_at):
+    for _ in range(ticks):
+        if time.time() >= stop_at:
+            return
+        t0 = time.perf_counter()
+        error = None
+        try:
+            outcome = "posted" if main.run_cycle("scheduler") else "miss"
+        except Exception as e:
+            outcome = f"error:{type(e).__name__}"
+            error = e
+        rec.add("scheduler", time.perf_counter() - t0, outcome, error)
+
+
+def report(rec, wall):
+    print(f"\n{'sorgente':<14}{'n':>6}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}  esiti")
+    for source, samples in sorted(rec.samples.items()):
+        s = sorted(samples)
+        outcomes = ", ".join(f"{k}={v}" for k, v in rec.outcomes[source].most_common())
+        print(
+            f"{source:<14}{len(s):>6}{len(s) / wall:>9.2f}{percentile(s, 50) * 1000:>10.0f}"
+            f"{percentile(s, 95) * 1000:>10.0f}{percentile(s, 99) * 1000:>10.0f}{s[-1] * 1000:>10.0f}  {outcomes}"
+        )
+    for outcome, msg in rec.first_error.items():
+        print(f"   ⚠️ {outcome}: {msg}")
+
+
+def main_cli():
+    ap = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter,
+        parents=[stub_servers.build_parser()], conflict_handler="resolve", add_help=False,
+    )
+    ap.add_argument("-h", "--help", action="help")
+    ap.add_argument("--port", type=int, default=0, help="porta degli stub con --start-stubs (0 = libera)")
+    ap.add_argument("--start-stubs", action="store_true", help="avvia gli stub in questo processo")
+    ap.add_argument("--stubs", default="", help="URL di stub già avviati (per /stats)")
+    ap.add_argument("--start-app", type=int, default=0, metavar="PORT", help="avvia l'app su questa porta")
+    ap.add_argument("--target", default="", help="URL base dell'app (default: quella avviata)")
+    ap.add_argument("--http-workers", type=int, default=4)
+    ap.add_argument("--requests", type=int, default=100, help="totale richieste /run (0 = solo --duration)")
+    ap.add_argument("--duration", type=float, default=300, help="tetto in secondi")
+    ap.add_argument("--request-timeout", type=float, default=180)
+    ap.add_argument("--scheduler-workers", type=int, default=0, help="thread che eseguono run_cycle in-process")
+    ap.add_argument("--scheduler-ticks", type=int, default=10, help="tick per thread scheduler")
+    args = ap.parse_args()
+
+    stubs_url = args.stubs.rstrip("/")
+    if args.start_stubs:
+        _, stubs_url = stub_servers.start_in_thread(args)
+        print(f"✅ Stub su {stubs_url}")
+    if not stubs_url:
+        sys.exit("Servono --start-stubs oppure --stubs URL")
+
+    env = stub_env(stubs_url) if args.start_stubs else {}
+    if not os.environ.get("DATA_DIR"):
+        env["DATA_DIR"] = tempfile.mkdtemp(prefix="load_")
+    os.environ.update(env)
+
+    app_proc = None
+    target = args.target.rstrip("/")
+    if args.start_app:
+        app_proc = start_app(args.start_app, env)
+        target = target or f"http://127.0.0.1:{args.start_app}"
+
+    main = None
+    if args.scheduler_workers:
+        import main  # noqa: F811 (dopo aver impostato l'env degli stub)
+
+    http_json(f"{stubs_url}/reset", method="POST")
+    rec = Recorder()
+    sent = Counter()
+    sent_lock = threading.Lock()
+
+    def budget():
+        if not args.requests:
+            return True
+        with sent_lock:
+            if sent["n"] >= args.requests:
+                return False
+            sent["n"] += 1
+            return True
+
+    stop_at = time.time() + args.duration
+    threads = []
+    if target:
+        threads += [
+            threading.Thread(target=http_worker, args=(target, rec, stop_at, budget, args.request_timeout), daemon=True)
+            for _ in range(args.http_workers)
+        ]
+    if main is not None:
+        threads += [
+            threading.Thread(target=scheduler_worker, args=(main, rec, args.scheduler_ticks, stop_at), daemon=True)
+            for _ in range(args.scheduler_workers)
+        ]
+    if not threads:
+        sys.exit("Niente da eseguire: servono --target/--start-app e/o --scheduler-workers")
+
+    t0 = time.time()
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        wall = time.time() - t0
+        stats = http_json(f"{stubs_url}/stats")
+        if app_proc is not None:
+            app_proc.terminate()
+            app_proc.wait(10)
+
+    report(rec, wall)
+    creators = {k: v for k, v in stats["statuses"].items() if k.split()[0] in ("searchItems", "getItems", "token")}
+    print(f"\nstub: {json.dumps(creators)}")
+    print(f"telegram: post={stats['posts']} unici={stats['unique_posts']} duplicati={stats['duplicate_posts']}")
+    if stats["duplicate_posts"]:
+        for key, n in sorted(stats["duplicates"].items(), key=lambda kv: -kv[1])[:10]:
+            print(f"   ❌ {key} inviato {n} volte")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
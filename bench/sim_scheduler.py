@@ -0,0 +1,144 @@
+"""
+Simulazione dello scheduler su orologio finto: nessuna attesa reale, nessun invio.
+Verifica che gli invii cadano solo in fascia (ora locale SCHEDULE_TZ, anche nelle
+settimane del cambio d'ora), che il reset parta il giorno/ora configurati e come
+si comportano jitter, job lunghi e sospensioni con le due politiche di recupero.
+
+Uso:
+    python bench/sim_scheduler.py                                   # settimane DST 2026
+    python bench/sim_scheduler.py --start 2026-10-22 --days 7 --job-seconds 900
+    python bench/sim_scheduler.py --suspend 2026-03-30T10:05=5400 --catchup once
+    POST_JITTER_SECONDS=90 python bench/sim_scheduler.py
+
+--suspend TS=SECONDI (ripetibile, TS ora locale) congela il processo per SECONDI a
+partire da TS: il risveglio arriva in ritardo, come dopo uno sleep del container.
+"""
+import argparse
+import os
+import random
+import sys
+from collections import Counter
+from datetime import datetime, timedelta
+
+from bench_common import prepare_main_env
+
+prepare_main_env()
+
+import main  # noqa: E402
+
+
+class FakeClock:
+    """Orologio finto: sleep avanza il tempo; le sospensioni allungano il primo sleep che le attraversa."""
+
+    def __init__(self, start, suspensions=()):
+        self.t = start
+        self.suspensions = sorted(suspensions)
+
+    def time(self):
+        return self.t
+
+    def sleep(self, seconds):
+        target = self.t + seconds
+        while self.suspensions and self.suspensions[0][0] <= target:
+            at, length = self.suspensions.pop(0)
+            target = max(target, at + length)
+        self.t = target
+
+
+def local(epoch):
+    return datetime.fromtimestamp(epoch, main.SCHEDULE_TZ)
+
+
+def parse_local(value):
+    return datetime.fromisoformat(value).replace(tzinfo=main.SCHEDULE_TZ).timestamp()
+
+
+def simulate(start, days, job_seconds, suspensions, catchup, seed):
+    clock = FakeClock(start, suspensions)
+    runs = {"invia_offerta": [], "resetta_pubblicati": []}
+
+    def post_job():
+        runs["invia_offerta"].append(clock.time())
+        clock.t += job_seconds
+
+    def reset_job():
+        runs["resetta_pubblicati"].append(clock.time())
+
+    main.SCHEDULE_CATCHUP = catchup
+    sched = main.build_scheduler(now=clock.time, sleep=clock.sleep, post_job=post_job,
+                                 reset_job=reset_job, rng=random.Random(seed))
+    wakeups = Counter()
+    real_sleep = clock.sleep
+
+    def counting_sleep(seconds):
+        wakeups["n"] += 1
+        real_sleep(seconds)
+
+    sched._sleep = counting_sleep
+    sched.run_until(start + days * 86400)
+    return runs, wakeups["n"]
+
+
+def check(runs, start, days):
+    problems = []
+    for t in runs["invia_offerta"]:
+        lt = local(t)
+        if not (main.POST_WINDOW_START <= lt.hour < main.POST_WINDOW_END):
+            problems.append(f"invio fuori fascia: {lt:%a %d/%m %H:%M:%S %Z}")
+    hh, mm = (int(x) for x in main.RESET_TIME.split(":"))
+    for t in runs["resetta_pubblicati"]:
+        lt = local(t)
+        if lt.weekday() != main.RESET_WEEKDAY or (lt.hour, lt.minute) < (hh, mm):
+            problems.append(f"reset fuori orario: {lt:%a %d/%m %H:%M:%S %Z}")
+    expected_resets = sum(
+        1 for d in range(days + 1)
+        if (local(start).date() + timedelta(days=d)).weekday() == main.RESET_WEEKDAY
+        and start <= main._local_day_at(local(start).date() + timedelta(days=d), hh, mm) < start + days * 86400
+    )
+    if len(runs["resetta_pubblicati"]) != expected_resets:
+        problems.append(f"reset eseguiti {len(runs['resetta_pubblicati'])}, attesi {expected_resets}")
+    return problems
+
+
+def main_cli():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--start", action="append", default=[], help="data locale di inizio (ripetibile)")
+    ap.add_argument("--days", type=int, default=7)
+    ap.add_argument("--job-seconds", type=float, default=30, help="durata simulata di invia_offerta")
+    ap.add_argument("--suspend", action="append", default=[], metavar="TS=SECONDI")
+    ap.add_argument("--catchup", default=main.SCHEDULE_CATCHUP, choices=["skip", "once"])
+    ap.add_argument("--seed", type=int, default=7)
+    args = ap.parse_args()
+
+    # default: le due settimane del cambio d'ora 2026 (29 marzo e 25 ottobre)
+    starts = args.start or ["2026-03-26", "2026-10-22"]
+    suspensions = []
+    for spec in args.suspend:
+        ts, _, length = spec.partition("=")
+        suspensions.append((parse_local(ts), float(length)))
+
+    failed = False
+    for s in starts:
+        start = parse_local(s)
+        runs, wakeups = simulate(start, args.days, args.job_seconds, suspensions, args.catchup, args.seed)
+        per_day = Counter(local(t).strftime("%a %d/%m %Z") for t in runs["invia_offerta"])
+        print(f"\n{s} +{args.days}g  fuso={main.SCHEDULE_TZ.key} catchup={args.catchup} "
+              f"jitter={main.POST_JITTER_SECONDS:.0f}s risvegli={wakeups}")
+        for day, n in per_day.items():
+            first = min(t for t in runs["invia_offerta"] if local(t).strftime("%a %d/%m %Z") == day)
+            last = max(t for t in runs["invia_offerta"] if local(t).strftime("%a %d/%m %Z") == day)
+            print(f"   {day:<18} invii={n:<4} primo={local(first):%H:%M:%S} ultimo={local(last):%H:%M:%S}")
+        for t in runs["resetta_pubblicati"]:
+            print(f"   reset               {local(t):%a %d/%m %H:%M:%S %Z}")
+        problems = check(runs, start, args.days)
+        for p in problems:
+            print(f"   ❌ {p}")
+        failed = failed or bool(problems)
+
+    if failed:
+        sys.exit(1)
+    print("\n✅ Tutti gli invii in fascia, reset puntuali")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,358 @@
+"""
+Stub locali di Cognito (token OAuth), Creators API (searchItems/getItems) e
+Telegram Bot API, per i load test end-to-end senza rete. Un solo processo,
+un solo porto, solo libreria standard (+ PIL per le immagini prodotto).
+
+Rotte:
+    POST /oauth2/token               token client_credentials (scadenza --token-ttl)
+    POST /catalog/v1/searchItems     item deterministici per (keywords, itemPage)
+    POST /catalog/v1/getItems        item per itemIds, con tutte le resources
+    GET  /img/<asin>.jpg             foto prodotto (ETag, risponde 304)
+    POST /bot<token>/sendPhoto       registra (chat, asin) e risponde con un Message
+    POST /bot<token>/getMe
+    GET  /stats                      contatori, post e duplicati (JSON)
+    POST /reset                      azzera i contatori
+
+Uso:
+    python bench/stub_servers.py --port 8765 --latency-ms 120 --jitter-ms 80 \\
+        --rate-429 0.05 --rate-5xx 0.02 --reject-resource offersV2.listings.savings
+
+Il bot va puntato sugli stub con:
+    CREATORS_TOKEN_URL=http://127.0.0.1:8765/oauth2/token
+    CREATORS_API_BASE=http://127.0.0.1:8765/catalog/v1
+    TELEGRAM_API_BASE=http://127.0.0.1:8765/bot
+"""
+import argparse
+import email.parser
+import email.policy
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, urlsplit
+
+ASIN_RE = re.compile(r"/dp/([A-Z0-9]{10})")
+VALIDATION_ERROR = (
+    "1 validation error detected: Value '{value}' at 'resources' failed to satisfy constraint: "
+    "Member must satisfy enum value set"
+)
+
+
+class StubState:
+    """Configurazione e contatori condivisi tra le richieste."""
+
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.rng = random.Random(args.seed)
+        self.msg_ids = itertools.count(1)
+        self.image = self._make_image()
+        self.image_etag = '"' + hashlib.sha1(self.image).hexdigest()[:16] + '"'
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = Counter()
+            self.statuses = Counter()
+            self.posts = Counter()  # (chat, asin) -> invii
+            self.started = time.time()
+
+    def _make_image(self):
+        try:
+            from PIL import Image, ImageDraw
+        except ImportError:
+            return b""
+        img = Image.new("RGB", (500, 500), (235, 235, 235))
+        draw = ImageDraw.Draw(img)
+        draw.rectangle((100, 100, 400, 400), fill=(40, 110, 200))
+        draw.ellipse((180, 180, 320, 320), fill=(250, 200, 30))
+        out = BytesIO()
+        img.save(out, format="JPEG", quality=85)
+        return out.getvalue()
+
+    def chance(self, p):
+        with self.lock:
+            return p > 0 and self.rng.random() < p
+
+    def sleep(self, latency_ms, jitter_ms):
+        with self.lock:
+            extra = self.rng.uniform(0, jitter_ms) if jitter_ms > 0 else 0
+        if latency_ms + extra > 0:
+            time.sleep((latency_ms + extra) / 1000)
+
+    def count(self, route, status):
+        with self.lock:
+            self.requests[route] += 1
+            self.statuses[f"{route} {status}"] += 1
+
+    def record_post(self, chat, asin):
+        with self.lock:
+            self.posts[(str(chat), asin or "?")] += 1
+
+    def stats(self):
+        with self.lock:
+            duplicates = {f"{c}|{a}": n for (c, a), n in self.posts.items() if n > 1}
+            return {
+                "uptime_s": round(time.time() - self.started, 1),
+                "requests": dict(self.requests),
+                "statuses": dict(self.statuses),
+                "posts": sum(self.posts.values()),
+                "unique_posts": len(self.posts),
+                "duplicate_posts": sum(n - 1 for n in duplicates.values()),
+                "duplicates": duplicates,
+            }
+
+
+def _money(amount):
+    return {"amount": amount, "currency": "EUR", "displayAmount": f"{amount:.2f} €".replace(".", ",")}
+
+
+def make_item(asin, seed, resources, base_url):
+    """Item Creators in una delle forme lette da extract_from_item, ridotto alle resources chieste."""
+    rng = random.Random(seed)
+    price = round(rng.uniform(10, 900), 2)
+    saving = round(price * rng.uniform(0.05, 0.55), 2)
+    shape = rng.randrange(4)
+    listing = {"price": {"money": _money(price)}}
+    if "offersV2.listings.savings" in resources:
+        if shape in (0, 1):
+            listing["savings"] = {"money": _money(saving), "percentage": int(saving / (price + saving) * 100)}
+        elif shape == 2:
+            listing["savingBasis"] = {"money": _money(round(price + saving, 2))}
+    if "offersV2.listings.dealDetails" in resources and shape == 3:
+        listing["dealDetails"] = [{"listPrice": _money(round(price + saving, 2)), "badge": "Offerta a tempo"}]
+
+    item = {
+        "asin": asin,
+        "detailPageURL": f"https://www.amazon.it/dp/{asin}?tag=stub-21",
+        "itemInfo": {"title": {"displayValue": f"Prodotto stub {asin}", "label": "Title", "locale": "it_IT"}},
+    }
+    if "images.primary.large" in resources:
+        item["images"] = {"primary": {"large": {"url": f"{base_url}/img/{asin}.jpg", "height": 500, "width": 500}}}
+    if "offersV2.listings.price" in resources:
+        item["offersV2"] = {"listings": [listing]}
+    return item
+
+
+def _asin_for(*parts):
+    return "B0" + hashlib.sha1("|".join(map(str, parts)).encode("utf-8")).hexdigest()[:8].upper()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    server_version = "StubServers/1.0"
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def log_message(self, fmt, *args):
+        if self.state.args.verbose:
+            super().log_message(fmt, *args)
+
+    def _body(self):
+        n = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(n) if n else b""
+
+    def _send(self, route, status, body=b"", content_type="application/json", headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+        elif isinstance(body, str):
+            body = body.encode("utf-8")
+        self.state.count(route, status)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    # ---------------- routing ----------------
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == "/stats":
+            return self._send("stats", 200, self.state.stats())
+        if path.startswith("/img/"):
+            return self._image()
+        return self._send("unknown", 404, {"message": "not found"})
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        body = self._body()
+        if path == "/reset":
+            self.state.reset()
+            return self._send("reset", 200, {"ok": True})
+        if path.endswith("/oauth2/token"):
+            return self._token()
+        if path.endswith("/searchItems") or path.endswith("/getItems"):
+            return self._catalog(path.rsplit("/", 1)[1], body)
+        m = re.match(r"^/bot[^/]+/(\w+)$", path)
+        if m:
+            return self._telegram(m.group(1), body)
+        return self._send("unknown", 404, {"message": "not found"})
+
+    # ---------------- Cognito ----------------
+    def _token(self):
+        a = self.state.args
+        self.state.sleep(a.token_latency_ms, 0)
+        if not (self.headers.get("Authorization") or "").startswith("Basic "):
+            return self._send("token", 401, {"error": "invalid_client"})
+        token = "stub-" + hashlib.sha1(str(time.time()).encode("utf-8")).hexdigest()[:20]
+        return self._send("token", 200, {"access_token": token, "expires_in": a.token_ttl, "token_type": "Bearer"})
+
+    # ---------------- Creators API ----------------
+    def _catalog(self, endpoint, body):
+        a = self.state.args
+        route = endpoint
+        self.state.sleep(a.latency_ms, a.jitter_ms)
+        if not (self.headers.get("Authorization") or "").startswith("Bearer "):
+            return self._send(route, 401, {"message": "Missing Authentication Token"})
+        if self.state.chance(a.rate_429):
+            return self._send(route, 429, {"message": "Too Many Requests"}, headers={"Retry-After": str(a.retry_after)})
+        if self.state.chance(a.rate_5xx):
+            return self._send(route, 503, {"message": "Service Unavailable"})
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            return self._send(route, 400, {"message": "invalid JSON"})
+
+        resources = payload.get("resources") or []
+        rejected = [r for r in resources if r in a.reject_resource]
+        if rejected:
+            return self._send(route, 400, {"message": VALIDATION_ERROR.format(value=rejected[0])})
+
+        base_url = f"http://{self.headers.get('Host') or '127.0.0.1'}"
+        if endpoint == "searchItems":
+            kw, page = payload.get("keywords", ""), int(payload.get("itemPage", 1))
+            n = int(payload.get("itemCount", 10))
+            items = [
+                make_item(_asin_for(kw, page, i), f"{kw}|{page}|{i}|{a.seed}", resources, base_url)
+                for i in range(n)
+            ]
+            return self._send(route, 200, {"searchResult": {"totalResultCount": n * 10, "items": items}})
+
+        items = [make_item(asin, f"{asin}|{a.seed}", resources, base_url) for asin in payload.get("itemIds", [])]
+        return self._send(route, 200, {"items": items})
+
+    def _image(self):
+        if self.headers.get("If-None-Match") == self.state.image_etag:
+            return self._send("image", 304, headers={"ETag": self.state.image_etag})
+        return self._send("image", 200, self.state.image, content_type="image/jpeg",
+                          headers={"ETag": self.state.image_etag, "Cache-Control": "max-age=3600"})
+
+    # ---------------- Telegram ----------------
+    def _telegram_fields(self, body):
+        ctype = self.headers.get("Content-Type") or ""
+        if ctype.startswith("multipart/"):
+            msg = email.parser.BytesParser(policy=email.policy.default).parsebytes(
+                b"Content-Type: " + ctype.encode("latin-1") + b"\r\n\r\n" + body
+            )
+            fields = {}
+            for part in msg.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                if part.get_filename():
+                    fields[name] = part.get_payload(decode=True)
+                else:
+                    fields[name] = part.get_content()
+            return fields
+        if ctype.startswith("application/json"):
+            return json.loads(body or b"{}")
+        return {k: v[0] for k, v in parse_qs(body.decode("utf-8")).items()}
+
+    def _telegram(self, method, body):
+        a = self.state.args
+        route = f"tg_{method}"
+        if method == "getMe":
+            return self._send(route, 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "stub", "username": "stub_bot"}})
+        if method != "sendPhoto":
+            return self._send(route, 200, {"ok": True, "result": True})
+
+        self.state.sleep(a.tg_latency_ms, a.tg_jitter_ms)
+        if self.state.chance(a.tg_rate_429):
+            return self._send(route, 429, {
+                "ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {a.retry_after}",
+                "parameters": {"retry_after": a.retry_after},
+            })
+
+        fields = self._telegram_fields(body)
+        chat_id = fields.get("chat_id")
+        caption = str(fields.get("caption") or "") + str(fields.get("reply_markup") or "")
+        m = ASIN_RE.search(caption)
+        self.state.record_post(chat_id, m.group(1) if m else None)
+
+        photo = fields.get("photo")
+        file_id = photo if isinstance(photo, str) else "stubfile-" + hashlib.sha1(photo or b"").hexdigest()[:24]
+        try:
+            chat_num = int(chat_id)
+        except (TypeError, ValueError):
+            chat_num = 0
+        return self._send(route, 200, {"ok": True, "result": {
+            "message_id": next(self.state.msg_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_num, "type": "channel", "title": "stub"},
+            "photo": [{"file_id": file_id, "file_unique_id": file_id[-12:], "width": 1080, "height": 1080}],
+            "caption": fields.get("caption") or "",
+        }})
+
+
+def build_parser():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--latency-ms", type=float, default=80, help="latenza base searchItems/getItems")
+    ap.add_argument("--jitter-ms", type=float, default=40)
+    ap.add_argument("--rate-429", type=float, default=0.0, help="frazione di risposte 429 (Creators)")
+    ap.add_argument("--rate-5xx", type=float, default=0.0, help="frazione di risposte 503 (Creators)")
+    ap.add_argument("--retry-after", type=int, default=1, help="secondi in Retry-After / retry_after")
+    ap.add_argument("--reject-resource", action="append", default=[],
+                    help="resource rifiutata con errore di validazione (ripetibile)")
+    ap.add_argument("--token-ttl", type=int, default=3600)
+    ap.add_argument("--token-latency-ms", type=float, default=50)
+    ap.add_argument("--tg-latency-ms", type=float, default=60)
+    ap.add_argument("--tg-jitter-ms", type=float, default=30)
+    ap.add_argument("--tg-rate-429", type=float, default=0.0, help="frazione di sendPhoto in flood limit")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--verbose", action="store_true")
+    return ap
+
+
+def make_server(args):
+    """Server degli stub e URL base (con --port 0 sceglie il sistema)."""
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    server.daemon_threads = True
+    server.state = StubState(args)
+    return server, f"http://{args.host}:{server.server_address[1]}"
+
+
+def start_in_thread(args):
+    """Avvia gli stub in un thread daemon; ritorna (server, base_url)."""
+    server, base = make_server(args)
+    threading.Thread(target=server.serve_forever, daemon=True, name="stubs").start()
+    return server, base
+
+
+def main_cli():
+    args = build_parser().parse_args()
+    server, base = make_server(args)
+    print(f"✅ Stub in ascolto su {base}")
+    print(f"   CREATORS_TOKEN_URL={base}/oauth2/token")
+    print(f"   CREATORS_API_BASE={base}/catalog/v1")
+    print(f"   TELEGRAM_API_BASE={base}/bot")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,18 +1,40 @@
 import os
 import time
 import json
+import math
+import heapq
+import mmap
+import random
+import struct
 import base64
+import cProfile
+import contextvars
+import tracemalloc
+import uuid
+import itertools
 import html
+import bisect
+import hashlib
+import sqlite3
+import tempfile
 import threading
+from contextlib import closing, contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from datetime import datetime, timedelta
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 from pathlib import Path
 from collections import Counter
+from urllib.parse import urlsplit
+from zoneinfo import ZoneInfo
 
 import requests
-import schedule
-from PIL import Image, ImageDraw, ImageFont
-from telegram import Bot, InlineKeyboardMarkup, InlineKeyboardButton
+from requests.adapters import HTTPAdapter
+
+# PIL, python-telegram-bot e numpy si importano al primo uso (render card, invio, filtro) e il
+# Bot si costruisce in get_bot(): l'import di main resta leggero e app.py risponde subito a
+# /health. warm_up() carica tutto in anticipo, in background.
 
 
 # ============================================================
@@ -40,11 +62,29 @@ CREATORS_API_BASE = os.environ.get("CREATORS_API_BASE", "https://creatorsapi.ama
 
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", "").strip()
 TELEGRAM_CHAT_ID = os.environ.get("TELEGRAM_CHAT_ID", "").strip()
+# Bot API alternativa (es. stub locale per i load test): "http://127.0.0.1:8765/bot", il token va in coda
+TELEGRAM_API_BASE = os.environ.get("TELEGRAM_API_BASE", "").strip()
+
+# Più canali/gruppi: "id1,id2,..." (se vuota si usa solo TELEGRAM_CHAT_ID).
+# La card si carica una volta sola, agli altri si manda il file_id in parallelo.
+TELEGRAM_CHAT_IDS = [
+    c.strip() for c in os.environ.get("TELEGRAM_CHAT_IDS", "").split(",") if c.strip()
+] or ([TELEGRAM_CHAT_ID] if TELEGRAM_CHAT_ID else [])
+TELEGRAM_FANOUT_WORKERS = int(os.environ.get("TELEGRAM_FANOUT_WORKERS", "4"))
+TELEGRAM_FLOOD_RETRIES = int(os.environ.get("TELEGRAM_FLOOD_RETRIES", "3"))
 
 FONT_PATH = os.environ.get("FONT_PATH", "Montserrat-VariableFont_wght.ttf").strip()
 LOGO_PATH = os.environ.get("LOGO_PATH", "header_clean2.png").strip()
 BADGE_PATH = os.environ.get("BADGE_PATH", "minimo storico flat.png").strip()
 
+# Formato della card inviata a Telegram: png (lossless), jpeg o webp
+CARD_FORMAT = os.environ.get("CARD_FORMAT", "png").strip().lower()
+CARD_PNG_COMPRESS = int(os.environ.get("CARD_PNG_COMPRESS", "6"))
+CARD_JPEG_QUALITY = int(os.environ.get("CARD_JPEG_QUALITY", "88"))
+CARD_JPEG_OPTIMIZE = os.environ.get("CARD_JPEG_OPTIMIZE", "1") == "1"
+CARD_WEBP_QUALITY = int(os.environ.get("CARD_WEBP_QUALITY", "85"))
+CARD_WEBP_METHOD = int(os.environ.get("CARD_WEBP_METHOD", "4"))
+
 # Filtri offerta
 MIN_DISCOUNT = int(os.environ.get("MIN_DISCOUNT", "15"))
 MIN_PRICE = float(os.environ.get("MIN_PRICE", "15"))
@@ -55,10 +95,113 @@ SEARCH_INDEX = os.environ.get("SEARCH_INDEX", "All").strip()
 ITEMS_PER_PAGE = int(os.environ.get("ITEMS_PER_PAGE", "8"))
 PAGES = int(os.environ.get("PAGES", "4"))
 
+# Pagine searchItems in parallelo (1 = sequenziale) e distanza minima tra due chiamate API
+PAGES_CONCURRENCY = int(os.environ.get("PAGES_CONCURRENCY", "1"))
+CREATORS_MIN_INTERVAL = float(os.environ.get("CREATORS_MIN_INTERVAL", "0.2"))
+
+# Quota Creators API: token bucket da CREATORS_TPS richieste/s (default 1/CREATORS_MIN_INTERVAL,
+# 0 = nessun limite) con burst CREATORS_BURST, e CREATORS_TPD richieste per giorno UTC (0 = nessun
+# limite). Un 429 dimezza il ritmo e blocca fino al Retry-After; i successi lo fanno risalire.
+# Se per un token servirebbe più di CREATORS_MAX_WAIT secondi la chiamata non parte.
+CREATORS_TPS = float(os.environ.get("CREATORS_TPS", str(1 / CREATORS_MIN_INTERVAL if CREATORS_MIN_INTERVAL > 0 else 0)))
+CREATORS_BURST = float(os.environ.get("CREATORS_BURST", "1"))
+CREATORS_TPD = int(os.environ.get("CREATORS_TPD", "8640"))
+CREATORS_MAX_WAIT = float(os.environ.get("CREATORS_MAX_WAIT", "10"))
+CREATORS_429_RETRIES = int(os.environ.get("CREATORS_429_RETRIES", "1"))
+
+# Circuit breaker: dopo BREAKER_FAILURES errori consecutivi (429, 5xx, rete) le chiamate
+# falliscono subito per BREAKER_OPEN_SECONDS; poi una sola chiamata di prova (half-open)
+# decide se richiudere. Ogni prova fallita raddoppia l'attesa fino a BREAKER_OPEN_MAX.
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", "5"))
+BREAKER_OPEN_SECONDS = float(os.environ.get("BREAKER_OPEN_SECONDS", "60"))
+BREAKER_OPEN_MAX = float(os.environ.get("BREAKER_OPEN_MAX", "600"))
+
+# Prefetch: offerte validate e già renderizzate tra un tick e l'altro
+PREFETCH_ENABLED = os.environ.get("PREFETCH_ENABLED", "0") == "1"
+PREFETCH_QUEUE_MAX = int(os.environ.get("PREFETCH_QUEUE_MAX", "5"))
+PREFETCH_TTL_SECONDS = int(os.environ.get("PREFETCH_TTL_SECONDS", "1800"))
+PREFETCH_INTERVAL = int(os.environ.get("PREFETCH_INTERVAL", "120"))
+
+# Cache risposte searchItems (TTL 0 = disattivata); i risultati presi dalla cache
+# vengono riconfermati con GetItems prima di pubblicare
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", "1800"))
+SEARCH_CACHE_MAX = int(os.environ.get("SEARCH_CACHE_MAX", "200"))
+SEARCH_CACHE_DISK = os.environ.get("SEARCH_CACHE_DISK", "1") == "1"
+SEARCH_CACHE_RECHECK = os.environ.get("SEARCH_CACHE_RECHECK", "1") == "1"
+
+# Cache negativa: gli ASIN scartati non vengono riparsati né rimandati a GetItems fino alla
+# scadenza. TTL breve per i motivi di prezzo (il prezzo cambia), lungo per quelli strutturali
+# (GetItems senza offerta o senza l'item). TTL 0 = motivo non messo in cache
+NEG_CACHE_TTL_PRICE = int(os.environ.get("NEG_CACHE_TTL_PRICE", "3600"))
+NEG_CACHE_TTL_STRUCTURAL = int(os.environ.get("NEG_CACHE_TTL_STRUCTURAL", "86400"))
+NEG_CACHE_MAX = int(os.environ.get("NEG_CACHE_MAX", "20000"))
+
+# Arricchimento: ASIN senza prezzo/sconto in searchItems raccolti tra keyword e
+# completati con GetItems a lotti pieni, con una cadenza propria
+ENRICH_ENABLED = os.environ.get("ENRICH_ENABLED", "0") == "1"
+ENRICH_INTERVAL = int(os.environ.get("ENRICH_INTERVAL", "300"))
+ENRICH_PENDING_MAX = int(os.environ.get("ENRICH_PENDING_MAX", "200"))
+ENRICH_PENDING_TTL = int(os.environ.get("ENRICH_PENDING_TTL", "21600"))
+GETITEMS_BATCH_MAX = int(os.environ.get("GETITEMS_BATCH_MAX", "10"))
+
+# Selezione offerta: "first" = prima valida in ordine di pagina, "best" = miglior punteggio
+# su tutte le pagine. Punteggio: "discount" (%), "saving" (€) o "blend" (sconto × log risparmio)
+DEAL_SELECTION = os.environ.get("DEAL_SELECTION", "first").strip().lower()
+DEAL_SCORE = os.environ.get("DEAL_SCORE", "discount").strip().lower()
+
+# Scelta keyword: "roundrobin" (KEYWORDS in ordine) o "bandit" (Thompson sampling sulle offerte
+# valide per chiamata API, statistiche con emivita KEYWORD_HALF_LIFE_HOURS e almeno KEYWORD_EXPLORE
+# di scelte a caso). Col bandit ogni keyword scansiona solo le pagine dove trova offerte
+# (quota KEYWORD_DEPTH_COVERAGE, +1 pagina, minimo KEYWORD_MIN_PAGES)
+KEYWORD_SELECTOR = os.environ.get("KEYWORD_SELECTOR", "roundrobin").strip().lower()
+KEYWORD_EXPLORE = float(os.environ.get("KEYWORD_EXPLORE", "0.1"))
+KEYWORD_HALF_LIFE_HOURS = float(os.environ.get("KEYWORD_HALF_LIFE_HOURS", "72"))
+KEYWORD_DEPTH_COVERAGE = float(os.environ.get("KEYWORD_DEPTH_COVERAGE", "0.9"))
+KEYWORD_MIN_PAGES = int(os.environ.get("KEYWORD_MIN_PAGES", "1"))
+
+# Minimo storico: prezzo più basso degli ultimi MINIMO_DAYS giorni, solo con almeno
+# MINIMO_MIN_DAYS giorni di storico per quell'asin
+MINIMO_DAYS = int(os.environ.get("MINIMO_DAYS", "30"))
+MINIMO_MIN_DAYS = float(os.environ.get("MINIMO_MIN_DAYS", "7"))
+
+# Scheduler: orari nel fuso SCHEDULE_TZ con le regole vere (ora legale compresa).
+# Un invio ogni POST_INTERVAL_MINUTES da POST_WINDOW_START a POST_WINDOW_END (nessun
+# risveglio fuori fascia); reset pubblicati il giorno RESET_WEEKDAY (0 = lunedì) alle RESET_TIME
+SCHEDULE_TZ = ZoneInfo(os.environ.get("SCHEDULE_TZ", "Europe/Rome").strip())
+POST_WINDOW_START = int(os.environ.get("POST_WINDOW_START", "9"))
+POST_WINDOW_END = int(os.environ.get("POST_WINDOW_END", "21"))
+POST_INTERVAL_MINUTES = int(os.environ.get("POST_INTERVAL_MINUTES", "14"))
+POST_JITTER_SECONDS = float(os.environ.get("POST_JITTER_SECONDS", "0"))
+RESET_WEEKDAY = int(os.environ.get("RESET_WEEKDAY", "0"))
+RESET_TIME = os.environ.get("RESET_TIME", "06:59").strip()
+# Tick persi (processo sospeso, job precedente troppo lungo): "skip" salta quelli in
+# ritardo oltre SCHEDULE_GRACE_SECONDS, "once" ne esegue uno solo appena possibile
+SCHEDULE_CATCHUP = os.environ.get("SCHEDULE_CATCHUP", "skip").strip().lower()
+SCHEDULE_GRACE_SECONDS = int(os.environ.get("SCHEDULE_GRACE_SECONDS", "120"))
+
 # Debug
 DEBUG_AMAZON = os.environ.get("DEBUG_AMAZON", "0") == "1"
+
+# Tracing per ciclo (span tree su JSONL) e profiling a campione (cProfile + tracemalloc)
+TRACE_ENABLED = os.environ.get("TRACE_ENABLED", "0") == "1"
+TRACE_MAX_BYTES = int(os.environ.get("TRACE_MAX_BYTES", str(5 * 1024 * 1024)))
+TRACE_BACKUPS = int(os.environ.get("TRACE_BACKUPS", "3"))
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "10"))
 GETITEMS_FALLBACK_MAX = int(os.environ.get("GETITEMS_FALLBACK_MAX", "4"))
 
+# HTTP: connessioni keep-alive per host, timeout per endpoint, retry su 5xx/errori rete
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "10"))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", "2"))
+HTTP_BACKOFF_BASE = float(os.environ.get("HTTP_BACKOFF_BASE", "0.5"))
+HTTP_BACKOFF_MAX = float(os.environ.get("HTTP_BACKOFF_MAX", "8"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_TIMEOUTS = {
+    "token": float(os.environ.get("HTTP_TIMEOUT_TOKEN", "20")),
+    "api": float(os.environ.get("HTTP_TIMEOUT_API", "25")),
+    "image": float(os.environ.get("HTTP_TIMEOUT_IMAGE", "15")),
+}
+
 KEYWORDS = [
     "Apple",
     "Android",
@@ -85,22 +228,125 @@ KEYWORDS = [
 # ============================================================
 # STORAGE (Render: meglio /tmp, o /data se hai persistent disk)
 # ============================================================
+# la cartella si crea alla prima scrittura (ensure_data_dir), non all'import
 DATA_DIR = os.environ.get("DATA_DIR", "/tmp/botdata")
-Path(DATA_DIR).mkdir(parents=True, exist_ok=True)
 
+# Stato (pubblicati, post per chat, rotazione keyword) in SQLite con journal WAL:
+# condiviso in modo consistente tra worker gunicorn, /run e scheduler
+STATE_DB = os.path.join(DATA_DIR, "state.db")
+STATE_DB_TIMEOUT = float(os.environ.get("STATE_DB_TIMEOUT", "10"))
+
+# Vecchi file di stato, importati una volta sola in STATE_DB e poi rinominati *.migrated
 PUB_FILE = os.path.join(DATA_DIR, "pubblicati.txt")
 PUB_TS = os.path.join(DATA_DIR, "pubblicati_ts.csv")
 KW_INDEX = os.path.join(DATA_DIR, "kw_index.txt")
 
+# Dedup: quante ore di storico dei post per chat tenere
+PUB_TS_RETENTION_HOURS = float(os.environ.get("PUB_TS_RETENTION_HOURS", "48"))
+
+# Prenotazione di un ASIN durante l'invio (un solo ciclo lo pubblica, anche tra processi):
+# scade dopo POST_CLAIM_TTL_SECONDS se il processo muore a metà
+POST_CLAIM_TTL_SECONDS = float(os.environ.get("POST_CLAIM_TTL_SECONDS", "900"))
+
+# Job di /run (stato in STATE_DB, leggibile da qualunque worker): storico tenuto per N ore
+RUN_JOB_RETENTION_HOURS = float(os.environ.get("RUN_JOB_RETENTION_HOURS", "24"))
+
+# Livello resources accettato dall'API (per endpoint/marketplace/credenziali), riprovato ogni tanto
+RES_LEVELS_FILE = os.path.join(DATA_DIR, "res_levels.json")
+RES_LEVEL_REPROBE_SECONDS = int(os.environ.get("RES_LEVEL_REPROBE_SECONDS", "21600"))
+
+SEARCH_CACHE_DIR = os.path.join(DATA_DIR, "search_cache")
+
+# Token Creators: refresh in background TOKEN_REFRESH_MARGIN secondi prima della scadenza,
+# salvato su disco (permessi 0600) per riusarlo dopo un riavvio
+TOKEN_FILE = os.path.join(DATA_DIR, "creators_token.json")
+TOKEN_REFRESH_MARGIN = int(os.environ.get("TOKEN_REFRESH_MARGIN", "300"))
+# con token brevi il margine scende a metà della durata; tra due refresh in background
+# passano comunque almeno TOKEN_REFRESH_MIN_INTERVAL secondi
+TOKEN_REFRESH_MIN_INTERVAL = float(os.environ.get("TOKEN_REFRESH_MIN_INTERVAL", "30"))
+TOKEN_PERSIST = os.environ.get("TOKEN_PERSIST", "1") == "1"
+ENRICH_FILE = os.path.join(DATA_DIR, "enrich_pending.json")
+TRACE_FILE = os.path.join(DATA_DIR, "traces.jsonl")
+PROFILE_DIR = os.path.join(DATA_DIR, "profiles")
+
+# Storico prezzi: record binari a dimensione fissa, append-only
+PRICE_HISTORY_FILE = os.path.join(DATA_DIR, "price_history.bin")
+PRICE_HISTORY_DAYS = int(os.environ.get("PRICE_HISTORY_DAYS", "90"))
+PRICE_HISTORY_MIN_GAP = int(os.environ.get("PRICE_HISTORY_MIN_GAP", "3600"))
+PRICE_HISTORY_COMPACT_MB = float(os.environ.get("PRICE_HISTORY_COMPACT_MB", "32"))
+
+# Cache immagini prodotto (LRU su disco, rivalidata con GET condizionale)
+IMG_CACHE_DIR = os.path.join(DATA_DIR, "img_cache")
+IMG_CACHE_MAX_MB = float(os.environ.get("IMG_CACHE_MAX_MB", "200"))
+IMG_CACHE_FRESH_SECONDS = int(os.environ.get("IMG_CACHE_FRESH_SECONDS", "86400"))
+IMG_CACHE_TILES = os.environ.get("IMG_CACHE_TILES", "1") == "1"
+
+PLACEHOLDER_IMG_URL = "https://m.media-amazon.com/images/I/71bhWgQK-cL._AC_SL1500_.jpg"
+
 # ============================================================
 # Telegram
 # ============================================================
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
+_bot = None
+_bot_lock = threading.Lock()
+
+
+def get_bot():
+    """Bot Telegram, costruito al primo uso (pool connessioni adeguato all'invio parallelo su più chat)."""
+    global _bot
+    if _bot is None:
+        with _bot_lock:
+            if _bot is None:
+                from telegram import Bot
+                from telegram.utils.request import Request
+
+                _bot = Bot(
+                    token=TELEGRAM_BOT_TOKEN,
+                    base_url=TELEGRAM_API_BASE or None,
+                    request=Request(con_pool_size=TELEGRAM_FANOUT_WORKERS + 4),
+                )
+    return _bot
+
+
+def __getattr__(name):
+    # main.bot resta disponibile per chi lo usava dall'esterno, ma si costruisce solo se serve
+    if name == "bot":
+        return get_bot()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 # ============================================================
 # Helpers generali
 # ============================================================
+_data_dir_ready = False
+
+
+def ensure_data_dir():
+    """Crea DATA_DIR alla prima scrittura (una volta per processo)."""
+    global _data_dir_ready
+    if not _data_dir_ready:
+        Path(DATA_DIR).mkdir(parents=True, exist_ok=True)
+        _data_dir_ready = True
+
+
+def _replace_file(path, write, binary=False):
+    """
+    Scrittura atomica di path: write(f) scrive su un temporaneo con nome univoco nella
+    stessa cartella, poi os.replace. Thread e worker che salvano lo stesso file non si
+    pubblicano a vicenda file scritti a metà. Il file nasce con permessi 0600.
+    """
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb" if binary else "w", **({} if binary else {"encoding": "utf-8"})) as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
 def _require_env():
     missing = []
     for k in [
@@ -110,10 +356,11 @@ def _require_env():
         "CREATORS_CREDENTIAL_VERSION",
         "CREATORS_MARKETPLACE",
         "TELEGRAM_BOT_TOKEN",
-        "TELEGRAM_CHAT_ID",
     ]:
         if not os.environ.get(k, "").strip():
             missing.append(k)
+    if not TELEGRAM_CHAT_IDS:
+        missing.append("TELEGRAM_CHAT_ID")
     if missing:
         raise RuntimeError(f"Missing env vars: {', '.join(missing)}")
 
@@ -161,29 +408,695 @@ def draw_bold_text(draw, position, text, font, fill="black", offset=1):
             draw.text((x + dx, y + dy), text, font=font, fill=fill)
 
 
+# ============================================================
+# Metriche (formato Prometheus, servite da /metrics in app.py)
+# ============================================================
+# Solo contatori e istogrammi in memoria: un bisect e un lock per osservazione.
+METRICS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 60.0)
+
+_METRICS_HELP = {
+    "bot_token_refresh_seconds": "Durata refresh token Cognito",
+    "bot_search_page_seconds": "Durata chiamata searchItems per pagina (rete, fallback resources inclusi)",
+    "bot_getitems_seconds": "Durata chiamata getItems",
+    "bot_image_download_seconds": "Durata download/rivalidazione immagine prodotto",
+    "bot_render_seconds": "Durata render + encode della card",
+    "bot_send_photo_seconds": "Durata send_photo Telegram",
+    "bot_resource_fallbacks_total": "Livelli resources rifiutati dall'API",
+    "bot_rejections_total": "Item scartati per keyword e motivo",
+    "bot_ticks_total": "Esecuzioni di invia_offerta per esito",
+    "bot_cycles_total": "Richieste di ciclo per sorgente (scheduler, http) ed esito (started, coalesced)",
+    "bot_post_claims_total": "Prenotazioni ASIN prima dell'invio per esito (won, lost)",
+    "bot_send_failures_total": "Invii Telegram falliti per chat",
+    "bot_scheduler_runs_total": "Job dello scheduler per esito (ok, error, skipped)",
+    "bot_negative_cache_total": "Consultazioni della cache negativa per punto (parse, getitems, enrich) ed esito",
+    "bot_creators_calls_total": "Chiamate Creators API per endpoint ed esito (status HTTP, network, token_error, short_circuit, rate_limited)",
+    "bot_token_refresh_ok_total": "Refresh token Cognito riusciti",
+    "bot_token_refresh_fail_total": "Refresh token Cognito falliti",
+    "bot_search_cache_hits_total": "Pagine searchItems servite dalla cache (memoria o disco)",
+    "bot_search_cache_misses_total": "Pagine searchItems non in cache",
+}
+
+_metrics_lock = threading.Lock()
+_metric_hist = {}  # (name, labels) -> [conteggi per bucket (+Inf in coda), somma, totale]
+_metric_counters = Counter()  # (name, labels) -> valore
+
+
+def metric_observe(name, seconds, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    i = bisect.bisect_left(METRICS_BUCKETS, seconds)
+    with _metrics_lock:
+        h = _metric_hist.get(key)
+        if h is None:
+            h = _metric_hist[key] = [[0] * (len(METRICS_BUCKETS) + 1), 0.0, 0]
+        h[0][i] += 1
+        h[1] += seconds
+        h[2] += 1
+
+
+def metric_inc(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        _metric_counters[key] += value
+
+
+@contextmanager
+def timed(name, **labels):
+    """Osserva la durata nell'istogramma name e, se c'è un trace attivo, apre uno span."""
+    t0 = time.perf_counter()
+    with trace_span(name.removeprefix("bot_").removesuffix("_seconds"), **labels):
+        try:
+            yield
+        finally:
+            metric_observe(name, time.perf_counter() - t0, **labels)
+
+
+def _fmt_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    body = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " "))
+        for k, v in pairs
+    )
+    return "{" + body + "}"
+
+
+def _metric_header(lines, seen, name, kind):
+    if name not in seen:
+        seen.add(name)
+        lines.append(f"# HELP {name} {_METRICS_HELP.get(name, name)}")
+        lines.append(f"# TYPE {name} {kind}")
+
+
+def render_metrics():
+    """Testo in formato di esposizione Prometheus."""
+    with _metrics_lock:
+        hists = {k: ([*v[0]], v[1], v[2]) for k, v in _metric_hist.items()}
+        counters = dict(_metric_counters)
+
+    lines, seen = [], set()
+    for (name, labels), (buckets, total, count) in sorted(hists.items()):
+        _metric_header(lines, seen, name, "histogram")
+        cum = 0
+        for le, n in zip([*METRICS_BUCKETS, "+Inf"], buckets):
+            cum += n
+            lines.append(f"{name}_bucket{_fmt_labels(labels, [('le', le)])} {cum}")
+        lines.append(f"{name}_sum{_fmt_labels(labels)} {total:.6f}")
+        lines.append(f"{name}_count{_fmt_labels(labels)} {count}")
+
+    for (name, labels), value in sorted(counters.items()):
+        _metric_header(lines, seen, name, "counter")
+        lines.append(f"{name}{_fmt_labels(labels)} {value}")
+
+    # stato interno già esposto dalle varie cache: i totali che crescono soltanto sono
+    # counter (rate()/increase() gestiscono i riavvii), i valori istantanei gauge
+    totals, gauges = [], []
+    try:
+        ts = token_stats()
+        totals += [
+            ("bot_token_refresh_ok_total", ts["refresh_ok"]),
+            ("bot_token_refresh_fail_total", ts["refresh_fail"]),
+        ]
+        gauges.append(("bot_token_expires_in_seconds", ts["expires_in_s"] or 0))
+        sc = search_cache_stats()
+        totals += [
+            ("bot_search_cache_hits_total", sc.get("hit_mem", 0) + sc.get("hit_disk", 0)),
+            ("bot_search_cache_misses_total", sc.get("miss", 0)),
+        ]
+        gauges.append(("bot_search_cache_entries", sc.get("entries_mem", 0)))
+        nc = negative_cache_stats()
+        gauges += [
+            ("bot_negative_cache_entries", nc["entries"]),
+            ("bot_negative_cache_hit_rate", nc["hit_rate"]),
+        ]
+        gauges += [
+            ("bot_cycle_in_flight", int(cycle_in_flight() is not None)),
+            ("bot_prefetch_queue_size", prefetch_size()),
+            ("bot_enrich_pending", enrich_pending_count()),
+        ]
+        cs = creators_status()
+        gauges += [
+            ("bot_creators_breaker_state", {"closed": 0, "half_open": 1, "open": 2}[cs["breaker"]]),
+            ("bot_creators_breaker_retry_in_seconds", cs["retry_in_s"]),
+            ("bot_creators_rate_factor", cs["rate_factor"]),
+            ("bot_creators_tokens_available", cs["tokens"]),
+            ("bot_creators_daily_remaining", cs["daily_remaining"] if cs["daily_remaining"] is not None else -1),
+        ]
+        if _scheduler is not None and _scheduler.next_due() is not None:
+            gauges.append(("bot_scheduler_next_run_seconds", round(max(0.0, _scheduler.next_due() - time.time()), 1)))
+    except Exception as e:
+        lines.append(f"# stato interno non disponibile: {e}")
+    for kind, series in (("counter", totals), ("gauge", gauges)):
+        for name, value in series:
+            _metric_header(lines, seen, name, kind)
+            lines.append(f"{name} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+# ============================================================
+# Tracing per ciclo e profiling a campione
+# ============================================================
+# Lo span corrente vive in un ContextVar: fuori da un ciclo tracciato è None e
+# trace_span/trace_set costano un solo lookup.
+_current_span = contextvars.ContextVar("current_span", default=None)
+_trace_write_lock = threading.Lock()
+_profile_lock = threading.Lock()
+
+
+@contextmanager
+def trace_span(name, **attrs):
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    span = {
+        "name": name,
+        "start_ms": round((time.perf_counter() - parent["_t0"]) * 1000 + parent["start_ms"], 2),
+        "attrs": attrs,
+        "children": [],
+        "_t0": time.perf_counter(),
+    }
+    parent["children"].append(span)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except Exception as e:
+        span["attrs"]["error"] = str(e)[:200]
+        raise
+    finally:
+        span["dur_ms"] = round((time.perf_counter() - span["_t0"]) * 1000, 2)
+        _current_span.reset(token)
+
+
+def trace_set(**attrs):
+    """Aggiunge attributi (dimensioni, conteggi) allo span corrente, se c'è."""
+    span = _current_span.get()
+    if span is not None:
+        span["attrs"].update(attrs)
+
+
+def submit_in_context(pool, fn, *args, **kwargs):
+    # i thread del pool non ereditano il ContextVar: si passa una copia del contesto
+    return pool.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def _strip_span(span):
+    return {
+        "name": span["name"],
+        "start_ms": span["start_ms"],
+        "dur_ms": span.get("dur_ms"),
+        "attrs": span["attrs"],
+        "children": [_strip_span(c) for c in span["children"]],
+    }
+
+
+def _write_trace(record):
+    line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+    with _trace_write_lock:
+        try:
+            ensure_data_dir()
+            if os.path.exists(TRACE_FILE) and os.path.getsize(TRACE_FILE) + len(line) > TRACE_MAX_BYTES:
+                for i in range(TRACE_BACKUPS - 1, 0, -1):
+                    if os.path.exists(f"{TRACE_FILE}.{i}"):
+                        os.replace(f"{TRACE_FILE}.{i}", f"{TRACE_FILE}.{i + 1}")
+                if TRACE_BACKUPS > 0:
+                    os.replace(TRACE_FILE, f"{TRACE_FILE}.1")
+                else:
+                    os.remove(TRACE_FILE)
+            with open(TRACE_FILE, "a", encoding="utf-8") as f:
+                f.write(line)
+        except Exception as e:
+            print(f"⚠️ Scrittura trace fallita: {e}")
+
+
+def _dump_profile(trace_id, prof, snapshot):
+    import pstats
+
+    Path(PROFILE_DIR).mkdir(parents=True, exist_ok=True)
+    stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+    base = os.path.join(PROFILE_DIR, f"cycle-{stamp}-{trace_id}")
+
+    prof.dump_stats(base + ".prof")
+    with open(base + ".txt", "w", encoding="utf-8") as f:
+        f.write("== cProfile (thread del ciclo, top 40 per tempo cumulativo) ==\n")
+        pstats.Stats(prof, stream=f).sort_stats("cumulative").print_stats(40)
+        f.write("\n== tracemalloc (top 30 allocazioni per riga) ==\n")
+        for stat in snapshot.statistics("lineno")[:30]:
+            f.write(f"{stat}\n")
+
+    # tieni solo gli ultimi PROFILE_KEEP cicli
+    stems = sorted({n.rsplit(".", 1)[0] for n in os.listdir(PROFILE_DIR) if n.startswith("cycle-")})
+    for stem in stems[:-PROFILE_KEEP] if PROFILE_KEEP > 0 else stems:
+        for ext in (".prof", ".txt"):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, stem + ext))
+            except OSError:
+                pass
+
+
+@contextmanager
+def trace_cycle(name):
+    """
+    Traccia un ciclo completo se TRACE_ENABLED (span tree su TRACE_FILE) e, con
+    probabilità PROFILE_SAMPLE_RATE, lo profila con cProfile + tracemalloc.
+    """
+    profile = PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+    if not (TRACE_ENABLED or profile) or _current_span.get() is not None:
+        yield None
+        return
+
+    # un solo profiler alla volta (cProfile non ne supporta due attivi)
+    if profile and not _profile_lock.acquire(blocking=False):
+        profile = False
+
+    trace_id = uuid.uuid4().hex[:12]
+    root = {"name": name, "start_ms": 0.0, "attrs": {}, "children": [], "_t0": time.perf_counter()}
+    token = _current_span.set(root)
+    prof = None
+    started_tm = False
+    if profile:
+        prof = cProfile.Profile()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            started_tm = True
+        prof.enable()
+
+    try:
+        yield root
+    except Exception as e:
+        root["attrs"]["error"] = str(e)[:200]
+        raise
+    finally:
+        root["dur_ms"] = round((time.perf_counter() - root["_t0"]) * 1000, 2)
+        _current_span.reset(token)
+        if prof is not None:
+            prof.disable()
+            try:
+                snapshot = tracemalloc.take_snapshot()
+                root["attrs"]["tracemalloc_peak_kb"] = tracemalloc.get_traced_memory()[1] // 1024
+                if started_tm:
+                    tracemalloc.stop()
+                _dump_profile(trace_id, prof, snapshot)
+                root["attrs"]["profile"] = trace_id
+            except Exception as e:
+                print(f"⚠️ Dump profilo fallito: {e}")
+            finally:
+                _profile_lock.release()
+        if TRACE_ENABLED:
+            _write_trace({"ts": datetime.utcnow().isoformat(), "trace_id": trace_id, "root": _strip_span(root)})
+
+
+def list_profiles():
+    """Dump disponibili (nome file, byte), dal più recente."""
+    try:
+        names = sorted((n for n in os.listdir(PROFILE_DIR) if n.startswith("cycle-")), reverse=True)
+    except FileNotFoundError:
+        return []
+    return [(n, os.path.getsize(os.path.join(PROFILE_DIR, n))) for n in names]
+
+
+def profile_path(name):
+    """Path di un dump di list_profiles(), None se il nome non è valido."""
+    if name not in {n for n, _ in list_profiles()}:
+        return None
+    return os.path.join(PROFILE_DIR, name)
+
+
+def tail_traces(n=20):
+    try:
+        with open(TRACE_FILE, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f.readlines()[-n:] if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+# ============================================================
+# HTTP: sessioni condivise (keep-alive) + retry con backoff
+# ============================================================
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+
+def _http_session(url):
+    """Una requests.Session per host: riusa connessioni TCP/TLS tra le chiamate."""
+    host = urlsplit(url).netloc
+    with _http_sessions_lock:
+        s = _http_sessions.get(host)
+        if s is None:
+            s = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=0)
+            s.mount("https://", adapter)
+            s.mount("http://", adapter)
+            _http_sessions[host] = s
+        return s
+
+
+def http_backoff(attempt):
+    """Attesa prima del nuovo tentativo attempt (0-based): esponenziale con jitter pieno."""
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** attempt)))
+
+
+def http_request(method, url, endpoint="api", retries=None, **kwargs):
+    """
+    Richiesta HTTP tramite la sessione dell'host.
+    endpoint sceglie il timeout in HTTP_TIMEOUTS ("token", "api", "image").
+    5xx ed errori di connessione/timeout vengono ritentati fino a retries volte
+    (default HTTP_RETRIES) con backoff esponenziale e jitter; le altre risposte
+    tornano al chiamante.
+    """
+    total = HTTP_TIMEOUTS.get(endpoint, HTTP_TIMEOUTS["api"])
+    kwargs.setdefault("timeout", (min(HTTP_CONNECT_TIMEOUT, total), total))
+    retries = HTTP_RETRIES if retries is None else retries
+
+    attempt = 0
+    while True:
+        try:
+            r = _http_session(url).request(method, url, **kwargs)
+            if r.status_code < 500 or attempt >= retries:
+                return r
+            why = f"HTTP {r.status_code}"
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= retries:
+                raise
+            why = type(e).__name__
+
+        delay = http_backoff(attempt)
+        attempt += 1
+        if DEBUG_AMAZON:
+            print(f"[DEBUG] {endpoint} {method} retry {attempt}/{retries} in {delay:.2f}s ({why})")
+        time.sleep(delay)
+
+
+# ============================================================
+# Template grafico: font, header, badge caricati una volta
+# ============================================================
+_render_lock = threading.Lock()
+_render_template = None
+_render_template_key = None
+
+
+def _render_assets_key():
+    # mtime/size degli asset: se cambiano su disco il template va ricostruito
+    key = []
+    for path in (FONT_PATH, LOGO_PATH, BADGE_PATH):
+        try:
+            st = os.stat(path)
+            key.append((path, st.st_mtime_ns, st.st_size))
+        except OSError:
+            key.append((path, None, None))
+    return tuple(key)
+
+
+def _build_render_template():
+    from PIL import Image, ImageFont
+
+    fonts = {size: ImageFont.truetype(FONT_PATH, size) for size in (72, 88, 120)}
+
+    base = Image.new("RGB", (1080, 1080), "white")
+    with Image.open(LOGO_PATH) as logo:
+        base.paste(logo.resize((1080, 165)), (0, 0))
+
+    with Image.open(BADGE_PATH) as badge_src:
+        badge = badge_src.resize((220, 96))
+    badge_mask = badge.convert("RGBA")
+
+    base_badge = base.copy()
+    base_badge.paste(badge, (24, 140), badge_mask)
+
+    return {
+        "font_perc": fonts[88],
+        "font_old": fonts[72],
+        "font_new": fonts[120],
+        "badge": badge,
+        "badge_mask": badge_mask,
+        "base": base,
+        "base_badge": base_badge,
+    }
+
+
+def get_render_template():
+    """Template pronto per il render; ricaricato solo se gli asset cambiano."""
+    global _render_template, _render_template_key
+
+    key = _render_assets_key()
+    with _render_lock:
+        if _render_template is None or key != _render_template_key:
+            _render_template = _build_render_template()
+            _render_template_key = key
+            if DEBUG_AMAZON:
+                print("[DEBUG] Render template (ri)caricato")
+        return _render_template
+
+
+# ============================================================
+# Cache immagini prodotto (DATA_DIR/img_cache)
+# ============================================================
+# Per ogni URL: <key>.img (bytes originali), <key>.json (ETag/Last-Modified)
+# e, se IMG_CACHE_TILES, <key>.tile<W>x<H>.png (tile già decodificato e scalato).
+_img_cache_lock = threading.Lock()
+_img_cache_index = None  # OrderedDict key -> {nome file: bytes}, dal meno al più recente
+_img_cache_bytes = 0
+
+
+def _img_cache_key(url):
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+
+def _img_cache_files(key):
+    prefix = os.path.join(IMG_CACHE_DIR, key)
+    return prefix + ".img", prefix + ".json"
+
+
+def _img_tile_path(key, size):
+    return os.path.join(IMG_CACHE_DIR, f"{key}.tile{size[0]}x{size[1]}.png")
+
+
+def _img_cache_load_index():
+    """Prima scansione della cartella, ordinata per ultimo accesso (mtime del .json)."""
+    global _img_cache_index, _img_cache_bytes
+
+    Path(IMG_CACHE_DIR).mkdir(parents=True, exist_ok=True)
+    files = {}
+    access = {}
+    for name in os.listdir(IMG_CACHE_DIR):
+        path = os.path.join(IMG_CACHE_DIR, name)
+        if name.endswith(".tmp"):
+            # temporaneo di una scrittura interrotta
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        key = name.split(".", 1)[0]
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        files.setdefault(key, {})[name] = st.st_size
+        if name.endswith(".json"):
+            access[key] = st.st_mtime
+
+    _img_cache_index = OrderedDict()
+    for key in sorted(files, key=lambda k: access.get(k, 0)):
+        _img_cache_index[key] = files[key]
+    _img_cache_bytes = sum(sum(f.values()) for f in files.values())
+
+
+def _img_cache_remove_locked(key, names):
+    """Cancella i file names di key e li toglie dall'indice."""
+    global _img_cache_bytes
+    files = _img_cache_index.get(key, {})
+    for name in names:
+        _img_cache_bytes -= files.pop(name, 0)
+        try:
+            os.remove(os.path.join(IMG_CACHE_DIR, name))
+        except OSError:
+            pass
+
+
+def _img_cache_drop(key):
+    _img_cache_remove_locked(key, list(_img_cache_index.get(key, ())))
+    _img_cache_index.pop(key, None)
+
+
+def _img_cache_account(key, paths=(), touch=True):
+    """
+    Aggiorna dimensioni (dei soli file in paths, appena scritti) e recency di key,
+    poi evince i meno usati oltre IMG_CACHE_MAX_MB.
+    """
+    global _img_cache_bytes
+
+    with _img_cache_lock:
+        if _img_cache_index is None:
+            _img_cache_load_index()
+        files = _img_cache_index.setdefault(key, {})
+        for path in paths:
+            name = os.path.basename(path)
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = 0
+            _img_cache_bytes += size - files.pop(name, 0)
+            if size:
+                files[name] = size
+        _img_cache_index.move_to_end(key)
+        if touch:
+            try:
+                os.utime(_img_cache_files(key)[1])
+            except OSError:
+                pass
+
+        cap = IMG_CACHE_MAX_MB * 1024 * 1024
+        while _img_cache_bytes > cap and len(_img_cache_index) > 1:
+            oldest = next(iter(_img_cache_index))
+            if oldest == key:
+                break
+            _img_cache_drop(oldest)
+
+
+def _img_cache_read_meta(key):
+    img_path, meta_path = _img_cache_files(key)
+    if not os.path.exists(img_path):
+        return None
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except:
+        return None
+
+
+def _img_cache_replace(path, write):
+    """Scrittura atomica (binaria) di un file della cache: thread e worker che scaricano lo stesso URL."""
+    _replace_file(path, write, binary=True)
+
+
+def _img_cache_write(key, meta, content=None):
+    """Scrive meta (e content se dato); ritorna i path scritti."""
+    img_path, meta_path = _img_cache_files(key)
+    written = []
+    if content is not None:
+        _img_cache_replace(img_path, lambda f: f.write(content))
+        written.append(img_path)
+    _img_cache_replace(meta_path, lambda f: f.write(json.dumps(meta).encode("utf-8")))
+    written.append(meta_path)
+    return written
+
+
+def _refresh_image_entry(url_img):
+    """
+    Garantisce in cache una copia valida di url_img e ne ritorna la chiave.
+    Entro IMG_CACHE_FRESH_SECONDS si usa la copia locale; dopo si rivalida con
+    If-None-Match/If-Modified-Since. Se la rete fallisce si usa la copia stantia.
+    """
+    with _img_cache_lock:
+        if _img_cache_index is None:
+            _img_cache_load_index()
+
+    key = _img_cache_key(url_img)
+    meta = _img_cache_read_meta(key)
+    now = time.time()
+
+    if meta and now - meta.get("checked_at", 0) < IMG_CACHE_FRESH_SECONDS:
+        _img_cache_account(key)
+        return key
+
+    headers = {}
+    if meta and meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta and meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        with timed("bot_image_download_seconds"):
+            r = http_request("GET", url_img, endpoint="image", headers=headers)
+            trace_set(status=r.status_code, bytes=len(r.content))
+    except Exception:
+        if meta:
+            return key
+        raise
+
+    if r.status_code == 304 and meta:
+        meta["checked_at"] = now
+        _img_cache_account(key, _img_cache_write(key, meta))
+        return key
+
+    if r.status_code != 200:
+        if meta:
+            return key
+        raise RuntimeError(f"Image download error {r.status_code}: {url_img}")
+
+    # contenuto nuovo: i tile vecchi non valgono più
+    with _img_cache_lock:
+        tiles = [name for name in _img_cache_index.get(key, ()) if name.startswith(key + ".tile")]
+        _img_cache_remove_locked(key, tiles)
+
+    written = _img_cache_write(
+        key,
+        {
+            "url": url_img,
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+            "checked_at": now,
+        },
+        content=r.content,
+    )
+    _img_cache_account(key, written)
+    return key
+
+
+def get_product_tile(url_img, size=(600, 600)):
+    """Immagine prodotto già scalata a size, dal tile in cache se disponibile."""
+    from PIL import Image
+
+    key = _refresh_image_entry(url_img)
+    tile_path = _img_tile_path(key, size)
+
+    if IMG_CACHE_TILES and os.path.exists(tile_path):
+        try:
+            tile = Image.open(tile_path)
+            tile.load()
+            return tile
+        except Exception:
+            pass
+
+    with open(_img_cache_files(key)[0], "rb") as f:
+        tile = Image.open(BytesIO(f.read())).resize(size)
+
+    if IMG_CACHE_TILES:
+        try:
+            _img_cache_replace(tile_path, lambda f: tile.save(f, format="PNG", compress_level=1))
+            _img_cache_account(key, [tile_path], touch=False)
+        except Exception as e:
+            if DEBUG_AMAZON:
+                print(f"[DEBUG] Tile non salvato ({url_img}): {e}")
+
+    return tile
+
+
 # ============================================================
 # Immagine offerta
 # ============================================================
-def genera_immagine_offerta(titolo, prezzo_nuovo, prezzo_vecchio, sconto, url_img, minimo_storico):
-    img = Image.new("RGB", (1080, 1080), "white")
-    draw = ImageDraw.Draw(img)
+def render_card(titolo, prezzo_nuovo, prezzo_vecchio, sconto, prodotto, minimo_storico):
+    """Card 1080x1080 (PIL Image) da un tile prodotto 600x600 già pronto."""
+    from PIL import ImageDraw
 
-    logo = Image.open(LOGO_PATH).resize((1080, 165))
-    img.paste(logo, (0, 0))
+    tpl = get_render_template()
 
-    if minimo_storico and sconto >= 30:
-        badge = Image.open(BADGE_PATH).resize((220, 96))
-        img.paste(badge, (24, 140), badge.convert("RGBA"))
+    # la base ha già header (e badge) composti: si copia e si disegna solo il dinamico
+    if minimo_storico:
+        img = tpl["base_badge"].copy()
+    else:
+        img = tpl["base"].copy()
+    draw = ImageDraw.Draw(img)
 
-    font_perc = ImageFont.truetype(FONT_PATH, 88)
+    font_perc = tpl["font_perc"]
     draw.text((830, 230), f"-{sconto}%", font=font_perc, fill="black")
 
-    response = requests.get(url_img, timeout=15)
-    prodotto = Image.open(BytesIO(response.content)).resize((600, 600))
     img.paste(prodotto, (240, 230))
 
-    font_old = ImageFont.truetype(FONT_PATH, 72)
-    font_new = ImageFont.truetype(FONT_PATH, 120)
+    font_old = tpl["font_old"]
+    font_new = tpl["font_new"]
 
     prezzo_old_str = f"€ {prezzo_vecchio:.2f}"
     prezzo_new_str = f"€ {prezzo_nuovo:.2f}"
@@ -197,84 +1110,355 @@ def genera_immagine_offerta(titolo, prezzo_nuovo, prezzo_vecchio, sconto, url_im
     x_new = (1080 - int(w_new)) // 2
     draw_bold_text(draw, (x_new, 910), prezzo_new_str, font=font_new, fill="darkred", offset=2)
 
+    return img
+
+
+def encode_card(img, fmt=None):
+    """Codifica la card nel formato CARD_FORMAT (o fmt) e ritorna un BytesIO con .name."""
+    fmt = (fmt or CARD_FORMAT).lower()
     out = BytesIO()
-    img.save(out, format="PNG")
+    if fmt in ("jpeg", "jpg"):
+        img.save(out, format="JPEG", quality=CARD_JPEG_QUALITY, optimize=CARD_JPEG_OPTIMIZE)
+        out.name = "card.jpg"
+    elif fmt == "webp":
+        img.save(out, format="WEBP", quality=CARD_WEBP_QUALITY, method=CARD_WEBP_METHOD)
+        out.name = "card.webp"
+    else:
+        img.save(out, format="PNG", compress_level=CARD_PNG_COMPRESS)
+        out.name = "card.png"
     out.seek(0)
     return out
 
 
+def genera_immagine_offerta(titolo, prezzo_nuovo, prezzo_vecchio, sconto, url_img, minimo_storico):
+    prodotto = get_product_tile(url_img, (600, 600))
+    with timed("bot_render_seconds", format=CARD_FORMAT):
+        img = render_card(titolo, prezzo_nuovo, prezzo_vecchio, sconto, prodotto, minimo_storico)
+        out = encode_card(img)
+        trace_set(bytes=len(out.getvalue()))
+        return out
+
+
 # ============================================================
 # Pubblicati / Rotazione keyword
 # ============================================================
+_db_local = threading.local()
+_db_init_lock = threading.Lock()
+_db_ready = False
+
+_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS posts (
+    asin TEXT NOT NULL,
+    chat TEXT NOT NULL,  -- "*" = tutte le chat (record importati dal vecchio formato)
+    ts REAL NOT NULL,
+    PRIMARY KEY (asin, chat)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS posts_ts ON posts (ts);
+CREATE TABLE IF NOT EXISTS pubblicati (
+    asin TEXT PRIMARY KEY,
+    ts REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS kw_stats (
+    kw TEXT PRIMARY KEY,
+    calls REAL NOT NULL,  -- chiamate API, con decadimento esponenziale
+    deals REAL NOT NULL,  -- offerte valide trovate, idem
+    page_hits TEXT NOT NULL,  -- JSON {pagina: offerte trovate lì}, idem
+    updated REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS claims (
+    asin TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,  -- id dell'invio che ha prenotato l'ASIN
+    ts REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    cycle TEXT NOT NULL,  -- ciclo eseguito (più job possono condividerlo)
+    coalesced INTEGER NOT NULL,
+    status TEXT NOT NULL,  -- running, done, error
+    posted INTEGER,
+    error TEXT,
+    created REAL NOT NULL,
+    finished REAL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created);
+"""
+
+
+def _db_connect():
+    ensure_data_dir()
+    conn = sqlite3.connect(STATE_DB, timeout=STATE_DB_TIMEOUT, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # con WAL, NORMAL non fa fsync a ogni commit (solo ai checkpoint) ma resta consistente
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={int(STATE_DB_TIMEOUT * 1000)}")
+    return conn
+
+
+def _db():
+    """Connessione SQLite del thread corrente (schema e migrazione al primo uso nel processo)."""
+    global _db_ready
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = _db_local.conn = _db_connect()
+    if not _db_ready:
+        with _db_init_lock:
+            if not _db_ready:
+                conn.executescript(_DB_SCHEMA)
+                _migrate_state_files(conn)
+                _db_ready = True
+    return conn
+
+
+@contextmanager
+def _db_tx():
+    """Transazione in scrittura (BEGIN IMMEDIATE: un solo scrittore alla volta, gli altri attendono)."""
+    conn = _db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _parse_ts_line(line):
+    parts = line.strip().split(";", 2)
+    if len(parts) < 2:
+        return None
+    a, ts = parts[0], parts[1]
+    chat = parts[2].strip() if len(parts) == 3 and parts[2].strip() else "*"
+    try:
+        epoch = datetime.fromisoformat(ts).replace(tzinfo=timezone.utc).timestamp()
+    except:
+        return None
+    return a.strip().upper(), chat, epoch
+
+
+def _migrate_state_files(conn):
+    """Importa una sola volta pubblicati.txt, pubblicati_ts.csv e kw_index.txt."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT 1 FROM kv WHERE key = 'migrated_files'").fetchone():
+            conn.execute("COMMIT")
+            return
+        imported = Counter()
+        if os.path.exists(PUB_FILE):
+            ts = os.path.getmtime(PUB_FILE)
+            with open(PUB_FILE, "r", encoding="utf-8") as f:
+                rows = [(line.strip().upper(), ts) for line in f if line.strip()]
+            conn.executemany("INSERT OR IGNORE INTO pubblicati (asin, ts) VALUES (?, ?)", rows)
+            imported["pubblicati"] = len(rows)
+        if os.path.exists(PUB_TS):
+            with open(PUB_TS, "r", encoding="utf-8", errors="replace") as f:
+                rows = [rec for rec in map(_parse_ts_line, f) if rec]
+            conn.executemany(
+                "INSERT INTO posts (asin, chat, ts) VALUES (?, ?, ?) "
+                "ON CONFLICT (asin, chat) DO UPDATE SET ts = max(ts, excluded.ts)",
+                rows,
+            )
+            imported["posts"] = len(rows)
+        if os.path.exists(KW_INDEX):
+            try:
+                with open(KW_INDEX, "r", encoding="utf-8") as f:
+                    conn.execute("INSERT OR REPLACE INTO kv (key, value) VALUES ('kw_index', ?)", (str(int(f.read().strip())),))
+            except ValueError:
+                pass
+        conn.execute("INSERT INTO kv (key, value) VALUES ('migrated_files', ?)", (datetime.utcnow().isoformat(),))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+    for path in (PUB_FILE, PUB_TS, KW_INDEX):
+        if os.path.exists(path):
+            try:
+                os.replace(path, path + ".migrated")
+            except OSError as e:
+                print(f"⚠️ Impossibile rinominare {path}: {e}")
+    if imported:
+        print(f"✅ Stato importato in {STATE_DB}: {dict(imported)}")
+
+
 def load_pubblicati():
-    if not os.path.exists(PUB_FILE):
-        return set()
-    with open(PUB_FILE, "r", encoding="utf-8") as f:
-        return {line.strip().upper() for line in f if line.strip()}
+    return {row[0] for row in _db().execute("SELECT asin FROM pubblicati")}
+
+
+def _chats_to_post_tx(conn, asin, hours, chat_ids):
+    cutoff = time.time() - hours * 3600
+    chats = dict(conn.execute("SELECT chat, ts FROM posts WHERE asin = ?", (asin,)).fetchall())
+    everyone = chats.get("*", 0)
+    targets = chat_ids or TELEGRAM_CHAT_IDS or ["*"]
+    return [c for c in targets if max(chats.get(c, 0), everyone) <= cutoff]
+
+
+def chats_to_post(asin, hours=24, chat_ids=None):
+    """Chat (tra chat_ids, default TELEGRAM_CHAT_IDS) che non hanno ricevuto asin nelle ultime hours ore."""
+    return _chats_to_post_tx(_db(), (asin or "").strip().upper(), hours, chat_ids)
+
 
+def can_post(asin, hours=24):
+    # pubblicabile se manca ancora ad almeno una chat
+    return bool(chats_to_post(asin, hours))
+
+
+def _record_posts_tx(conn, asin, chat_ids, now):
+    conn.executemany(
+        "INSERT INTO posts (asin, chat, ts) VALUES (?, ?, ?) "
+        "ON CONFLICT (asin, chat) DO UPDATE SET ts = excluded.ts",
+        [(asin, c, now) for c in (chat_ids or ["*"])],
+    )
+    # retention: delete sull'indice per ts, al posto della vecchia compattazione del CSV
+    conn.execute("DELETE FROM posts WHERE ts < ?", (now - PUB_TS_RETENTION_HOURS * 3600,))
 
-def save_pubblicati(asin):
+
+def claim_post(asin, owner, hours=24):
+    """
+    Prenota asin per l'invio e ritorna le chat ancora da servire; [] se è già stato
+    pubblicato ovunque o se un altro invio (thread o processo) lo ha prenotato.
+    Controllo e prenotazione stanno nella stessa transazione: vince un solo ciclo.
+    """
     asin = (asin or "").strip().upper()
     if not asin:
-        return
-    with open(PUB_FILE, "a", encoding="utf-8") as f:
-        f.write(asin + "\n")
-        f.flush()
-        os.fsync(f.fileno())
+        return []
+    now = time.time()
+    with _db_tx() as conn:
+        row = conn.execute("SELECT owner, ts FROM claims WHERE asin = ?", (asin,)).fetchone()
+        if row and row[0] != owner and row[1] > now - POST_CLAIM_TTL_SECONDS:
+            targets = []
+        else:
+            targets = _chats_to_post_tx(conn, asin, hours, None)
+        if targets:
+            conn.execute("INSERT OR REPLACE INTO claims (asin, owner, ts) VALUES (?, ?, ?)", (asin, owner, now))
+    metric_inc("bot_post_claims_total", outcome="won" if targets else "lost")
+    return targets
 
 
-def can_post(asin, hours=24):
-    if not os.path.exists(PUB_TS):
-        return True
-    cutoff = datetime.utcnow() - timedelta(hours=hours)
-    with open(PUB_TS, "r", encoding="utf-8") as f:
-        for line in f:
-            parts = line.strip().split(";", 1)
-            if len(parts) != 2:
-                continue
-            a, ts = parts
-            if a == asin:
-                try:
-                    if datetime.fromisoformat(ts) > cutoff:
-                        return False
-                except:
-                    pass
-    return True
+def release_claim(asin, owner):
+    asin = (asin or "").strip().upper()
+    with _db_tx() as conn:
+        conn.execute("DELETE FROM claims WHERE asin = ? AND owner = ?", (asin, owner))
 
 
-def mark_posted(asin):
-    with open(PUB_TS, "a", encoding="utf-8") as f:
-        f.write(f"{asin};{datetime.utcnow().isoformat()}\n")
-        f.flush()
-        os.fsync(f.fileno())
+def commit_post(asin, chat_ids, complete, owner=None):
+    """Post per chat, (se complete) pubblicati e rilascio della prenotazione in un'unica transazione."""
+    asin = (asin or "").strip().upper()
+    if not asin:
+        return
+    now = time.time()
+    with _db_tx() as conn:
+        _record_posts_tx(conn, asin, chat_ids, now)
+        if complete:
+            conn.execute("INSERT OR IGNORE INTO pubblicati (asin, ts) VALUES (?, ?)", (asin, now))
+        if owner:
+            conn.execute("DELETE FROM claims WHERE asin = ? AND owner = ?", (asin, owner))
 
 
 def resetta_pubblicati():
-    open(PUB_FILE, "w", encoding="utf-8").close()
-    open(PUB_TS, "w", encoding="utf-8").close()
+    with _db_tx() as conn:
+        conn.execute("DELETE FROM pubblicati")
+        conn.execute("DELETE FROM posts")
 
 
-def get_kw_index():
+def _kw_index_tx(conn):
+    row = conn.execute("SELECT value FROM kv WHERE key = 'kw_index'").fetchone()
     try:
-        with open(KW_INDEX, "r", encoding="utf-8") as f:
-            i = int(f.read().strip())
-    except:
-        i = 0
-    return i % len(KEYWORDS)
+        return int(row[0]) % len(KEYWORDS) if row else 0
+    except ValueError:
+        return 0
 
 
-def bump_kw_index():
-    i = get_kw_index()
-    i = (i + 1) % len(KEYWORDS)
-    with open(KW_INDEX, "w", encoding="utf-8") as f:
-        f.write(str(i))
+def pick_keyword():
+    if KEYWORD_SELECTOR == "bandit":
+        return _bandit_pick()
+    # lettura e avanzamento nella stessa transazione: due tick concorrenti non prendono la stessa keyword
+    with _db_tx() as conn:
+        i = _kw_index_tx(conn)
+        conn.execute("INSERT OR REPLACE INTO kv (key, value) VALUES ('kw_index', ?)", (str((i + 1) % len(KEYWORDS)),))
+    return KEYWORDS[i]
+
+
+def _kw_stat(conn, kw, now):
+    """(chiamate, offerte, {pagina: offerte}) di kw, decaduti fino a now."""
+    row = conn.execute("SELECT calls, deals, page_hits, updated FROM kw_stats WHERE kw = ?", (kw,)).fetchone()
+    if not row:
+        return 0.0, 0.0, {}
+    f = 0.5 ** (max(0.0, now - row[3]) / (KEYWORD_HALF_LIFE_HOURS * 3600))
+    return row[0] * f, row[1] * f, {int(p): n * f for p, n in json.loads(row[2]).items()}
+
+
+def _pages_for(calls, deals, page_hits):
+    # servono almeno 3 offerte per stimare la profondità; senza offerte dopo 20 chiamate metà pagine
+    if deals >= 3:
+        covered, depth = 0.0, PAGES
+        for page in sorted(page_hits):
+            covered += page_hits[page]
+            if covered >= KEYWORD_DEPTH_COVERAGE * deals:
+                depth = page
+                break
+        # una pagina oltre l'ultima utile, per accorgersi se le offerte si spostano più in fondo
+        return max(KEYWORD_MIN_PAGES, min(PAGES, depth + 1))
+    if calls >= 20:
+        return max(KEYWORD_MIN_PAGES, PAGES // 2)
+    return PAGES
+
+
+def keyword_pages(kw):
+    """Pagine searchItems da scansionare per kw (sempre PAGES col round robin)."""
+    if KEYWORD_SELECTOR != "bandit":
+        return PAGES
+    return _pages_for(*_kw_stat(_db(), kw, time.time()))
+
+
+def _bandit_pick(rng=random):
+    if rng.random() < KEYWORD_EXPLORE:
+        return rng.choice(KEYWORDS)
+    conn, now = _db(), time.time()
+    best, best_p = KEYWORDS[0], -1.0
+    for kw in KEYWORDS:
+        calls, deals, _ = _kw_stat(conn, kw, now)
+        # probabilità di offerta per chiamata ~ Beta(1 + offerte, 1 + chiamate a vuoto)
+        p = rng.betavariate(1 + deals, 1 + max(0.0, calls - deals))
+        if p > best_p:
+            best, best_p = kw, p
+    return best
+
+
+def record_keyword_outcome(kw, calls, found_page=None):
+    """Aggiorna le statistiche del bandit dopo la scansione di kw."""
+    now = time.time()
+    with _db_tx() as conn:
+        c, d, hits = _kw_stat(conn, kw, now)
+        c += calls
+        if found_page:
+            d += 1
+            hits[found_page] = hits.get(found_page, 0.0) + 1
+        conn.execute(
+            "INSERT OR REPLACE INTO kw_stats (kw, calls, deals, page_hits, updated) VALUES (?, ?, ?, ?, ?)",
+            (kw, c, d, json.dumps({str(p): round(n, 4) for p, n in hits.items()}), now),
+        )
 
 
-def pick_keyword():
-    i = get_kw_index()
-    kw = KEYWORDS[i]
-    bump_kw_index()
-    return kw
+def keyword_stats():
+    """Statistiche per keyword (decadute ad adesso), per /status/keywords."""
+    conn, now = _db(), time.time()
+    out = []
+    for kw in KEYWORDS:
+        calls, deals, hits = _kw_stat(conn, kw, now)
+        out.append({
+            "keyword": kw,
+            "calls": round(calls, 2),
+            "deals": round(deals, 2),
+            "deals_per_call": round(deals / calls, 3) if calls else None,
+            "pages": _pages_for(calls, deals, hits),
+            "page_hits": {p: round(n, 2) for p, n in sorted(hits.items())},
+        })
+    return out
 
 
 # ============================================================
@@ -283,6 +1467,14 @@ def pick_keyword():
 _token_lock = threading.Lock()
 _access_token = None
 _token_expiry_epoch = 0
+_token_lifetime = 0  # expires_in dell'ultimo token (0 = sconosciuto)
+
+
+def _token_margin(margin):
+    """margin, ridotto a metà della durata del token se questo vive meno di 2*margin."""
+    if _token_lifetime > 0:
+        return min(margin, _token_lifetime / 2)
+    return margin
 
 
 def _build_token_url():
@@ -294,78 +1486,431 @@ def _build_token_url():
     return f"https://creatorsapi.auth.{CREATORS_AUTH_REGION}.amazoncognito.com/oauth2/token"
 
 
-def _get_access_token():
-    global _access_token, _token_expiry_epoch
+_token_stats = {
+    "refresh_ok": 0,
+    "refresh_fail": 0,
+    "last_latency_s": None,
+    "last_refresh_epoch": None,
+    "last_error": None,
+    "loaded_from_disk": False,
+}
+_token_refresher_started = False
 
-    with _token_lock:
-        now = time.time()
-        # refresh 60s prima della scadenza
-        if _access_token and now < (_token_expiry_epoch - 60):
-            return _access_token
 
-        token_url = _build_token_url()
-        basic = base64.b64encode(
-            f"{CREATORS_CREDENTIAL_ID}:{CREATORS_CREDENTIAL_SECRET}".encode("utf-8")
-        ).decode("utf-8")
+def _token_cred_fingerprint():
+    # il token salvato vale solo per le stesse credenziali
+    raw = f"{CREATORS_CREDENTIAL_ID}:{CREATORS_CREDENTIAL_SECRET}:{CREATORS_CREDENTIAL_VERSION}:{_build_token_url()}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
 
-        data = "grant_type=client_credentials&scope=creatorsapi/default"
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded",
-            "Authorization": f"Basic {basic}",
-        }
 
+def _load_persisted_token_locked():
+    global _access_token, _token_expiry_epoch, _token_lifetime
+    if not TOKEN_PERSIST:
+        return
+    try:
+        with open(TOKEN_FILE, "r", encoding="utf-8") as f:
+            j = json.load(f)
+    except:
+        return
+    if j.get("cred") != _token_cred_fingerprint():
+        return
+    lifetime = float(j.get("lifetime") or 0)
+    margin = min(60, lifetime / 2) if lifetime > 0 else 60
+    if j.get("access_token") and time.time() < float(j.get("expires_at", 0)) - margin:
+        _access_token = j["access_token"]
+        _token_expiry_epoch = float(j["expires_at"])
+        _token_lifetime = lifetime
+        _token_stats["loaded_from_disk"] = True
         if DEBUG_AMAZON:
-            print(f"[DEBUG] Token refresh -> {token_url}")
+            print(f"[DEBUG] Token da disco (scade tra {int(_token_expiry_epoch - time.time())}s)")
 
-        r = requests.post(token_url, headers=headers, data=data, timeout=20)
-        if r.status_code != 200:
-            raise RuntimeError(f"Token error {r.status_code}: {r.text}")
 
-        j = r.json()
-        _access_token = j.get("access_token")
-        expires_in = int(j.get("expires_in", 3600) or 3600)
-        _token_expiry_epoch = time.time() + expires_in
+def _persist_token_locked():
+    if not TOKEN_PERSIST:
+        return
+    try:
+        ensure_data_dir()
+        # temporaneo univoco (mkstemp, già 0600): due worker che rinnovano insieme non si
+        # sovrascrivono il file a metà
+        record = {
+            "cred": _token_cred_fingerprint(),
+            "access_token": _access_token,
+            "expires_at": _token_expiry_epoch,
+            "lifetime": _token_lifetime,
+        }
+        _replace_file(TOKEN_FILE, lambda f: json.dump(record, f))
+    except Exception as e:
+        print(f"⚠️ Salvataggio token fallito: {e}")
 
-        if DEBUG_AMAZON:
-            print(f"[DEBUG] Token OK (expires_in={expires_in}s)")
 
-        return _access_token
+class TokenError(RuntimeError):
+    """Risposta non 200 dall'endpoint token Cognito (status in .status)."""
 
+    def __init__(self, status, text):
+        super().__init__(f"Token error {status}: {text}")
+        self.status = status
 
-def _auth_header():
-    # Da guida: Authorization: Bearer <token>, Version <version>
-    token = _get_access_token()
-    return f"Bearer {token}, Version {CREATORS_CREDENTIAL_VERSION}"
 
+def _refresh_token_locked():
+    global _access_token, _token_expiry_epoch, _token_lifetime
 
-def _creators_post(path, payload):
-    url = f"{CREATORS_API_BASE}/{path.lstrip('/')}"
+    token_url = _build_token_url()
+    basic = base64.b64encode(
+        f"{CREATORS_CREDENTIAL_ID}:{CREATORS_CREDENTIAL_SECRET}".encode("utf-8")
+    ).decode("utf-8")
+
+    data = "grant_type=client_credentials&scope=creatorsapi/default"
     headers = {
-        "Authorization": _auth_header(),
-        "Content-Type": "application/json",
-        "x-marketplace": CREATORS_MARKETPLACE,
+        "Content-Type": "application/x-www-form-urlencoded",
+        "Authorization": f"Basic {basic}",
     }
-    r = requests.post(url, headers=headers, json=payload, timeout=25)
-    if r.status_code == 200:
-        return r.json()
 
-    # Log super utile
-    raise RuntimeError(f"Creators API error {r.status_code}: {r.text}")
+    if DEBUG_AMAZON:
+        print(f"[DEBUG] Token refresh -> {token_url}")
 
+    t0 = time.perf_counter()
+    try:
+        with timed("bot_token_refresh_seconds"):
+            r = http_request("POST", token_url, endpoint="token", headers=headers, data=data)
+        if r.status_code != 200:
+            raise TokenError(r.status_code, r.text)
+        j = r.json()
+    except Exception as e:
+        _token_stats["refresh_fail"] += 1
+        _token_stats["last_error"] = str(e)[:300]
+        _token_stats["last_latency_s"] = round(time.perf_counter() - t0, 3)
+        raise
+
+    _access_token = j.get("access_token")
+    expires_in = int(j.get("expires_in", 3600) or 3600)
+    _token_expiry_epoch = time.time() + expires_in
+    _token_lifetime = expires_in
+
+    _token_stats["refresh_ok"] += 1
+    _token_stats["last_error"] = None
+    _token_stats["last_latency_s"] = round(time.perf_counter() - t0, 3)
+    _token_stats["last_refresh_epoch"] = time.time()
+    _persist_token_locked()
 
-def _is_resources_validation_error(err_text: str) -> bool:
-    t = (err_text or "").lower()
-    return ("validation error detected" in t) and ("'resources'" in t or "resources" in t)
+    if DEBUG_AMAZON:
+        print(f"[DEBUG] Token OK (expires_in={expires_in}s, {_token_stats['last_latency_s']}s)")
 
+    return _access_token
 
-# ============================================================
-# Creators API: searchItems / getItems con fallback resources
-# ============================================================
-SEARCH_RES_LEVELS = [
-    ["images.primary.large", "itemInfo.title", "offersV2.listings.price", "offersV2.listings.savings"],
-    ["images.primary.large", "itemInfo.title", "offersV2.listings.price"],
-    ["images.primary.large", "itemInfo.title"],
-]
+
+def _get_access_token():
+    # percorso veloce senza lock: non resta in coda dietro a un refresh in background
+    token, expiry = _access_token, _token_expiry_epoch
+    if token and time.time() < expiry - _token_margin(60):
+        return token
+
+    with _token_lock:
+        if _access_token is None:
+            _load_persisted_token_locked()
+        # refresh 60s prima della scadenza (di norma ci pensa già il refresher in background)
+        if _access_token and time.time() < (_token_expiry_epoch - _token_margin(60)):
+            return _access_token
+        return _refresh_token_locked()
+
+
+def token_stats():
+    with _token_lock:
+        stats = dict(_token_stats)
+        stats["expires_in_s"] = int(_token_expiry_epoch - time.time()) if _access_token else None
+    return stats
+
+
+def _token_refresher_loop():
+    while True:
+        with _token_lock:
+            if _access_token is None:
+                _load_persisted_token_locked()
+            due_in = _token_expiry_epoch - _token_margin(TOKEN_REFRESH_MARGIN) - time.time()
+        if due_in > 0:
+            time.sleep(min(due_in, 300))
+            continue
+        try:
+            with _token_lock:
+                if time.time() >= _token_expiry_epoch - _token_margin(TOKEN_REFRESH_MARGIN):
+                    _refresh_token_locked()
+        except Exception as e:
+            print(f"⚠️ Token refresh in background fallito: {e}")
+            time.sleep(30)
+            continue
+        # anche se il token dura meno del margine non si martella Cognito
+        time.sleep(TOKEN_REFRESH_MIN_INTERVAL)
+
+
+def start_token_refresher():
+    global _token_refresher_started
+    if not (CREATORS_CREDENTIAL_ID and CREATORS_CREDENTIAL_SECRET):
+        return
+    with _token_lock:
+        if _token_refresher_started:
+            return
+        _token_refresher_started = True
+    threading.Thread(target=_token_refresher_loop, daemon=True).start()
+
+
+def _auth_header():
+    # Da guida: Authorization: Bearer <token>, Version <version>
+    token = _get_access_token()
+    return f"Bearer {token}, Version {CREATORS_CREDENTIAL_VERSION}"
+
+
+# ============================================================
+# Creators API: limite di richieste (token bucket) e circuit breaker
+# ============================================================
+class CreatorsUnavailable(RuntimeError):
+    """Chiamata non partita: breaker aperto, quota giornaliera finita o attesa troppo lunga."""
+
+
+_rl_lock = threading.Lock()
+_rl = {
+    "tokens": CREATORS_BURST,
+    "last": time.monotonic(),
+    "factor": 1.0,  # ritmo corrente rispetto a CREATORS_TPS (giù coi 429, su coi successi)
+    "blocked_until": 0.0,  # monotonic: niente chiamate prima (Retry-After)
+    "day": None,
+    "day_used": 0,
+}
+
+_breaker_lock = threading.Lock()
+_breaker = {
+    "state": "closed",  # closed | open | half_open
+    "failures": 0,
+    "opened_at": 0.0,
+    "open_for": BREAKER_OPEN_SECONDS,
+    "probe_inflight": False,
+    "last_error": None,
+}
+
+
+def _rate_refill_locked(now):
+    rate = CREATORS_TPS * _rl["factor"]
+    _rl["tokens"] = min(CREATORS_BURST, _rl["tokens"] + (now - _rl["last"]) * rate)
+    _rl["last"] = now
+    day = datetime.now(timezone.utc).date()
+    if _rl["day"] != day:
+        _rl["day"], _rl["day_used"] = day, 0
+    return rate
+
+
+def _rate_acquire():
+    """Prenota un token e attende il suo turno (o la fine del Retry-After)."""
+    with _rl_lock:
+        now = time.monotonic()
+        rate = _rate_refill_locked(now)
+        if CREATORS_TPD > 0 and _rl["day_used"] >= CREATORS_TPD:
+            metric_inc("bot_creators_calls_total", endpoint="any", outcome="rate_limited")
+            raise CreatorsUnavailable(f"quota giornaliera Creators esaurita ({CREATORS_TPD} richieste)")
+        wait = max(0.0, _rl["blocked_until"] - now)
+        if CREATORS_TPS > 0 and _rl["tokens"] < 1:
+            wait = max(wait, (1 - _rl["tokens"]) / rate)
+        if wait > CREATORS_MAX_WAIT:
+            metric_inc("bot_creators_calls_total", endpoint="any", outcome="rate_limited")
+            raise CreatorsUnavailable(f"rate limit Creators: servirebbero {wait:.1f}s di attesa")
+        if CREATORS_TPS > 0:
+            _rl["tokens"] -= 1  # può andare sotto zero: i chiamanti successivi si mettono in coda
+        _rl["day_used"] += 1
+    if wait > 0:
+        time.sleep(wait)
+
+
+def _rate_on_throttle(retry_after):
+    with _rl_lock:
+        now = time.monotonic()
+        _rate_refill_locked(now)
+        _rl["factor"] = max(0.05, _rl["factor"] / 2)
+        _rl["blocked_until"] = max(_rl["blocked_until"], now + retry_after)
+        _rl["tokens"] = min(_rl["tokens"], 0.0)
+
+
+def _rate_on_success():
+    with _rl_lock:
+        if _rl["factor"] < 1.0:
+            _rate_refill_locked(time.monotonic())
+            _rl["factor"] = min(1.0, _rl["factor"] + 0.05)
+
+
+def _parse_retry_after(value, default=None):
+    """Secondi da un header Retry-After (numero o data HTTP)."""
+    default = HTTP_BACKOFF_MAX if default is None else default
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+def _breaker_before():
+    """Solleva CreatorsUnavailable se il breaker blocca; in half-open lascia passare una prova."""
+    with _breaker_lock:
+        b = _breaker
+        if b["state"] == "closed":
+            return
+        now = time.monotonic()
+        if b["state"] == "open" and now - b["opened_at"] >= b["open_for"]:
+            b["state"], b["probe_inflight"] = "half_open", False
+        if b["state"] == "half_open" and not b["probe_inflight"]:
+            b["probe_inflight"] = True
+            return
+        state, retry_in, last_error = b["state"], max(0.0, b["opened_at"] + b["open_for"] - now), b["last_error"]
+    metric_inc("bot_creators_calls_total", endpoint="any", outcome="short_circuit")
+    raise CreatorsUnavailable(f"Creators API sospesa (breaker {state}, riprova tra {retry_in:.0f}s): {last_error}")
+
+
+def _breaker_record(outcome, err=None, min_open=0.0):
+    """outcome: "ok" chiude, "fail" conta verso l'apertura, "neutral" libera solo la prova."""
+    with _breaker_lock:
+        b = _breaker
+        if outcome == "neutral":
+            if b["state"] == "half_open":
+                b["probe_inflight"] = False
+            return
+        if outcome == "ok":
+            if b["state"] != "closed":
+                print("✅ Creators API di nuovo raggiungibile: breaker chiuso")
+            b.update(state="closed", failures=0, open_for=BREAKER_OPEN_SECONDS, probe_inflight=False)
+            return
+
+        b["failures"] += 1
+        b["last_error"] = (err or "")[:300]
+        if b["state"] == "half_open":
+            b["open_for"] = min(BREAKER_OPEN_MAX, b["open_for"] * 2)
+        elif b["state"] != "closed" or b["failures"] < BREAKER_FAILURES:
+            return
+        b["open_for"] = max(b["open_for"], min(min_open, BREAKER_OPEN_MAX))
+        b.update(state="open", opened_at=time.monotonic(), probe_inflight=False)
+        print(f"⛔ Creators API: breaker aperto per {b['open_for']:.0f}s dopo {b['failures']} errori ({b['last_error']})")
+
+
+def creators_available():
+    """(True, 0) se una chiamata può partire adesso, altrimenti (False, secondi alla prossima prova)."""
+    with _breaker_lock:
+        b = _breaker
+        if b["state"] == "closed" or (b["state"] == "half_open" and not b["probe_inflight"]):
+            return True, 0.0
+        retry_in = b["opened_at"] + b["open_for"] - time.monotonic()
+        if b["state"] == "open" and retry_in <= 0:
+            return True, 0.0
+        return False, max(1.0, retry_in)
+
+
+def creators_status():
+    """Stato di breaker e quota (per /status/creators e le metriche)."""
+    with _rl_lock:
+        now = time.monotonic()
+        _rate_refill_locked(now)
+        rl = {
+            "rate_factor": round(_rl["factor"], 3),
+            "tps_effective": round(CREATORS_TPS * _rl["factor"], 3),
+            "tokens": round(max(0.0, _rl["tokens"]), 2),
+            "blocked_for_s": round(max(0.0, _rl["blocked_until"] - now), 1),
+            "daily_used": _rl["day_used"],
+            "daily_remaining": max(0, CREATORS_TPD - _rl["day_used"]) if CREATORS_TPD > 0 else None,
+        }
+    with _breaker_lock:
+        b = _breaker
+        retry_in = max(0.0, b["opened_at"] + b["open_for"] - now) if b["state"] == "open" else 0.0
+        br = {
+            "breaker": b["state"],
+            "failures": b["failures"],
+            "retry_in_s": round(retry_in, 1),
+            "open_for_s": b["open_for"],
+            "last_error": b["last_error"],
+        }
+    return {**br, **rl}
+
+
+def _creators_post(path, payload):
+    url = f"{CREATORS_API_BASE}/{path.lstrip('/')}"
+    endpoint = path.strip("/")
+    attempt = 0  # nuovi tentativi dopo un 429
+    transient = 0  # nuovi tentativi dopo 5xx / errori di rete
+    while True:
+        _breaker_before()
+        outcome, err, retry_after = "neutral", None, 0.0
+        r, net_err = None, None
+        try:
+            try:
+                authorization = _auth_header()
+            except (requests.ConnectionError, requests.Timeout, TokenError) as e:
+                # Cognito giù o lento: conta come errore dell'API, così il breaker si apre e le
+                # pagine successive non ripartono ognuna con i retry sull'endpoint token
+                if not isinstance(e, TokenError) or e.status >= 500:
+                    outcome, err = "fail", f"token: {type(e).__name__}: {e}"
+                metric_inc("bot_creators_calls_total", endpoint=endpoint, outcome="token_error")
+                raise
+            headers = {
+                "Authorization": authorization,
+                "Content-Type": "application/json",
+                "x-marketplace": CREATORS_MARKETPLACE,
+            }
+            # un token e un'unità di CREATORS_TPD per ogni richiesta che parte: i nuovi
+            # tentativi passano da questo ciclo (limiter e breaker), non da http_request
+            _rate_acquire()
+            try:
+                r = http_request("POST", url, endpoint="api", retries=0, headers=headers, json=payload)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                net_err = e
+                outcome, err = "fail", f"{type(e).__name__}: {e}"
+                metric_inc("bot_creators_calls_total", endpoint=endpoint, outcome="network")
+            else:
+                metric_inc("bot_creators_calls_total", endpoint=endpoint, outcome=str(r.status_code))
+                if r.status_code == 429:
+                    retry_after = _parse_retry_after(r.headers.get("Retry-After"))
+                    _rate_on_throttle(retry_after)
+                    outcome, err = "fail", f"HTTP 429 (Retry-After {retry_after:.0f}s)"
+                elif r.status_code >= 500:
+                    outcome, err = "fail", f"HTTP {r.status_code}"
+                else:
+                    # anche un 4xx dice che l'API risponde
+                    outcome = "ok"
+        finally:
+            _breaker_record(outcome, err, min_open=retry_after)
+
+        if net_err is not None or r.status_code >= 500:
+            if transient < HTTP_RETRIES:
+                delay = http_backoff(transient)
+                transient += 1
+                if DEBUG_AMAZON:
+                    print(f"[DEBUG] {endpoint} retry {transient}/{HTTP_RETRIES} in {delay:.2f}s ({err})")
+                time.sleep(delay)
+                continue
+            if net_err is not None:
+                raise net_err
+        elif r.status_code == 200:
+            _rate_on_success()
+            return r.json()
+        elif r.status_code == 429 and attempt < CREATORS_429_RETRIES and retry_after <= CREATORS_MAX_WAIT:
+            attempt += 1
+            if DEBUG_AMAZON:
+                print(f"[DEBUG] {endpoint} 429: nuovo tentativo dopo {retry_after:.1f}s")
+            continue
+
+        # Log super utile
+        raise RuntimeError(f"Creators API error {r.status_code}: {r.text}")
+
+
+def _is_resources_validation_error(err_text: str) -> bool:
+    t = (err_text or "").lower()
+    return ("validation error detected" in t) and ("'resources'" in t or "resources" in t)
+
+
+# ============================================================
+# Creators API: searchItems / getItems con fallback resources
+# ============================================================
+SEARCH_RES_LEVELS = [
+    ["images.primary.large", "itemInfo.title", "offersV2.listings.price", "offersV2.listings.savings"],
+    ["images.primary.large", "itemInfo.title", "offersV2.listings.price"],
+    ["images.primary.large", "itemInfo.title"],
+]
 
 GET_RES_LEVELS = [
     [
@@ -381,35 +1926,84 @@ GET_RES_LEVELS = [
 ]
 
 
-def creators_search_items(kw, page):
-    last_err = None
-    used_resources = None
+# Livello di resources accettato, per non ripartire ogni volta da L1:
+# { "searchItems|www.amazon.it|2.2": {"level": 1, "probed_at": epoch} } (level 0-based)
+_res_levels_lock = threading.Lock()
+_res_levels = None
 
-    for level, resources in enumerate(SEARCH_RES_LEVELS, start=1):
-        payload = {
-            "keywords": kw,
-            "partnerTag": AMAZON_ASSOCIATE_TAG,
-            "marketplace": CREATORS_MARKETPLACE,
-            "searchIndex": SEARCH_INDEX,
-            "itemCount": ITEMS_PER_PAGE,
-            "itemPage": page,
-            "resources": resources,
-        }
 
+def _res_levels_key(endpoint):
+    return f"{endpoint}|{CREATORS_MARKETPLACE}|{CREATORS_CREDENTIAL_VERSION}"
+
+
+def _res_levels_load():
+    global _res_levels
+    if _res_levels is None:
+        try:
+            with open(RES_LEVELS_FILE, "r", encoding="utf-8") as f:
+                _res_levels = json.load(f)
+        except:
+            _res_levels = {}
+    return _res_levels
+
+
+def _res_start_level(endpoint):
+    """Livello da cui partire: quello ricordato, o 0 se è ora di riprovare i livelli più ricchi."""
+    with _res_levels_lock:
+        e = _res_levels_load().get(_res_levels_key(endpoint))
+    if not e:
+        return 0
+    level = int(e.get("level", 0))
+    if level > 0 and time.time() - e.get("probed_at", 0) > RES_LEVEL_REPROBE_SECONDS:
+        return 0
+    return level
+
+
+def _res_record_level(endpoint, level, probed):
+    """
+    Salva il livello accettato; probed=True se la chiamata è partita da L1 (probe completo).
+    Su disco si scrive solo se il livello cambia o se un riprobe da un livello ridotto è
+    andato a buon fine (riparte il timer): le chiamate normali non toccano il file.
+    """
+    key = _res_levels_key(endpoint)
+    with _res_levels_lock:
+        levels = _res_levels_load()
+        e = levels.get(key)
+        if e and e.get("level") == level and not (probed and level > 0):
+            return
+        probed_at = time.time() if (probed or not e) else e.get("probed_at", time.time())
+        levels[key] = {"level": level, "probed_at": probed_at}
+        try:
+            ensure_data_dir()
+            _replace_file(RES_LEVELS_FILE, lambda f: json.dump(levels, f))
+        except Exception as e:
+            print(f"⚠️ Salvataggio res_levels fallito: {e}")
+
+
+def _creators_call_with_levels(endpoint, res_levels, build_payload, label):
+    start = _res_start_level(endpoint)
+    if start >= len(res_levels):
+        start = 0
+
+    last_err = None
+    for idx in range(start, len(res_levels)):
+        resources = res_levels[idx]
+        payload = build_payload(resources)
         try:
             if DEBUG_AMAZON:
-                print(f"[DEBUG] SearchItems try L{level} resources={resources}")
-            j = _creators_post("searchItems", payload)
-            used_resources = resources
-            return j, used_resources
+                print(f"[DEBUG] {label} try L{idx + 1} resources={resources}")
+            j = _creators_post(endpoint, payload)
+            _res_record_level(endpoint, idx, probed=(start == 0))
+            return j, resources
         except Exception as e:
             last_err = e
             msg = str(e)
             if DEBUG_AMAZON:
-                print(f"[DEBUG] SearchItems L{level} rejected -> {msg[:180]}")
+                print(f"[DEBUG] {label} L{idx + 1} rejected -> {msg[:180]}")
 
             # Se è un errore di validazione sui resources, fallback al prossimo livello
             if _is_resources_validation_error(msg):
+                metric_inc("bot_resource_fallbacks_total", endpoint=endpoint, level=idx + 1)
                 continue
 
             # Altri errori: non insistere troppo
@@ -419,33 +2013,31 @@ def creators_search_items(kw, page):
     raise last_err
 
 
-def creators_get_items(asins):
-    last_err = None
-    used_resources = None
+def creators_search_items(kw, page):
+    def build_payload(resources):
+        return {
+            "keywords": kw,
+            "partnerTag": AMAZON_ASSOCIATE_TAG,
+            "marketplace": CREATORS_MARKETPLACE,
+            "searchIndex": SEARCH_INDEX,
+            "itemCount": ITEMS_PER_PAGE,
+            "itemPage": page,
+            "resources": resources,
+        }
+
+    return _creators_call_with_levels("searchItems", SEARCH_RES_LEVELS, build_payload, "SearchItems")
 
-    for level, resources in enumerate(GET_RES_LEVELS, start=1):
-        payload = {
+
+def creators_get_items(asins):
+    def build_payload(resources):
+        return {
             "itemIds": asins,
             "partnerTag": AMAZON_ASSOCIATE_TAG,
             "marketplace": CREATORS_MARKETPLACE,
             "resources": resources,
         }
-        try:
-            if DEBUG_AMAZON:
-                print(f"[DEBUG] GetItems try L{level} resources={resources} asins={asins}")
-            j = _creators_post("getItems", payload)
-            used_resources = resources
-            return j, used_resources
-        except Exception as e:
-            last_err = e
-            msg = str(e)
-            if DEBUG_AMAZON:
-                print(f"[DEBUG] GetItems L{level} rejected -> {msg[:180]}")
-            if _is_resources_validation_error(msg):
-                continue
-            raise
 
-    raise last_err
+    return _creators_call_with_levels("getItems", GET_RES_LEVELS, build_payload, f"GetItems asins={asins}")
 
 
 # ============================================================
@@ -539,12 +2131,6 @@ def extract_from_item(item: dict):
             if sv is not None:
                 old_val = price_val + sv
 
-    # ✅ filtro premium: risparmio minimo in euro
-        if price_val is not None and old_val is not None and old_val > price_val:
-            saving_eur = old_val - price_val
-            if saving_eur < MIN_SAVING_EUR:
-                return None  # oppure: continue (dipende dalla tua funzione)
-
     # URL fallback
     if not url and asin:
         url = f"https://www.amazon.it/dp/{asin}?tag={AMAZON_ASSOCIATE_TAG}"
@@ -562,123 +2148,718 @@ def extract_from_item(item: dict):
 
 
 # ============================================================
-# Core: trova prima offerta valida
+# Cache searchItems: LRU in memoria + livello opzionale su disco
 # ============================================================
-def _first_valid_item_for_keyword(kw, pubblicati):
-    reasons = Counter()
-    asin_candidates = []
+_search_cache_lock = threading.Lock()
+_search_cache = OrderedDict()  # key -> (ts, resources, json)
+_search_cache_stats = Counter()
+
 
-    for page in range(1, PAGES + 1):
+def _search_cache_key(kw, page, resources):
+    raw = json.dumps(
+        [kw, page, SEARCH_INDEX, ITEMS_PER_PAGE, CREATORS_MARKETPLACE, list(resources)],
+        ensure_ascii=False,
+    )
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def _search_cache_sweep_disk():
+    cutoff = time.time() - SEARCH_CACHE_TTL
+    for name in os.listdir(SEARCH_CACHE_DIR):
+        path = os.path.join(SEARCH_CACHE_DIR, name)
         try:
-            j, used_res = creators_search_items(kw, page)
-            # response shape: { "searchResult": { "items": [...] } } oppure { "items": [...] }
-            items = safe_get(j, "searchResult", "items", default=None)
-            if items is None:
-                items = j.get("items", []) or []
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
 
-            if DEBUG_AMAZON:
-                print(f"[DEBUG] kw={kw} page={page} items={len(items)} used_resources={used_res}")
-                print(f"[DEBUG] searchItems raw keys: {list(j.keys())}")
-                if items:
-                    prev = items[0]
-                    print(f"[DEBUG] searchItems raw preview: {json.dumps(prev)[:550]}")
 
+def search_cache_get(kw, page):
+    """(json, resources) se la pagina è in cache e non scaduta, altrimenti None."""
+    if SEARCH_CACHE_TTL <= 0:
+        return None
+
+    resources = SEARCH_RES_LEVELS[min(_res_start_level("searchItems"), len(SEARCH_RES_LEVELS) - 1)]
+    key = _search_cache_key(kw, page, resources)
+    now = time.time()
+
+    with _search_cache_lock:
+        hit = _search_cache.get(key)
+        if hit and now - hit[0] < SEARCH_CACHE_TTL:
+            _search_cache.move_to_end(key)
+            _search_cache_stats["hit_mem"] += 1
+            return hit[2], hit[1]
+        if hit:
+            del _search_cache[key]
+
+    if SEARCH_CACHE_DISK:
+        try:
+            with open(os.path.join(SEARCH_CACHE_DIR, key + ".json"), "r", encoding="utf-8") as f:
+                rec = json.load(f)
+            if now - rec["ts"] < SEARCH_CACHE_TTL:
+                with _search_cache_lock:
+                    _search_cache[key] = (rec["ts"], rec["resources"], rec["data"])
+                    while len(_search_cache) > SEARCH_CACHE_MAX:
+                        _search_cache.popitem(last=False)
+                    _search_cache_stats["hit_disk"] += 1
+                return rec["data"], rec["resources"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    with _search_cache_lock:
+        _search_cache_stats["miss"] += 1
+    return None
+
+
+def search_cache_put(kw, page, resources, j):
+    if SEARCH_CACHE_TTL <= 0:
+        return
+
+    key = _search_cache_key(kw, page, resources)
+    now = time.time()
+    with _search_cache_lock:
+        _search_cache[key] = (now, resources, j)
+        _search_cache.move_to_end(key)
+        while len(_search_cache) > SEARCH_CACHE_MAX:
+            _search_cache.popitem(last=False)
+        _search_cache_stats["store"] += 1
+        sweep = _search_cache_stats["store"] % 50 == 0
+
+    if SEARCH_CACHE_DISK:
+        try:
+            Path(SEARCH_CACHE_DIR).mkdir(parents=True, exist_ok=True)
+            path = os.path.join(SEARCH_CACHE_DIR, key + ".json")
+            _replace_file(path, lambda f: json.dump({"ts": now, "resources": resources, "data": j}, f))
+            if sweep:
+                _search_cache_sweep_disk()
         except Exception as e:
-            reasons["api_error"] += 1
-            print(f"❌ Creators searchItems error (kw='{kw}', page={page}): {e}")
-            continue
+            print(f"⚠️ Search cache su disco non scritta: {e}")
+
+
+def search_cache_stats():
+    with _search_cache_lock:
+        stats = dict(_search_cache_stats)
+        stats["entries_mem"] = len(_search_cache)
+    hits = stats.get("hit_mem", 0) + stats.get("hit_disk", 0)
+    lookups = hits + stats.get("miss", 0)
+    stats["hit_rate"] = round(hits / lookups, 3) if lookups else 0.0
+    return stats
+
+
+# ============================================================
+# Cache negativa (ASIN scartati, in memoria)
+# ============================================================
+# Motivi di _reject_reason legati al prezzo; "no_offer" (GetItems senza prezzo/sconto) e
+# "not_returned" (GetItems non restituisce l'item) sono strutturali.
+# "no_price_or_disc_in_searchitems" non si mette in cache: lo decide GetItems.
+_NEG_PRICE_REASONS = {"price_out_range", "disc_too_low", "saving_too_low"}
+_NEG_STRUCTURAL_REASONS = {"no_offer", "not_returned"}
+
+_neg_lock = threading.Lock()
+_neg_cache = OrderedDict()  # asin -> (motivo, scadenza epoch), in ordine di inserimento
+_neg_stats = Counter()
+
+
+def _neg_ttl(reason):
+    if reason in _NEG_PRICE_REASONS:
+        return NEG_CACHE_TTL_PRICE
+    if reason in _NEG_STRUCTURAL_REASONS:
+        return NEG_CACHE_TTL_STRUCTURAL
+    return 0
+
+
+def neg_cache_get(asin, where):
+    """Motivo dello scarto se asin è in cache negativa e non scaduto, altrimenti None."""
+    # cache spenta: niente lock né contatori nel percorso caldo della scansione
+    if not asin or (NEG_CACHE_TTL_PRICE <= 0 and NEG_CACHE_TTL_STRUCTURAL <= 0):
+        return None
+    now = time.time()
+    with _neg_lock:
+        hit = _neg_cache.get(asin)
+        if hit and hit[1] <= now:
+            del _neg_cache[asin]
+            hit = None
+        result = "hit" if hit else "miss"
+        _neg_stats[result] += 1
+        _neg_stats[f"{result}_{where}"] += 1
+    metric_inc("bot_negative_cache_total", where=where, result=result)
+    return hit[0] if hit else None
+
+
+def neg_cache_put_many(pairs):
+    """pairs: [(asin, motivo)]; i motivi senza TTL vengono ignorati."""
+    now = time.time()
+    with _neg_lock:
+        for asin, reason in pairs:
+            ttl = _neg_ttl(reason)
+            if not asin or ttl <= 0:
+                continue
+            _neg_cache.pop(asin, None)
+            _neg_cache[asin] = (reason, now + ttl)
+        while len(_neg_cache) > NEG_CACHE_MAX:
+            _neg_cache.popitem(last=False)
+
+
+def negative_cache_stats():
+    with _neg_lock:
+        stats = dict(_neg_stats)
+        stats["entries"] = len(_neg_cache)
+        stats["by_reason"] = dict(Counter(reason for reason, _ in _neg_cache.values()))
+    lookups = stats.get("hit", 0) + stats.get("miss", 0)
+    stats["hit_rate"] = round(stats.get("hit", 0) / lookups, 3) if lookups else 0.0
+    return stats
+
+
+# ============================================================
+# Storico prezzi (DATA_DIR/price_history.bin)
+# ============================================================
+# Record da 18 byte: asin (10 byte ASCII), epoch (uint32), prezzo in centesimi (uint32).
+# In memoria per asin si tengono due pile monotone (minimi crescenti / massimi
+# decrescenti): il min/max su una finestra che finisce "adesso" è il primo elemento
+# con ts >= inizio finestra -> bisect, O(log n).
+_PH_REC = struct.Struct("<10sII")
+
+_ph_lock = threading.Lock()
+_ph_index = None
+_ph_compacting = False
+
+
+class _PriceSeries:
+    __slots__ = ("first_ts", "last_ts", "last_price", "min_ts", "min_p", "max_ts", "max_p")
+
+    def __init__(self, ts):
+        self.first_ts = ts
+        self.last_ts = 0
+        self.last_price = None
+        self.min_ts, self.min_p = [], []
+        self.max_ts, self.max_p = [], []
+
+    def add(self, ts, cents):
+        ts = max(ts, self.last_ts)  # append da più processi: mai indietro nel tempo
+        while self.min_p and self.min_p[-1] >= cents:
+            self.min_p.pop()
+            self.min_ts.pop()
+        self.min_ts.append(ts)
+        self.min_p.append(cents)
+        while self.max_p and self.max_p[-1] <= cents:
+            self.max_p.pop()
+            self.max_ts.pop()
+        self.max_ts.append(ts)
+        self.max_p.append(cents)
+        self.last_ts = ts
+        self.last_price = cents
+
+    def window(self, since_ts):
+        """(min, max) in centesimi dei prezzi visti da since_ts in poi, o None."""
+        i = bisect.bisect_left(self.min_ts, since_ts)
+        j = bisect.bisect_left(self.max_ts, since_ts)
+        if i >= len(self.min_p) or j >= len(self.max_p):
+            return None
+        return self.min_p[i], self.max_p[j]
 
-        for item in items:
-            parsed = extract_from_item(item)
+
+def _ph_load_locked():
+    global _ph_index
+    if _ph_index is not None:
+        return _ph_index
+
+    _ph_index = {}
+    try:
+        with open(PRICE_HISTORY_FILE, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            usable = size - size % _PH_REC.size
+            if usable:
+                # memoryview: i record si leggono dalla mappatura senza copiare il file in un bytes
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view, \
+                        view[:usable] as records:
+                    for raw_asin, ts, cents in _PH_REC.iter_unpack(records):
+                        asin = raw_asin.rstrip(b"\0").decode("ascii", "replace")
+                        series = _ph_index.get(asin)
+                        if series is None:
+                            series = _ph_index[asin] = _PriceSeries(ts)
+                        series.add(ts, cents)
+        if usable != size:
+            # coda scritta a metà (crash): si riparte dall'ultimo record completo
+            with open(PRICE_HISTORY_FILE, "r+b") as f:
+                f.truncate(usable)
+    except FileNotFoundError:
+        pass
+    return _ph_index
+
+
+def record_prices(parsed_list, now=None):
+    """Registra in blocco i prezzi visti (una sola write); salta i prezzi invariati entro PRICE_HISTORY_MIN_GAP."""
+    now = int(now or time.time())
+    buf = []
+    with _ph_lock:
+        index = _ph_load_locked()
+        for parsed in parsed_list:
             asin = parsed["asin"]
-            if not asin:
-                reasons["no_asin"] += 1
+            price = parsed["price"]
+            if not asin or price is None or price <= 0:
                 continue
-            if asin in pubblicati or not can_post(asin, hours=24):
-                reasons["already_posted"] += 1
+            cents = int(round(price * 100))
+            series = index.get(asin)
+            if series is None:
+                series = index[asin] = _PriceSeries(now)
+            elif series.last_price == cents and now - series.last_ts < PRICE_HISTORY_MIN_GAP:
                 continue
+            series.add(now, cents)
+            buf.append(_PH_REC.pack(asin.encode("ascii", "replace")[:10], now, cents))
+
+        if buf:
+            ensure_data_dir()
+            with open(PRICE_HISTORY_FILE, "ab") as f:
+                f.write(b"".join(buf))
+                size = f.tell()
+            need_compact = size > PRICE_HISTORY_COMPACT_MB * 1024 * 1024
+        else:
+            need_compact = False
 
-            # Se searchItems non include abbastanza info, salva asin per getItems
-            if parsed["price"] is None or parsed["discount"] == 0:
-                reasons["no_price_or_disc_in_searchitems"] += 1
-                if len(asin_candidates) < GETITEMS_FALLBACK_MAX:
-                    asin_candidates.append(asin)
-                continue
+    if need_compact:
+        _maybe_compact_price_history()
+    return len(buf)
 
-            price_val = parsed["price"]
-            disc = parsed["discount"]
-            old_val = parsed["old"] if parsed["old"] else price_val
 
-            if price_val < MIN_PRICE or price_val > MAX_PRICE:
-                reasons["price_out_range"] += 1
-                continue
+def is_minimo_storico(asin, price, days=None):
+    """
+    True se price è il più basso visto negli ultimi days giorni (default MINIMO_DAYS),
+    il prezzo ha avuto almeno una variazione e lo storico copre MINIMO_MIN_DAYS giorni.
+    """
+    if price is None:
+        return False
+    days = days or MINIMO_DAYS
+    with _ph_lock:
+        series = _ph_load_locked().get(asin)
+        if series is None or time.time() - series.first_ts < MINIMO_MIN_DAYS * 86400:
+            return False
+        w = series.window(int(time.time() - days * 86400))
+    if w is None:
+        return False
+    cents = int(round(price * 100))
+    low, high = w
+    return cents <= low and high > cents
 
-            if disc < MIN_DISCOUNT:
-                reasons["disc_too_low"] += 1
-                continue
 
-            url_img = parsed["url_img"] or "https://m.media-amazon.com/images/I/71bhWgQK-cL._AC_SL1500_.jpg"
-            title = (parsed["title"] or "")[:80].strip()
-            if len(parsed["title"] or "") > 80:
-                title += "…"
+def _compact_price_history():
+    """Riscrive il file tenendo solo i record entro PRICE_HISTORY_DAYS e ricostruisce l'indice."""
+    global _ph_index, _ph_compacting
 
-            if DEBUG_AMAZON:
-                print(f"[DEBUG] FOUND via SearchItems asin={asin} price={price_val} old={old_val} disc={disc}")
-
-            return {
-                "asin": asin,
-                "title": title,
-                "price_new": price_val,
-                "price_old": old_val,
-                "discount": disc,
-                "url_img": url_img,
-                "url": parsed["url"],
-                "minimo": disc >= 30,
-            }
+    try:
+        cutoff = int(time.time() - PRICE_HISTORY_DAYS * 86400)
+        kept = 0
+
+        def write(dst):
+            nonlocal kept
+            with open(PRICE_HISTORY_FILE, "rb") as src:
+                size = os.fstat(src.fileno()).st_size
+                usable = size - size % _PH_REC.size
+                if usable:
+                    with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        out = []
+                        for off in range(0, usable, _PH_REC.size):
+                            rec = mm[off:off + _PH_REC.size]
+                            if _PH_REC.unpack(rec)[1] >= cutoff:
+                                out.append(rec)
+                        kept = len(out)
+                        dst.write(b"".join(out))
+            dst.flush()
+            os.fsync(dst.fileno())
+
+        with _ph_lock:
+            _replace_file(PRICE_HISTORY_FILE, write, binary=True)
+            _ph_index = None
+            _ph_load_locked()
+        if DEBUG_AMAZON:
+            print(f"[DEBUG] price_history compattato: {kept} record")
+    except Exception as e:
+        print(f"⚠️ Compattazione price_history fallita: {e}")
+    finally:
+        _ph_compacting = False
 
-    # Fallback getItems su pochi candidati (molto spesso qui arrivano old/savings meglio)
-    if asin_candidates:
+
+def _maybe_compact_price_history():
+    global _ph_compacting
+    with _ph_lock:
+        if _ph_compacting:
+            return
+        _ph_compacting = True
+    threading.Thread(target=_compact_price_history, daemon=True).start()
+
+
+# ============================================================
+# Core: trova prima offerta valida
+# ============================================================
+def _reject_reason(parsed):
+    """None se l'offerta passa i filtri prezzo/sconto/risparmio, altrimenti il motivo."""
+    if parsed["price"] is None or parsed["discount"] == 0:
+        return "no_price_or_disc_in_searchitems"
+    if parsed["price"] < MIN_PRICE or parsed["price"] > MAX_PRICE:
+        return "price_out_range"
+    if parsed["discount"] < MIN_DISCOUNT:
+        return "disc_too_low"
+    # ✅ filtro premium: risparmio minimo in euro
+    old = parsed["old"]
+    if old and old > parsed["price"] and old - parsed["price"] < MIN_SAVING_EUR:
+        return "saving_too_low"
+    return None
+
+
+def deal_score(parsed):
+    price = parsed["price"] or 0.0
+    saving = max((parsed["old"] or price) - price, 0.0)
+    if DEAL_SCORE == "saving":
+        return saving
+    if DEAL_SCORE == "blend":
+        return parsed["discount"] * math.log1p(saving)
+    return float(parsed["discount"])
+
+
+_np = None  # modulo numpy dopo il primo get_numpy(); False se non installato
+
+
+def get_numpy():
+    """numpy, importato al primo filtro; None se non installato (filtro per-item)."""
+    global _np
+    if _np is None:
         try:
-            j, used_res = creators_get_items(asin_candidates)
-            items = safe_get(j, "items", default=[]) or []
-            if DEBUG_AMAZON:
-                print(f"[DEBUG] GetItems fallback asins={asin_candidates} items={len(items)} used_resources={used_res}")
+            import numpy
+            _np = numpy
+        except ImportError:
+            _np = False
+    return _np or None
+
+
+def deal_columns(parsed_list):
+    """Colonne numpy di un lotto di item parsati (NaN dove il dato manca)."""
+    np = get_numpy()
+    n = len(parsed_list)
+    price = np.fromiter((np.nan if p["price"] is None else p["price"] for p in parsed_list), float, n)
+    old = np.fromiter((p["old"] or np.nan for p in parsed_list), float, n)
+    old = np.where(np.isnan(old), price, old)
+    return {
+        "price": price,
+        "old": old,
+        "discount": np.fromiter((p["discount"] for p in parsed_list), float, n),
+        "saving": old - price,
+        "has_offers": np.fromiter((p["has_offers"] for p in parsed_list), bool, n),
+    }
 
-            for item in items:
-                parsed = extract_from_item(item)
-                asin = parsed["asin"]
-                if not asin or asin in pubblicati or not can_post(asin, hours=24):
-                    continue
 
-                price_val = parsed["price"]
-                disc = parsed["discount"]
-                old_val = parsed["old"] if parsed["old"] else price_val
+def _filter_deals_python(parsed_list, ranked):
+    rejected = {}
+    ok = []
+    for i, parsed in enumerate(parsed_list):
+        reason = _reject_reason(parsed)
+        if reason:
+            rejected.setdefault(reason, []).append(i)
+        else:
+            ok.append(i)
+    if ranked:
+        ok.sort(key=lambda i: -deal_score(parsed_list[i]))
+    return ok, rejected
+
+
+def filter_deals(parsed_list, ranked=False):
+    """
+    Applica MIN_PRICE/MAX_PRICE/MIN_DISCOUNT/MIN_SAVING_EUR a un lotto intero.
+    Ritorna (indici validi, {motivo: [indici scartati]}): gli indici validi sono in
+    ordine originale, oppure per DEAL_SCORE decrescente se ranked (a parità, ordine originale).
+    Stessi motivi e stesso ordine dei controlli di _reject_reason.
+    """
+    np = get_numpy()
+    if np is None or not parsed_list:
+        return _filter_deals_python(parsed_list, ranked)
+
+    c = deal_columns(parsed_list)
+    price, disc, saving = c["price"], c["discount"], c["saving"]
+
+    left = np.ones(len(parsed_list), dtype=bool)
+    rejected = {}
+    with np.errstate(invalid="ignore"):
+        for reason, mask in (
+            ("no_price_or_disc_in_searchitems", np.isnan(price) | (disc == 0)),
+            ("price_out_range", (price < MIN_PRICE) | (price > MAX_PRICE)),
+            ("disc_too_low", disc < MIN_DISCOUNT),
+            ("saving_too_low", (saving > 0) & (saving < MIN_SAVING_EUR)),
+        ):
+            hit = left & mask
+            if hit.any():
+                rejected[reason] = np.flatnonzero(hit).tolist()
+                left &= ~hit
+
+    ok = np.flatnonzero(left)
+    if ranked and len(ok) > 1:
+        if DEAL_SCORE == "saving":
+            score = np.maximum(saving[ok], 0)
+        elif DEAL_SCORE == "blend":
+            score = disc[ok] * np.log1p(np.maximum(saving[ok], 0))
+        else:
+            score = disc[ok]
+        ok = ok[np.argsort(-score, kind="stable")]
+    return ok.tolist(), rejected
+
+
+def _deal_payload(parsed):
+    price_val = parsed["price"]
+    disc = parsed["discount"]
+    old_val = parsed["old"] if parsed["old"] else price_val
+
+    url_img = parsed["url_img"] or PLACEHOLDER_IMG_URL
+    title = (parsed["title"] or "")[:80].strip()
+    if len(parsed["title"] or "") > 80:
+        title += "…"
+
+    return {
+        "asin": parsed["asin"],
+        "title": title,
+        "price_new": price_val,
+        "price_old": old_val,
+        "discount": disc,
+        "url_img": url_img,
+        "url": parsed["url"],
+        "minimo": is_minimo_storico(parsed["asin"], price_val),
+    }
+
+
+def _getitems_parsed(asins):
+    # gli slot del batch vanno solo agli asin che possono ancora passare i filtri
+    asins = [a for a in asins if not neg_cache_get(a, "getitems")]
+    if not asins:
+        return []
+    with timed("bot_getitems_seconds"):
+        j, used_res = creators_get_items(asins)
+        items = safe_get(j, "items", default=[]) or []
+        trace_set(asins=len(asins), items=len(items))
+    if DEBUG_AMAZON:
+        print(f"[DEBUG] GetItems asins={asins} items={len(items)} used_resources={used_res}")
+    parsed_list = [extract_from_item(item) for item in items]
+    record_prices(parsed_list)
+
+    returned = {p["asin"] for p in parsed_list}
+    negatives = [(a, "not_returned") for a in asins if a not in returned]
+    for p in parsed_list:
+        reason = _reject_reason(p)
+        if reason:
+            negatives.append((p["asin"], "no_offer" if reason == "no_price_or_disc_in_searchitems" else reason))
+    neg_cache_put_many(negatives)
+    return parsed_list
+
+
+def _recheck_price(parsed):
+    """Riconferma con GetItems un'offerta trovata in una pagina searchItems presa dalla cache."""
+    for fresh in _getitems_parsed([parsed["asin"]]):
+        if fresh["asin"] == parsed["asin"]:
+            return fresh
+    return None
+
+
+def _fetch_search_page(kw, page):
+    """(items, from_cache) di una pagina searchItems."""
+    with trace_span("search_cache_lookup", page=page):
+        hit = search_cache_get(kw, page)
+        trace_set(hit=bool(hit))
+    if hit:
+        j, used_res = hit
+        from_cache = True
+    else:
+        with timed("bot_search_page_seconds", page=page):
+            j, used_res = creators_search_items(kw, page)
+            trace_set(resources=len(used_res), keyword=kw)
+        search_cache_put(kw, page, used_res, j)
+        from_cache = False
+
+    # response shape: { "searchResult": { "items": [...] } } oppure { "items": [...] }
+    items = safe_get(j, "searchResult", "items", default=None)
+    if items is None:
+        items = j.get("items", []) or []
+
+    if DEBUG_AMAZON:
+        print(f"[DEBUG] kw={kw} page={page} items={len(items)} used_resources={used_res} cache={from_cache}")
+        print(f"[DEBUG] searchItems raw keys: {list(j.keys())}")
+        if items:
+            prev = items[0]
+            print(f"[DEBUG] searchItems raw preview: {json.dumps(prev)[:550]}")
+
+    return items, from_cache
+
+
+def _iter_search_pages(kw, pages=None):
+    """
+    Genera (page, items, from_cache, errore) sempre in ordine di pagina.
+    Con PAGES_CONCURRENCY > 1 le richieste partono in parallelo: chiudendo il
+    generatore (offerta trovata) le pagine non ancora partite vengono annullate
+    e quelle in volo ignorate.
+    """
+    pages = pages or PAGES
+    if PAGES_CONCURRENCY <= 1 or pages <= 1:
+        for page in range(1, pages + 1):
+            try:
+                items, from_cache = _fetch_search_page(kw, page)
+                yield page, items, from_cache, None
+            except Exception as e:
+                yield page, None, False, e
+        return
+
+    pool = ThreadPoolExecutor(max_workers=min(PAGES_CONCURRENCY, pages), thread_name_prefix="search")
+    try:
+        futures = [submit_in_context(pool, _fetch_search_page, kw, page) for page in range(1, pages + 1)]
+        for page, fut in enumerate(futures, start=1):
+            try:
+                items, from_cache = fut.result()
+                yield page, items, from_cache, None
+            except Exception as e:
+                yield page, None, False, e
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _first_valid_item_for_keyword(kw, pubblicati):
+    reasons = Counter()
+    usage = Counter()  # chiamate API, ultima pagina letta, pagina dell'offerta (per il bandit)
+    asin_candidates = {}  # asin -> pagina searchItems da cui viene (per il fallback GetItems)
+    incomplete = []
+
+    try:
+        with trace_span("scan_keyword", keyword=kw) as span:
+            deal = _scan_keyword(kw, pubblicati, reasons, asin_candidates, incomplete, usage)
+            if span is not None:
+                span["attrs"].update(reasons=dict(reasons), found=deal["asin"] if deal else None)
+            return deal
+    finally:
+        for reason, n in reasons.items():
+            metric_inc("bot_rejections_total", n, keyword=kw, reason=reason)
+        # quelli non già passati dal fallback restano in attesa del batch GetItems
+        if ENRICH_ENABLED:
+            enrich_add([a for a in incomplete if a not in asin_candidates], kw)
+        # API sospesa: non è colpa della keyword
+        if KEYWORD_SELECTOR == "bandit" and usage["last_page"] and not reasons.get("api_unavailable"):
+            try:
+                record_keyword_outcome(kw, usage["calls"], usage.get("found_page"))
+            except Exception as e:
+                print(f"⚠️ Statistiche keyword non aggiornate ({kw}): {e}")
+
+
+def _pick_deal(pool, reasons, asin_candidates, incomplete, ranked):
+    """
+    Filtra a lotti pool [(parsed, from_cache, pagina)] e ritorna (payload, pagina) della
+    prima offerta valida, (None, None) se non ce ne sono.
+    """
+    parsed_list = [p for p, _, _ in pool]
+    order, rejected = filter_deals(parsed_list, ranked=ranked)
+
+    for reason, idx in rejected.items():
+        reasons[reason] += len(idx)
+    neg_cache_put_many((parsed_list[i]["asin"], reason) for reason, idx in rejected.items() for i in idx)
+    # Se searchItems non include abbastanza info, salva asin per getItems
+    for i in rejected.get("no_price_or_disc_in_searchitems", []):
+        asin = parsed_list[i]["asin"]
+        incomplete.append(asin)
+        if len(asin_candidates) < GETITEMS_FALLBACK_MAX:
+            asin_candidates.setdefault(asin, pool[i][2])
+
+    for i in order:
+        parsed, from_cache, page = pool[i]
+        asin = parsed["asin"]
+
+        # pagina dalla cache: il prezzo può essere vecchio, riconferma con GetItems
+        if from_cache and SEARCH_CACHE_RECHECK:
+            try:
+                parsed = _recheck_price(parsed)
+            except Exception as e:
+                parsed = None
+                if DEBUG_AMAZON:
+                    print(f"[DEBUG] GetItems recheck error asin={asin}: {e}")
+            if parsed is None or _reject_reason(parsed):
+                reasons["stale_in_cache"] += 1
+                continue
+
+        deal = _deal_payload(parsed)
+        if DEBUG_AMAZON:
+            print(
+                f"[DEBUG] FOUND via SearchItems asin={asin} price={deal['price_new']} "
+                f"old={deal['price_old']} disc={deal['discount']} cache={from_cache}"
+            )
+        return deal, page
+
+    return None, None
+
+
+def _scan_keyword(kw, pubblicati, reasons, asin_candidates, incomplete, usage):
+    best_mode = DEAL_SELECTION == "best"
+    pool = []
+
+    with closing(_iter_search_pages(kw, pages=keyword_pages(kw))) as search_pages:
+        for page, items, from_cache, err in search_pages:
+            if isinstance(err, CreatorsUnavailable):
+                # breaker aperto o quota finita: inutile provare le altre pagine
+                reasons["api_unavailable"] += 1
+                print(f"⛔ Creators searchItems non disponibile (kw='{kw}'): {err}")
+                break
+            if err is not None:
+                reasons["api_error"] += 1
+                print(f"❌ Creators searchItems error (kw='{kw}', page={page}): {err}")
+                continue
 
-                if price_val is None or disc == 0:
+            usage["last_page"] = page
+            parsed_page = []
+            for item in items:
+                if neg_cache_get((item.get("asin") or "").strip().upper(), "parse"):
+                    reasons["negative_cache"] += 1
                     continue
-                if price_val < MIN_PRICE or price_val > MAX_PRICE:
+                parsed_page.append(extract_from_item(item))
+            # le pagine dalla cache hanno prezzi già registrati (e non di adesso)
+            if not from_cache:
+                usage["calls"] += 1
+                record_prices(parsed_page)
+
+            page_pool = []
+            for parsed in parsed_page:
+                asin = parsed["asin"]
+                if not asin:
+                    reasons["no_asin"] += 1
                     continue
-                if disc < MIN_DISCOUNT:
+                if asin in pubblicati or not can_post(asin, hours=24):
+                    reasons["already_posted"] += 1
                     continue
+                page_pool.append((parsed, from_cache, page))
+
+            # "best": si valutano tutte le pagine insieme alla fine
+            if best_mode:
+                pool.extend(page_pool)
+                continue
+
+            deal, found_page = _pick_deal(page_pool, reasons, asin_candidates, incomplete, ranked=False)
+            if deal:
+                usage["found_page"] = found_page
+                return deal
 
-                url_img = parsed["url_img"] or "https://m.media-amazon.com/images/I/71bhWgQK-cL._AC_SL1500_.jpg"
-                title = (parsed["title"] or "")[:80].strip()
-                if len(parsed["title"] or "") > 80:
-                    title += "…"
+    # la profondità registrata è la pagina dell'offerta scelta, non l'ultima letta:
+    # altrimenti le statistiche del bandit non potrebbero mai ridurla
+    if pool:
+        deal, found_page = _pick_deal(pool, reasons, asin_candidates, incomplete, ranked=True)
+        if deal:
+            usage["found_page"] = found_page
+            return deal
 
+    # Fallback getItems su pochi candidati (molto spesso qui arrivano old/savings meglio)
+    if asin_candidates:
+        try:
+            usage["calls"] += 1
+            parsed_list = [
+                p for p in _getitems_parsed(list(asin_candidates))
+                if p["asin"] and p["asin"] not in pubblicati and can_post(p["asin"], hours=24)
+            ]
+            order, _ = filter_deals(parsed_list, ranked=best_mode)
+            if order:
+                deal = _deal_payload(parsed_list[order[0]])
                 if DEBUG_AMAZON:
-                    print(f"[DEBUG] FOUND via GetItems asin={asin} price={price_val} old={old_val} disc={disc}")
-
-                return {
-                    "asin": asin,
-                    "title": title,
-                    "price_new": price_val,
-                    "price_old": old_val,
-                    "discount": disc,
-                    "url_img": url_img,
-                    "url": parsed["url"],
-                    "minimo": disc >= 30,
-                }
+                    print(
+                        f"[DEBUG] FOUND via GetItems asin={deal['asin']} price={deal['price_new']} "
+                        f"old={deal['price_old']} disc={deal['discount']}"
+                    )
+                usage["found_page"] = asin_candidates.get(deal["asin"]) or usage["last_page"] or 1
+                return deal
 
         except Exception as e:
             reasons["getitems_error"] += 1
@@ -686,48 +2867,404 @@ def _first_valid_item_for_keyword(kw, pubblicati):
                 print(f"[DEBUG] GetItems fallback error: {e}")
 
     if DEBUG_AMAZON:
-        print(f"[DEBUG] kw={kw} reasons={dict(reasons)} asin_candidates={asin_candidates}")
+        print(f"[DEBUG] kw={kw} reasons={dict(reasons)} asin_candidates={list(asin_candidates)}")
+
+    return None
+
+
+# ============================================================
+# Coda offerte pronte (prefetch in background)
+# ============================================================
+# Heap di (-sconto, -risparmio, seq, entry): in cima l'offerta migliore.
+# entry = {"payload": ..., "card": bytes codificati, "card_name": ..., "found_at": epoch}
+_prefetch_lock = threading.Lock()
+_prefetch_heap = []
+_prefetch_seq = itertools.count()
+_prefetch_started = False
+
+
+def _deal_priority(payload):
+    saving = (payload["price_old"] or payload["price_new"]) - payload["price_new"]
+    return (-payload["discount"], -saving)
+
+
+def prepare_deal(payload):
+    """Renderizza la card di un'offerta: dopo serve solo l'invio."""
+    immagine = genera_immagine_offerta(
+        payload["title"],
+        payload["price_new"],
+        payload["price_old"],
+        payload["discount"],
+        payload["url_img"],
+        payload["minimo"],
+    )
+    return {
+        "payload": payload,
+        "card": immagine.getvalue(),
+        "card_name": getattr(immagine, "name", "card.png"),
+        "found_at": time.time(),
+    }
 
+
+def _prefetch_purge_locked():
+    cutoff = time.time() - PREFETCH_TTL_SECONDS
+    alive = [e for e in _prefetch_heap if e[3]["found_at"] > cutoff]
+    if len(alive) != len(_prefetch_heap):
+        _prefetch_heap[:] = alive
+        heapq.heapify(_prefetch_heap)
+
+
+def prefetch_size():
+    with _prefetch_lock:
+        _prefetch_purge_locked()
+        return len(_prefetch_heap)
+
+
+def prefetch_queued_asins():
+    with _prefetch_lock:
+        return {e[3]["payload"]["asin"] for e in _prefetch_heap}
+
+
+def prefetch_accepts(payload):
+    """True se prefetch_push accetterebbe l'offerta (evita di renderizzare per niente)."""
+    with _prefetch_lock:
+        _prefetch_purge_locked()
+        if len(_prefetch_heap) < PREFETCH_QUEUE_MAX:
+            return True
+        return _deal_priority(payload) < max(_prefetch_heap)[:2]
+
+
+def prefetch_push(entry):
+    """Aggiunge un'offerta pronta; a coda piena sostituisce la peggiore solo se è migliore."""
+    item = (*_deal_priority(entry["payload"]), next(_prefetch_seq), entry)
+    with _prefetch_lock:
+        _prefetch_purge_locked()
+        if any(e[3]["payload"]["asin"] == entry["payload"]["asin"] for e in _prefetch_heap):
+            return False
+        if len(_prefetch_heap) >= PREFETCH_QUEUE_MAX:
+            worst = max(_prefetch_heap)
+            if worst[:2] <= item[:2]:
+                return False
+            _prefetch_heap.remove(worst)
+            heapq.heapify(_prefetch_heap)
+        heapq.heappush(_prefetch_heap, item)
+        return True
+
+
+def prefetch_pop(pubblicati):
+    """Migliore offerta ancora fresca e non pubblicata nel frattempo (ricontrollo solo locale)."""
+    with _prefetch_lock:
+        _prefetch_purge_locked()
+        while _prefetch_heap:
+            entry = heapq.heappop(_prefetch_heap)[3]
+            asin = entry["payload"]["asin"]
+            if asin in pubblicati or not can_post(asin, hours=24):
+                continue
+            return entry
     return None
 
 
+def prefetch_once():
+    """Cerca un'offerta per la prossima keyword e la mette in coda già renderizzata."""
+    _require_env()
+
+    exclude = load_pubblicati() | prefetch_queued_asins()
+    kw = pick_keyword()
+    payload = _first_valid_item_for_keyword(kw, exclude)
+    if not payload:
+        if DEBUG_AMAZON:
+            print(f"[DEBUG] Prefetch: nessuna offerta per keyword: {kw}")
+        return False
+
+    payload["kw"] = kw
+    added = prefetch_push(prepare_deal(payload))
+    if DEBUG_AMAZON:
+        print(f"[DEBUG] Prefetch: {payload['asin']} | {kw} added={added} queue={prefetch_size()}")
+    return added
+
+
+def _prefetch_loop():
+    while True:
+        try:
+            in_window, _ = is_in_italy_window()
+            if in_window and prefetch_size() < PREFETCH_QUEUE_MAX:
+                prefetch_once()
+        except Exception as e:
+            print(f"⚠️ Prefetch error: {e}")
+        time.sleep(PREFETCH_INTERVAL)
+
+
+def start_prefetcher():
+    global _prefetch_started
+    with _prefetch_lock:
+        if _prefetch_started:
+            return
+        _prefetch_started = True
+    threading.Thread(target=_prefetch_loop, daemon=True).start()
+
+
+# ============================================================
+# Arricchimento GetItems a lotti (ASIN incompleti tra keyword)
+# ============================================================
+# { asin: {"kw": keyword, "ts": epoch} } in ordine di arrivo, persistito in ENRICH_FILE
+_enrich_lock = threading.Lock()
+_enrich_pending = None
+_enrich_started = False
+
+
+def _enrich_load_locked():
+    global _enrich_pending
+    if _enrich_pending is None:
+        _enrich_pending = OrderedDict()
+        try:
+            with open(ENRICH_FILE, "r", encoding="utf-8") as f:
+                for asin, meta in json.load(f):
+                    _enrich_pending[asin] = meta
+        except:
+            pass
+    cutoff = time.time() - ENRICH_PENDING_TTL
+    for asin in [a for a, m in _enrich_pending.items() if m.get("ts", 0) < cutoff]:
+        del _enrich_pending[asin]
+    return _enrich_pending
+
+
+def _enrich_save_locked():
+    try:
+        ensure_data_dir()
+        _replace_file(ENRICH_FILE, lambda f: json.dump(list(_enrich_pending.items()), f))
+    except Exception as e:
+        print(f"⚠️ Salvataggio enrich_pending fallito: {e}")
+
+
+def enrich_add(asins, kw):
+    asins = [a for a in asins if not neg_cache_get(a, "enrich")]
+    if not asins:
+        return
+    now = time.time()
+    with _enrich_lock:
+        pending = _enrich_load_locked()
+        for asin in asins:
+            if asin not in pending:
+                pending[asin] = {"kw": kw, "ts": now}
+        while len(pending) > ENRICH_PENDING_MAX:
+            pending.popitem(last=False)
+        _enrich_save_locked()
+
+
+def enrich_pending_count():
+    with _enrich_lock:
+        return len(_enrich_load_locked())
+
+
+def _enrich_take(n):
+    with _enrich_lock:
+        pending = _enrich_load_locked()
+        batch = []
+        while pending and len(batch) < n:
+            batch.append(pending.popitem(last=False))
+        if batch:
+            _enrich_save_locked()
+        return batch
+
+
+def _enrich_put_back(batch):
+    """Rimette in testa un lotto preso da _enrich_take (GetItems fallita): si riprova al giro dopo."""
+    with _enrich_lock:
+        pending = _enrich_load_locked()
+        for asin, meta in reversed(batch):
+            pending.setdefault(asin, meta)
+            pending.move_to_end(asin, last=False)
+        _enrich_save_locked()
+
+
+def run_enrichment():
+    """
+    Un lotto GetItems (fino a GETITEMS_BATCH_MAX asin) sui pending più vecchi:
+    le offerte valide finiscono nella coda prefetch già renderizzate.
+    """
+    _require_env()
+
+    # breaker aperto: niente lotto, i pending restano dove sono
+    if not creators_available()[0]:
+        return 0
+
+    batch = _enrich_take(GETITEMS_BATCH_MAX)
+    if not batch:
+        return 0
+    kw_by_asin = {asin: meta.get("kw") for asin, meta in batch}
+
+    try:
+        parsed_list = _getitems_parsed(list(kw_by_asin))
+    except Exception as e:
+        _enrich_put_back(batch)
+        print(f"⚠️ Enrichment GetItems error ({len(batch)} asin rimessi in coda): {e}")
+        return 0
+
+    exclude = load_pubblicati() | prefetch_queued_asins()
+    parsed_list = [
+        p for p in parsed_list
+        if p["asin"] and p["asin"] not in exclude and can_post(p["asin"], hours=24)
+    ]
+    order, _ = filter_deals(parsed_list, ranked=True)
+
+    added = 0
+    for i in order:
+        parsed = parsed_list[i]
+        asin = parsed["asin"]
+        payload = _deal_payload(parsed)
+        payload["kw"] = kw_by_asin.get(asin) or "enrichment"
+        if not prefetch_accepts(payload):
+            continue
+        if prefetch_push(prepare_deal(payload)):
+            added += 1
+
+    if DEBUG_AMAZON:
+        print(f"[DEBUG] Enrichment: asins={len(batch)} valid={len(order)} queued={added}")
+    return added
+
+
+def _enrich_loop():
+    while True:
+        try:
+            in_window, _ = is_in_italy_window()
+            if in_window:
+                run_enrichment()
+        except Exception as e:
+            print(f"⚠️ Enrichment error: {e}")
+        time.sleep(ENRICH_INTERVAL)
+
+
+def start_enricher():
+    global _enrich_started
+    with _enrich_lock:
+        if _enrich_started:
+            return
+        _enrich_started = True
+    threading.Thread(target=_enrich_loop, daemon=True).start()
+
+
+# ============================================================
+# Telegram: invio su più chat (upload una volta, poi file_id)
+# ============================================================
+def _send_photo_retry(chat_id, photo_factory, **kwargs):
+    """send_photo con attesa sui flood limit (RetryAfter) fino a TELEGRAM_FLOOD_RETRIES volte."""
+    from telegram.error import RetryAfter
+
+    attempt = 0
+    while True:
+        try:
+            photo = photo_factory()
+            with timed("bot_send_photo_seconds", kind="file_id" if isinstance(photo, str) else "upload"):
+                trace_set(chat=chat_id, bytes=0 if isinstance(photo, str) else len(photo.getvalue()))
+                return get_bot().send_photo(chat_id=chat_id, photo=photo, **kwargs)
+        except RetryAfter as e:
+            if attempt >= TELEGRAM_FLOOD_RETRIES:
+                raise
+            attempt += 1
+            wait = float(e.retry_after) + random.uniform(0, 1)
+            print(f"⏳ Flood limit chat {chat_id}: attendo {wait:.0f}s ({attempt}/{TELEGRAM_FLOOD_RETRIES})")
+            time.sleep(wait)
+
+
+def send_card_to_chats(card, card_name, chat_ids, **kwargs):
+    """
+    Invia la card a tutte le chat_ids. Il file viene caricato sulla prima chat che
+    accetta; alle altre si manda il file_id restituito, in parallelo.
+    Ritorna {chat_id: None se ok, altrimenti l'eccezione}.
+    """
+    results = {}
+    remaining = list(chat_ids)
+    file_id = None
+
+    def upload():
+        photo = BytesIO(card)
+        photo.name = card_name
+        return photo
+
+    while remaining and file_id is None:
+        chat_id = remaining.pop(0)
+        try:
+            msg = _send_photo_retry(chat_id, upload, **kwargs)
+            file_id = msg.photo[-1].file_id
+            results[chat_id] = None
+        except Exception as e:
+            results[chat_id] = e
+            metric_inc("bot_send_failures_total", chat=chat_id)
+            print(f"❌ Telegram send_photo error (chat={chat_id}): {e}")
+
+    if remaining and file_id:
+        workers = max(1, min(TELEGRAM_FANOUT_WORKERS, len(remaining)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tg") as pool:
+            futures = {
+                chat_id: submit_in_context(pool, _send_photo_retry, chat_id, lambda: file_id, **kwargs)
+                for chat_id in remaining
+            }
+            for chat_id, fut in futures.items():
+                try:
+                    fut.result()
+                    results[chat_id] = None
+                except Exception as e:
+                    results[chat_id] = e
+                    metric_inc("bot_send_failures_total", chat=chat_id)
+                    print(f"❌ Telegram send_photo error (chat={chat_id}): {e}")
+
+    return results
+
+
 # ============================================================
 # Pubblica offerta
 # ============================================================
 def invia_offerta():
+    with trace_cycle("invia_offerta") as root:
+        ok = _invia_offerta_counted()
+        if root is not None:
+            root["attrs"]["posted"] = ok
+        return ok
+
+
+def _invia_offerta_counted():
+    try:
+        ok = _invia_offerta()
+    except Exception:
+        metric_inc("bot_ticks_total", outcome="error")
+        raise
+    metric_inc("bot_ticks_total", outcome="posted" if ok else "miss")
+    return ok
+
+
+def _invia_offerta():
     _require_env()
 
     pubblicati = load_pubblicati()
-    kw = pick_keyword()
 
-    payload = _first_valid_item_for_keyword(kw, pubblicati)
-    if not payload:
-        print(f"⚠️ Nessuna offerta valida trovata per keyword: {kw}")
+    entry = prefetch_pop(pubblicati)
+    if entry:
+        kw = entry["payload"].get("kw", "prefetch")
+    elif not creators_available()[0]:
+        print(f"⛔ Creators API sospesa (breaker aperto, riprova tra {creators_available()[1]:.0f}s): tick saltato")
         return False
-
+    else:
+        kw = pick_keyword()
+        payload = _first_valid_item_for_keyword(kw, pubblicati | prefetch_queued_asins())
+        if not payload:
+            print(f"⚠️ Nessuna offerta valida trovata per keyword: {kw}")
+            return False
+        entry = prepare_deal(payload)
+
+    payload = entry["payload"]
     titolo = payload["title"]
     prezzo_nuovo_val = payload["price_new"]
     prezzo_vecchio_val = payload["price_old"]
     sconto = payload["discount"]
-    url_img = payload["url_img"]
     url = payload["url"]
     minimo = payload["minimo"]
     asin = payload["asin"]
 
-    immagine = genera_immagine_offerta(
-        titolo,
-        prezzo_nuovo_val,
-        prezzo_vecchio_val,
-        sconto,
-        url_img,
-        minimo,
-    )
-
     safe_title = html.escape(titolo)
     safe_url = html.escape(url, quote=True)
 
     caption_parts = [f"📌 <b>{safe_title}</b>"]
-    if minimo and sconto >= 30:
+    if minimo:
         caption_parts.append("❗️🚨 <b>MINIMO STORICO</b> 🚨❗️")
 
     if prezzo_vecchio_val and prezzo_vecchio_val > prezzo_nuovo_val:
@@ -742,53 +3279,361 @@ def invia_offerta():
 
     caption = "\n\n".join(caption_parts)
 
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
     button = InlineKeyboardMarkup([[InlineKeyboardButton("🛒 Acquista ora", url=url)]])
 
-    bot.send_photo(
-        chat_id=TELEGRAM_CHAT_ID,
-        photo=immagine,
-        caption=caption,
-        parse_mode="HTML",
-        reply_markup=button,
-    )
+    # solo le chat che non l'hanno già ricevuto (es. dopo un invio parziale), con la
+    # prenotazione dell'ASIN: un ciclo concorrente che ha scelto la stessa offerta rinuncia
+    owner = uuid.uuid4().hex
+    targets = claim_post(asin, owner, hours=24)
+    if not targets:
+        print(f"⏭ {asin} già pubblicata o in invio da un altro ciclo: salto")
+        return False
 
-    save_pubblicati(asin)
-    mark_posted(asin)
-    print(f"✅ Pubblicata: {asin} | {kw}")
+    try:
+        results = send_card_to_chats(
+            entry["card"],
+            entry.get("card_name", "card.png"),
+            targets,
+            caption=caption,
+            parse_mode="HTML",
+            reply_markup=button,
+        )
+    except BaseException:
+        release_claim(asin, owner)
+        raise
+    ok_chats = [c for c, err in results.items() if err is None]
+    failed = [c for c, err in results.items() if err is not None]
+
+    if not ok_chats:
+        release_claim(asin, owner)
+        raise RuntimeError(f"Invio fallito su tutte le chat: {results}")
+
+    # pubblicati solo quando tutte le chat l'hanno ricevuto: le altre riprovano al prossimo giro
+    commit_post(asin, ok_chats, complete=not failed, owner=owner)
+    if not failed:
+        print(f"✅ Pubblicata: {asin} | {kw}")
+    else:
+        print(f"⚠️ Pubblicata parzialmente: {asin} | {kw} | ok={ok_chats} falliti={failed}")
     return True
 
 
 # ============================================================
-# Fascia oraria Italia (semplice CET/CEST)
+# Cicli single-flight e job di /run
+# ============================================================
+# Un solo ciclo invia_offerta alla volta nel processo: chi lo chiede mentre uno è in corso
+# (scheduler o /run) si aggancia a quello e ne riceve l'esito invece di avviarne un altro.
+_cycle_lock = threading.Lock()
+_cycle = None  # {"id", "source", "started", "jobs": [id job agganciati], "done": Event, "ok", "error"}
+
+
+def cycle_in_flight():
+    with _cycle_lock:
+        return None if _cycle is None else {"id": _cycle["id"], "source": _cycle["source"], "started": _cycle["started"]}
+
+
+def _join_or_start_cycle(source, job_id=None):
+    """(ciclo, leader): aggancia al ciclo in corso o ne crea uno nuovo. Con job_id aggancia il job al ciclo."""
+    global _cycle
+    with _cycle_lock:
+        leader = _cycle is None
+        cycle = _cycle or {
+            "id": uuid.uuid4().hex[:12],
+            "source": source,
+            "started": time.time(),
+            "jobs": [],
+            "done": threading.Event(),
+            "ok": None,
+            "error": None,
+        }
+        if job_id:
+            # sotto lock solo la lista in memoria: la riga su SQLite la scrive submit_run_job
+            cycle["jobs"].append(job_id)
+        _cycle = cycle
+    metric_inc("bot_cycles_total", source=source, outcome="started" if leader else "coalesced")
+    return cycle, leader
+
+
+def _run_cycle_leader(cycle):
+    global _cycle
+    try:
+        cycle["ok"] = invia_offerta()
+    except Exception as e:
+        cycle["error"] = e
+        print(f"❌ Ciclo {cycle['id']} ({cycle['source']}) fallito: {e}")
+    finally:
+        with _cycle_lock:
+            _cycle = None
+            jobs = list(cycle["jobs"])
+        cycle["done"].set()
+        if jobs:
+            _jobs_finish(jobs, cycle)
+
+
+def run_cycle(source="scheduler"):
+    """invia_offerta single-flight e sincrono (scheduler): con un ciclo già in corso ne attende l'esito."""
+    cycle, leader = _join_or_start_cycle(source)
+    if not leader:
+        cycle["done"].wait()
+        return bool(cycle["ok"])
+    _run_cycle_leader(cycle)
+    if cycle["error"] is not None:
+        raise cycle["error"]
+    return bool(cycle["ok"])
+
+
+def submit_run_job(source="http"):
+    """Job asincrono: aggancia il ciclo in corso o ne avvia uno in background. Ritorna lo stato del job."""
+    job_id = uuid.uuid4().hex
+    cycle, leader = _join_or_start_cycle(source, job_id)
+    # INSERT fuori da _cycle_lock: /run e scheduler non aspettano il disco per decidere
+    try:
+        _job_insert(job_id, source, cycle["id"], coalesced=not leader)
+    finally:
+        if leader:
+            threading.Thread(target=_run_cycle_leader, args=(cycle,), name=f"cycle-{cycle['id']}", daemon=True).start()
+    # ciclo già chiuso prima dell'INSERT: l'UPDATE del leader non ha trovato la riga
+    if cycle["done"].is_set():
+        _jobs_finish([job_id], cycle)
+    return get_job(job_id)
+
+
+def _job_insert(job_id, source, cycle_id, coalesced):
+    now = time.time()
+    with _db_tx() as conn:
+        conn.execute(
+            "INSERT INTO jobs (id, source, cycle, coalesced, status, created) VALUES (?, ?, ?, ?, 'running', ?)",
+            (job_id, source, cycle_id, int(coalesced), now),
+        )
+        conn.execute("DELETE FROM jobs WHERE created < ?", (now - RUN_JOB_RETENTION_HOURS * 3600,))
+
+
+def _jobs_finish(job_ids, cycle):
+    error = None if cycle["error"] is None else f"{type(cycle['error']).__name__}: {cycle['error']}"[:2000]
+    try:
+        with _db_tx() as conn:
+            conn.executemany(
+                "UPDATE jobs SET status = ?, posted = ?, error = ?, finished = ? WHERE id = ?",
+                [("error" if error else "done", int(bool(cycle["ok"])), error, time.time(), j) for j in job_ids],
+            )
+    except Exception as e:
+        print(f"⚠️ Stato dei job {job_ids} non salvato: {e}")
+
+
+def get_job(job_id):
+    row = _db().execute(
+        "SELECT id, source, cycle, coalesced, status, posted, error, created, finished FROM jobs WHERE id = ?",
+        (job_id,),
+    ).fetchone()
+    if not row:
+        return None
+    job = dict(zip(("id", "source", "cycle", "coalesced", "status", "posted", "error", "created", "finished"), row))
+    job["coalesced"] = bool(job["coalesced"])
+    job["posted"] = None if job["posted"] is None else bool(job["posted"])
+    return job
+
+
+# ============================================================
+# Fascia oraria e scheduler (fuso SCHEDULE_TZ, default Europe/Rome)
 # ============================================================
 def is_in_italy_window(now_utc=None):
+    """(in fascia, ora locale) per un datetime UTC (naive o aware); default adesso."""
     if now_utc is None:
-        now_utc = datetime.utcnow()
-    month = now_utc.month
-    offset_hours = 2 if 4 <= month <= 10 else 1  # CEST approx / CET approx
-    italy_time = now_utc + timedelta(hours=offset_hours)
-    in_window = 9 <= italy_time.hour < 21
+        now_utc = datetime.now(timezone.utc)
+    elif now_utc.tzinfo is None:
+        now_utc = now_utc.replace(tzinfo=timezone.utc)
+    italy_time = now_utc.astimezone(SCHEDULE_TZ)
+    in_window = POST_WINDOW_START <= italy_time.hour < POST_WINDOW_END
     return in_window, italy_time
 
 
-def run_if_in_fascia_oraria():
-    now_utc = datetime.utcnow()
-    in_window, italy_time = is_in_italy_window(now_utc)
-    if in_window:
-        invia_offerta()
-    else:
-        print(f"⏸ Fuori fascia oraria (Italia {italy_time.strftime('%H:%M')}), nessuna offerta pubblicata.")
+def _local_day_at(day, hours, minutes=0, tz=None):
+    """Epoch dell'ora locale hours:minutes del giorno day (hours può valere 24)."""
+    midnight = datetime.combine(day, datetime.min.time(), tzinfo=tz or SCHEDULE_TZ)
+    return (midnight + timedelta(hours=hours, minutes=minutes)).timestamp()
+
+
+def next_window_slot(after, tz=None):
+    """Primo slot d'invio dopo after (epoch): griglia di POST_INTERVAL_MINUTES da inizio fascia."""
+    tz = tz or SCHEDULE_TZ
+    step = POST_INTERVAL_MINUTES * 60
+    today = datetime.fromtimestamp(after, tz).date()
+    for d in range(8):
+        day = today + timedelta(days=d)
+        start = _local_day_at(day, POST_WINDOW_START, tz=tz)
+        end = _local_day_at(day, POST_WINDOW_END, tz=tz)
+        if after < start:
+            return start
+        if after < end:
+            slot = start + (int((after - start) // step) + 1) * step
+            if slot < end:
+                return slot
+    return None
 
 
-def start_scheduler():
-    schedule.clear()
-    # Reset pubblicati ogni lunedì (ATTENZIONE: schedule usa timezone della macchina, spesso UTC su Render)
-    schedule.every().monday.at("06:59").do(resetta_pubblicati)
-    schedule.every(14).minutes.do(run_if_in_fascia_oraria)
+def next_weekly(after, weekday, hhmm, tz=None):
+    """Prossima occorrenza (epoch) del giorno weekday alle hhmm locali dopo after."""
+    tz = tz or SCHEDULE_TZ
+    hh, mm = (int(x) for x in hhmm.split(":"))
+    today = datetime.fromtimestamp(after, tz).date()
+    for d in range(8):
+        day = today + timedelta(days=d)
+        if day.weekday() == weekday:
+            t = _local_day_at(day, hh, mm, tz=tz)
+            if t > after:
+                return t
+    return None
 
-    while True:
-        schedule.run_pending()
-        time.sleep(5)
+
+class Scheduler:
+    """
+    Scheduler a heap: dorme fino al prossimo job invece di interrogare ogni 5s.
+    Ogni job ha una funzione next_after(epoch) -> prossimo slot (o None), un jitter
+    in secondi, una politica per i tick persi ("skip" oltre grace secondi, "once") e
+    un eventuale allowed(epoch): un recupero fuori da allowed viene saltato.
+    now/sleep sono iniettabili: con un orologio finto si simula una settimana in un attimo.
+    """
+
+    def __init__(self, now=time.time, sleep=None, rng=None):
+        self._now = now
+        self._sleep = sleep
+        self._rng = rng or random.Random()
+        self._heap = []  # (scadenza, seq, job)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+
+    def add(self, name, fn, next_after, jitter=0.0, catchup="skip", grace=SCHEDULE_GRACE_SECONDS, allowed=None):
+        job = {
+            "name": name, "fn": fn, "next_after": next_after, "jitter": jitter,
+            "catchup": catchup, "grace": grace, "allowed": allowed,
+        }
+        self._push(job, self._now())
+        self._wake.set()
+        return job
+
+    def _push(self, job, after, at=None):
+        """Accoda il primo slot dopo after, oppure (recupero) esattamente at."""
+        slot = at if at is not None else job["next_after"](after)
+        if slot is None:
+            return
+        job["slot"] = slot
+        due = slot + (self._rng.uniform(0, job["jitter"]) if job["jitter"] > 0 and at is None else 0)
+        with self._lock:
+            heapq.heappush(self._heap, (due, next(self._seq), job))
+
+    def next_due(self):
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def jobs(self):
+        """[(nome, scadenza epoch)] in ordine di scadenza."""
+        with self._lock:
+            return [(job["name"], due) for due, _, job in sorted(self._heap)]
+
+    def run_pending(self):
+        """Esegue i job scaduti; ritorna quanti ne ha eseguiti."""
+        ran = 0
+        while True:
+            now = self._now()
+            with self._lock:
+                if not self._heap or self._heap[0][0] > now:
+                    return ran
+                due, _, job = heapq.heappop(self._heap)
+
+            late = now - due
+            if job["allowed"] and not job["allowed"](now):
+                print(f"⏭ {job['name']} saltato: recupero fuori fascia (in ritardo di {late:.0f}s)")
+                metric_inc("bot_scheduler_runs_total", job=job["name"], outcome="skipped")
+            elif job["catchup"] == "skip" and late > job["grace"]:
+                print(f"⏭ {job['name']} saltato: in ritardo di {late:.0f}s")
+                metric_inc("bot_scheduler_runs_total", job=job["name"], outcome="skipped")
+            else:
+                try:
+                    job["fn"]()
+                    metric_inc("bot_scheduler_runs_total", job=job["name"], outcome="ok")
+                except Exception as e:
+                    metric_inc("bot_scheduler_runs_total", job=job["name"], outcome="error")
+                    print(f"❌ Job {job['name']} fallito: {e}")
+                ran += 1
+
+            now = self._now()
+            nxt = job["next_after"](job["slot"])
+            if nxt is not None and nxt <= now:
+                # slot persi durante il job o una sospensione: con "once" se ne recupera
+                # uno solo (se questo era puntuale), con "skip" si riparte dal prossimo
+                if job["catchup"] == "once" and late <= job["grace"]:
+                    self._push(job, now, at=now)
+                else:
+                    self._push(job, now)
+            else:
+                self._push(job, job["slot"])
+
+    def run_until(self, deadline=None):
+        """Ciclo principale fino a deadline (epoch) o stop()."""
+        while not self._stopped:
+            self.run_pending()
+            due = self.next_due()
+            now = self._now()
+            if deadline is not None:
+                if now >= deadline:
+                    return
+                due = deadline if due is None else min(due, deadline)
+            delay = None if due is None else max(0.0, due - now)
+            if self._sleep is not None:
+                if delay is None:
+                    return
+                self._sleep(delay)
+            else:
+                self._wake.wait(delay)
+                self._wake.clear()
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+
+
+_scheduler = None
+
+
+def build_scheduler(now=time.time, sleep=None, post_job=None, reset_job=None, rng=None):
+    """Scheduler con i job standard (invio in fascia, reset settimanale)."""
+    sched = Scheduler(now=now, sleep=sleep, rng=rng)
+    sched.add("resetta_pubblicati", reset_job or resetta_pubblicati,
+              lambda t: next_weekly(t, RESET_WEEKDAY, RESET_TIME), catchup="once")
+    sched.add("invia_offerta", post_job or (lambda: run_cycle("scheduler")), next_window_slot,
+              jitter=POST_JITTER_SECONDS, catchup=SCHEDULE_CATCHUP,
+              allowed=lambda t: is_in_italy_window(datetime.fromtimestamp(t, timezone.utc))[0])
+    return sched
+
+
+def warm_up():
+    """Carica in anticipo quello che all'import è rimandato: stato, numpy, template card, PIL, Bot."""
+    t0 = time.perf_counter()
+    steps = [("state_db", _db), ("numpy", get_numpy), ("render_template", get_render_template), ("bot", get_bot)]
+    for name, fn in steps:
+        try:
+            fn()
+        except Exception as e:
+            print(f"⚠️ Warm-up {name} fallito: {e}")
+    print(f"🔥 Warm-up completato in {time.perf_counter() - t0:.2f}s")
+
+
+def start_scheduler():
+    global _scheduler
+    start_token_refresher()
+    if PREFETCH_ENABLED:
+        start_prefetcher()
+    if ENRICH_ENABLED:
+        start_enricher()
+
+    _scheduler = build_scheduler()
+    for name, due in _scheduler.jobs():
+        when = datetime.fromtimestamp(due, SCHEDULE_TZ).strftime("%a %d/%m %H:%M:%S %Z")
+        print(f"🗓 {name}: prossima esecuzione {when}")
+    _scheduler.run_until()
 
 
 if __name__ == "__main__":